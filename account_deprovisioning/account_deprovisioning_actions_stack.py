@@ -15,11 +15,14 @@ from aws_cdk import (
     aws_secretsmanager as sm,
     aws_sns_subscriptions as subscriptions,
     aws_lambda_event_sources as lambda_event_sources,
+    aws_events as events,
+    aws_events_targets as etargets,
     Duration
 )
 
 from .src.state_machine.state_machine import ad_delete_sfn_workflow
 from .src.s3.bucket import bucket_init
+from .src.layers.layer import shared_layer_init
 
 from aws_cdk.aws_lambda import (
     IFunction
@@ -53,10 +56,15 @@ class AccountDeprovisioningActionsStack(PLNUStack):
 
         environment = self.cdk_env.get('environment')
 
+        idempotency_table = self.build_idempotency_table()
+
         # Set up basic environment variables to be shared across all lambdas
         default_env = {'deploy_environment': environment,
                        'log_level': self.cdk_env.get('log_level'),
-                       'failure_topic_arn': failure_topic.topic_arn
+                       'failure_topic_arn': failure_topic.topic_arn,
+                       'deprov_topic_arn': deprov_topic.topic_arn,
+                       'buffer_outcomes': str(self.cdk_env.get('buffer_outcomes', False)).lower(),
+                       'idempotency_table': idempotency_table.table_name
                        }
 
         force_logout_env = {'canvas_url': self.cdk_env.get('canvas_url')}
@@ -124,6 +132,11 @@ class AccountDeprovisioningActionsStack(PLNUStack):
                                     visibility_timeout=Duration.seconds(300)
                                     )
 
+        # Users are spread over message groups, so the writer can consume several groups at once while each user's
+        # suspend and delete stay in order
+        ad_delete_message_groups = int(self.cdk_env.get('ad_delete_message_groups', 16))
+        ad_delete_writer_concurrency = int(self.cdk_env.get('ad_delete_writer_concurrency', 4))
+
         lambdas['ad_delete_sfn_handler'] = (
             lambda_factory.basic_lambda(self, 'ad_delete_sfn_handler', SRC_PATH, BASE_PATH, REL_SRC_PATH, 60,
                                         "Checks delete state and processes recorsd for deletion", 0,
@@ -131,16 +144,20 @@ class AccountDeprovisioningActionsStack(PLNUStack):
                                             'bucket_arn': ad_delete_bucket.bucket_arn,
                                             'bucket_name': ad_delete_bucket.bucket_name,
                                             'queue_url': ad_delete_queue.queue_url,
+                                            'message_group_shards': str(ad_delete_message_groups)
                                         })
         )
 
+        # Minutes of deletes combined into a single file for AD, 0 writes a file per batch
+        ad_delete_window_minutes = int(self.cdk_env.get('ad_delete_window_minutes', 0))
+
         lambdas['ad_delete_bucket_writer'] = (
             lambda_factory.basic_lambda(self, 'ad_delete_bucket_writer', SRC_PATH, BASE_PATH, REL_SRC_PATH, 60,
                                         'AD delete bucket writer.', 2, environment={
-                    'queue_url': ad_delete_queue.queue_url,
-                    'bucket_name': ad_delete_bucket.bucket_name
+                    'bucket_name': ad_delete_bucket.bucket_name,
+                    'accumulate_window_minutes': str(ad_delete_window_minutes)
                 },
-                                        reserved_concurrent_executions=1
+                                        reserved_concurrent_executions=ad_delete_writer_concurrency
                                         )
         )
 
@@ -163,10 +180,19 @@ class AccountDeprovisioningActionsStack(PLNUStack):
         )
 
         # set sqs queue as lambda trigger
+        # FIFO event sources take at most 10 messages per batch and no batching window, larger files come from
+        # compacting the batches of a window. Messages the writer couldn't read are returned as batch item failures,
+        # the rest are deleted by the event source
         lambdas['ad_delete_bucket_writer'].add_event_source(
-            lambda_event_sources.SqsEventSource(ad_delete_queue)
+            lambda_event_sources.SqsEventSource(ad_delete_queue, batch_size=10, report_batch_item_failures=True)
         )
 
+        # Compacts each window's batches once it has closed
+        if ad_delete_window_minutes:
+            compaction_rule = events.Rule(self, "ad_delete_compaction_rule",
+                                          schedule=events.Schedule.rate(Duration.minutes(ad_delete_window_minutes)))
+            compaction_rule.add_target(etargets.LambdaFunction(lambdas['ad_delete_bucket_writer']))
+
         # Step function state machine permission
         ad_delete_workflow.grant_start_execution(lambdas['ad_delete_entry'])
 
@@ -216,24 +242,56 @@ class AccountDeprovisioningActionsStack(PLNUStack):
 
         canvas_secret.grant_read(lambdas['force_logout_canvas'])
 
-        # Set up step subscriptions
-        add_sns_subscription(deprov_topic, lambdas['disable_in_gal'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['remove_google_license'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['remove_delegates'], ["emp-1", "emp-180"])
-        add_sns_subscription(deprov_topic, lambdas['remove_google_oauth_tokens'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['remove_google_asps'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['remove_ooo_msg'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['remove_mfa_factors'], ['emp-1'])
+        # Set up step subscriptions. Actions read their steps from their own queue, in batches. Each external API has
+        # a concurrency budget that is split between the actions calling it
+        api_subscriptions = {
+            'google': (self.cdk_env.get('google_max_concurrency', 16), {
+                'disable_in_gal': ["emp-1"],
+                'remove_google_license': ["emp-1"],
+                'remove_delegates': ["emp-1", "emp-180"],
+                'remove_google_oauth_tokens': ["emp-1"],
+                'remove_google_asps': ["emp-1"],
+                'remove_ooo_msg': ["emp-1"],
+                'suspend_google_account': ["emp-180"],
+                'force_logout_google': ["emp-1"]
+            }),
+            'onelogin': (self.cdk_env.get('onelogin_max_concurrency', 4), {
+                'remove_mfa_factors': ['emp-1'],
+                'force_logout_onelogin': ["emp-1"]
+            }),
+            'canvas': (self.cdk_env.get('canvas_max_concurrency', 2), {
+                'force_logout_canvas': ["emp-1"]
+            })
+        }
+        for budget, subscribed in api_subscriptions.values():
+            for name, steps in subscribed.items():
+                add_queue_subscription(self, deprov_topic, lambdas[name], steps, budget // len(subscribed))
         add_sns_subscription(deprov_topic, lambdas['ad_delete_entry'], ['emp-1'])
-        add_sns_subscription(deprov_topic, lambdas['suspend_google_account'], ["emp-180"])
-        add_sns_subscription(deprov_topic, lambdas['force_logout_canvas'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['force_logout_onelogin'], ["emp-1"])
-        add_sns_subscription(deprov_topic, lambdas['force_logout_google'], ["emp-1"])
 
-        # Grant all lambdas permission to publish to failure event processing sns topic
+        shared_layer = shared_layer_init(self)
+
+        # Grant all lambdas permission to publish to failure event processing sns topic, and to the deprovisioning
+        # topic to defer records they run out of time for, and access to the ledger of completed work
         for function in lambdas.values():
             failure_topic.grant_publish(function)
+            deprov_topic.grant_publish(function)
+            idempotency_table.grant_read_write_data(function)
             sns_kmskey.grant_encrypt_decrypt(function)
+            function.add_layers(shared_layer)
+
+    def build_idempotency_table(self) -> ddb.Table:
+        """
+        Creates the DynamoDB table action lambdas record completed work in, keyed by `<username>#<step>#<lambda_name>`.
+        Entries expire through TTL on `expires_at`, so the table only holds recent steps
+
+        :return: aws_cdk.aws_dynamodb.Table: The configured DynamoDB table
+        """
+        return ddb.Table(self, 'ActionIdempotency', table_name='ActionIdempotency',
+                         partition_key=ddb.Attribute(name="idempotency_key", type=ddb.AttributeType.STRING),
+                         billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+                         encryption=ddb.TableEncryption.AWS_MANAGED,
+                         time_to_live_attribute='expires_at'
+                         )
 
 
 def add_sns_subscription(topic: sns.ITopic, function: IFunction, steps: List[str]):
@@ -254,3 +312,47 @@ def add_sns_subscription(topic: sns.ITopic, function: IFunction, steps: List[str
             "step": sns.SubscriptionFilter.string_filter(allowlist=steps_and_lambda)
         }
     ))
+
+
+def add_queue_subscription(scope: Construct, topic: sns.ITopic, function: IFunction, steps: List[str],
+                           max_concurrency: int, batch_size: int = 5) -> sqs.Queue:
+    """
+    Subscribes the specified Lambda function to an SNS topic through its own SQS queue. The function reads messages
+    in batches and reports the ones it couldn't finish, which are redelivered on their own and moved to a dead letter
+    queue after repeated failures.
+
+    :param constructs.Construct scope: Stack the queues belong to
+    :param aws_cdk.aws_sns.ITopic topic: Topic to subscribe to
+    :param aws_cdk.aws_lambda.Function function: Lambda function consuming the queue
+    :param List[str] steps: Steps delivered to the function, along with retries addressed to the function itself
+    :param int max_concurrency: Maximum number of concurrent invocations of this function, to bound its share of the
+        load on the external API. SQS event sources take no less than 2
+    :param int batch_size: Maximum number of messages per invocation, each holding a list of records
+
+    :return: The configured SQS queue
+    """
+    queue_name = f"{function.node.id}_queue"
+    dead_letter_queue = sqs.Queue(scope, f"{queue_name}_dlq", retention_period=Duration.days(14))
+
+    # Six times the function timeout, as recommended for Lambda event sources
+    queue = sqs.Queue(scope, queue_name,
+                      visibility_timeout=Duration.seconds(360),
+                      dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dead_letter_queue))
+
+    topic.add_subscription(subscriptions.SqsSubscription(
+        queue,
+        raw_message_delivery=True,
+        filter_policy={
+            "step": sns.SubscriptionFilter.string_filter(allowlist=steps + [function.function_name])
+        }
+    ))
+
+    function.add_event_source(lambda_event_sources.SqsEventSource(
+        queue,
+        batch_size=batch_size,
+        max_batching_window=Duration.seconds(1),
+        max_concurrency=max(2, max_concurrency),
+        report_batch_item_failures=True
+    ))
+
+    return queue
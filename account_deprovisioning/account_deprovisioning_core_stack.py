@@ -7,6 +7,8 @@ from aws_cdk import (
     aws_sns as sns,
     aws_iam as iam,
     aws_sns_subscriptions as sns_sub,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
     aws_dynamodb as ddb,
     aws_ssm as ssm,
     aws_kms as kms,
@@ -14,11 +16,14 @@ from aws_cdk import (
     aws_events as events,
     aws_events_targets as etargets,
     aws_ses as ses,
+    aws_scheduler as scheduler,
 )
 from constructs import Construct
 
 from cdk_utils.cdk_utils import PLNUStack, PLNULambda
 
+from .src.layers.layer import shared_layer_init
+
 state_parameter_file = 'state_params.json'
 
 BASE_PATH = os.path.join(os.path.dirname(__file__), "..")
@@ -28,6 +33,7 @@ ENVIRONMENT_CONFIG_VAR = 'config'
 
 CORE_API_ROOT = "core"
 CORE_API_ACCOUNT = "account"
+CORE_API_BULK = "bulk"
 
 
 class AccountDeprovisioningCoreStack(PLNUStack):
@@ -44,6 +50,14 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
         self.deprov_topic = sns.Topic(self, "acct_deprovisioning_actions", master_key=self.sns_kmskey)
 
+        # `off`, `backfill` or `on`, see `event_index.STEP_SHARD_INDEX`. Moving from `off` creates
+        # next_step_shard-index, which must be its own deployment: a table update can only add one index
+        self.step_shard_index = self.cdk_env.get('step_shard_index', 'off')
+
+        # Whether retries scan has_failed_lambdas-index for users flagged before retries were scheduled. Turn off once
+        # none are left, retries are then polled every minute in prod
+        self.scan_legacy_failures = str(self.cdk_env.get('scan_legacy_failures', 'true')).lower() == 'true'
+
         self.event_table = self.build_event_table()
 
         deprov_topic_env = {"deprov_topic_arn": self.deprov_topic.topic_arn}
@@ -53,6 +67,8 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
         lam_fac = PLNULambda(default_env=default_env)
 
+        shared_layer = shared_layer_init(self)
+
         records_to_process_lambda = \
             lam_fac.basic_lambda(self, "get_records_to_process", SRC_PATH, BASE_PATH, REL_SRC_PATH, 60,
                                  "Gets records that are ready to be processed, puts them in the processing SNS topic",
@@ -60,11 +76,16 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
         self.sns_kmskey.grant_encrypt_decrypt(records_to_process_lambda)
         self.deprov_topic.grant_publish(records_to_process_lambda)
-        self.event_table.grant_read_data(records_to_process_lambda)
+        # Writes `next_step_shard` when invoked to backfill it
+        self.event_table.grant_read_write_data(records_to_process_lambda)
+        records_to_process_lambda.add_environment('step_shard_index', self.step_shard_index)
+
+        step_schedule_env = self.build_step_schedules(records_to_process_lambda)
 
         advance_step_lambda = \
             lam_fac.basic_lambda(self, "advance_step", SRC_PATH, BASE_PATH, REL_SRC_PATH, 60,
-                                 "Updates a state record to the next step and next trigger time", 2)
+                                 "Updates a state record to the next step and next trigger time", 2,
+                                 step_schedule_env)
 
         self.deprov_topic.add_subscription(
             sns_sub.LambdaSubscription(
@@ -76,9 +97,21 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
         insert_record_lambda = \
             lam_fac.basic_lambda(self, "insert_record", SRC_PATH, BASE_PATH, REL_SRC_PATH, 60,
-                                 "Inserts initial record for a user to decommission", 2)
+                                 "Inserts initial record for a user to decommission", 2, step_schedule_env)
 
         self.event_table.grant_read_write_data(insert_record_lambda)
+
+        schedule_steps_lambda = \
+            lam_fac.basic_lambda(self, "schedule_steps", SRC_PATH, BASE_PATH, REL_SRC_PATH, 60,
+                                 "Creates the step schedules of users queued by bulk inserts", 0, step_schedule_env)
+
+        # Bulk inserts queue their users' schedules instead of creating them within the API's timeout
+        step_schedule_queue = self.build_step_schedule_queue(schedule_steps_lambda)
+        insert_record_lambda.add_environment('step_schedule_queue_url', step_schedule_queue.queue_url)
+        step_schedule_queue.grant_send_messages(insert_record_lambda)
+
+        for scheduling_lambda in [advance_step_lambda, insert_record_lambda, schedule_steps_lambda]:
+            self.grant_step_scheduling(scheduling_lambda, step_schedule_env)
         api_gw = self.core_api(self.cdk_env)
         # self.api_gw_lambda_integration(insert_record_lambda, api_gw=api_gw)
 
@@ -99,7 +132,9 @@ class AccountDeprovisioningCoreStack(PLNUStack):
             "Checks for lambdas that failed with a retry expectation, requeues them for processing",
             0, deprov_topic_env)
 
-        self.event_table.grant_read_data(process_failed_lambda)
+        # Leases the retries it publishes
+        self.event_table.grant_read_write_data(process_failed_lambda)
+        process_failed_lambda.add_environment('scan_legacy_failures', str(self.scan_legacy_failures).lower())
         self.deprov_topic.grant_publish(process_failed_lambda)
 
         flag_failed_lambda_retry = lam_fac.basic_lambda(self, "flag_failed_lambda_retry", SRC_PATH, BASE_PATH,
@@ -134,14 +169,27 @@ class AccountDeprovisioningCoreStack(PLNUStack):
         self.event_table.grant_read_write_data(remove_failure_state)
 
         failure_handler_info = [
-            {"lambda": flag_failed_lambda_retry, "allowlist": ['retry']},
             {"lambda": process_terminal_failure, "allowlist": ['terminal']},
-            {"lambda": remove_failure_state, "allowlist": ['clear']},
             {"lambda": notify_email_terminal_lambda, "allowlist": ['terminal']}
         ]
 
         self.failure_topic = self.build_failure_topic(self.sns_kmskey, failure_handler_info)
 
+        # Success notifications of deleted users are published in batches
+        delete_record_lambda.add_environment('failure_topic_arn', self.failure_topic.topic_arn)
+        delete_record_lambda.add_environment('buffer_outcomes', 'true')
+        self.failure_topic.grant_publish(delete_record_lambda)
+        self.sns_kmskey.grant_encrypt_decrypt(delete_record_lambda)
+
+        # Failure state updates are buffered in SQS so they can be applied in batches, one update per user
+        self.build_failure_state_queue("failure_state_retry_queue", flag_failed_lambda_retry, ['retry'])
+        self.build_failure_state_queue("failure_state_clear_queue", remove_failure_state, ['clear'])
+
+        for layered_lambda in [advance_step_lambda, records_to_process_lambda, insert_record_lambda,
+                               delete_record_lambda, process_failed_lambda, flag_failed_lambda_retry,
+                               remove_failure_state, schedule_steps_lambda]:
+            layered_lambda.add_layers(shared_layer)
+
         process_records_rule = self.build_process_cron_rule()
         process_records_rule.add_target(etargets.LambdaFunction(records_to_process_lambda))
 
@@ -184,7 +232,8 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
     def build_event_table(self):
         """
-        Creates a DynamDB table with two global secondary indexes (next_step-index & has_failed_lambdas-index)
+        Creates a DynamDB table with global secondary indexes next_step-index, has_failed_lambdas-index,
+        retry_due-index and, once `step_shard_index` is no longer `off`, next_step_shard-index
 
         :return: aws_cdk.aws_dynamodb.Table: The configured DynamoDB table
         """
@@ -202,10 +251,28 @@ class AccountDeprovisioningCoreStack(PLNUStack):
                                          sort_key=ddb.Attribute(name="next_step_date", type=ddb.AttributeType.STRING),
                                          projection_type=ddb.ProjectionType.ALL)
 
+        # Write sharded: users of a step are spread over `<step>#<shard>` partitions, which are queried in parallel,
+        # so a step with many pending users doesn't concentrate on one partition
+        if self.step_shard_index != 'off':
+            table.add_global_secondary_index(index_name='next_step_shard-index',
+                                             partition_key=ddb.Attribute(name="next_step_shard",
+                                                                         type=ddb.AttributeType.STRING),
+                                             sort_key=ddb.Attribute(name="next_step_date",
+                                                                    type=ddb.AttributeType.STRING),
+                                             projection_type=ddb.ProjectionType.ALL)
+
         table.add_global_secondary_index(index_name='has_failed_lambdas-index',
                                          partition_key=ddb.Attribute(name="has_failed_lambdas",
                                                                      type=ddb.AttributeType.STRING))
 
+        # Sparse: only users with failed lambdas have `next_retry_at`, so retry discovery reads failures and nothing
+        # else. Keys only, the full records are fetched for the users that are due
+        table.add_global_secondary_index(index_name='retry_due-index',
+                                         partition_key=ddb.Attribute(name="has_failed_lambdas",
+                                                                     type=ddb.AttributeType.STRING),
+                                         sort_key=ddb.Attribute(name="next_retry_at", type=ddb.AttributeType.STRING),
+                                         projection_type=ddb.ProjectionType.KEYS_ONLY)
+
         return table
 
     def core_api(self, cdk_env):
@@ -239,7 +306,8 @@ class AccountDeprovisioningCoreStack(PLNUStack):
         usage_plan.add_api_stage(stage=api_gw.deployment_stage)
 
         core = api_gw.root.add_resource(CORE_API_ROOT)
-        core.add_resource(CORE_API_ACCOUNT)
+        account = core.add_resource(CORE_API_ACCOUNT)
+        account.add_resource(CORE_API_BULK)
 
         return api_gw
 
@@ -282,7 +350,7 @@ class AccountDeprovisioningCoreStack(PLNUStack):
     def api_gw_lambda_integration(self, insert_lambda: _lambda.Function, delete_lambda: _lambda.Function,
                                   api_gw: apigw.RestApi):
         """
-        Configures API Gateway integration with lambda functions for insert and delete operations
+        Configures API Gateway integration with lambda functions for insert, bulk insert and delete operations
 
         :param _lambda.Function insert_lambda: Lambda function for data insertion
         :param _lambda.Function delete_lambda: Lambda function for data deletion
@@ -310,6 +378,37 @@ class AccountDeprovisioningCoreStack(PLNUStack):
             ]
         )
 
+        # Bulk inserts take a JSON array of records, or NDJSON which is passed to the lambda base64 encoded
+        bulk_insert_integration = apigw.LambdaIntegration(
+            insert_lambda,
+            proxy=False,
+            timeout=Duration.seconds(29),
+            passthrough_behavior=apigw.PassthroughBehavior.WHEN_NO_MATCH,
+            request_templates={
+                "application/x-ndjson": '{"ndjson_base64": "$util.base64Encode($input.body)"}'
+            },
+            # Records are written by the time the lambda returns, their step schedules are created afterwards. Lambda
+            # errors carry an error message, which successful responses don't
+            integration_responses=[
+                apigw.IntegrationResponse(status_code="202"),
+                apigw.IntegrationResponse(
+                    status_code="500",
+                    selection_pattern=".+",
+                    response_templates={"application/json": '{"message": "Bulk insert failed, please retry"}'}
+                )
+            ]
+        )
+
+        api_account_resource.get_resource(CORE_API_BULK).add_method(
+            "POST",
+            bulk_insert_integration,
+            api_key_required=True,
+            method_responses=[
+                apigw.MethodResponse(status_code="202"),
+                apigw.MethodResponse(status_code="500")
+            ]
+        )
+
         delete_record_integration = apigw.LambdaIntegration(
             delete_lambda,
             proxy=False,
@@ -349,6 +448,38 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
         return failure_topic
 
+    def build_failure_state_queue(self, queue_name: str, function: _lambda.Function, allowlist: list[str]):
+        """
+        Builds an SQS queue subscribed to the failure topic that feeds failure notifications to a Lambda function in
+        batches. Messages the function can't apply are retried, then moved to a dead letter queue.
+
+        :param str queue_name: Name of the queue
+        :param function: Lambda function consuming the queue
+        :param allowlist: Failure types delivered to the queue
+
+        :return: The configured SQS queue
+        """
+        dead_letter_queue = sqs.Queue(self, f"{queue_name}_dlq", retention_period=Duration.days(14))
+
+        queue = sqs.Queue(self, queue_name,
+                          visibility_timeout=Duration.seconds(360),
+                          dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dead_letter_queue))
+
+        self.failure_topic.add_subscription(sns_sub.SqsSubscription(
+            queue,
+            raw_message_delivery=True,
+            filter_policy={"failure_type": sns.SubscriptionFilter.string_filter(allowlist=allowlist)}
+        ))
+
+        function.add_event_source(lambda_event_sources.SqsEventSource(
+            queue,
+            batch_size=100,
+            max_batching_window=Duration.seconds(5),
+            report_batch_item_failures=True
+        ))
+
+        return queue
+
     def grant_lambda_ses_access(self, function: _lambda.Function):
         """
         Handles security policy changes to allow a lambda to send email via SES
@@ -364,25 +495,89 @@ class AccountDeprovisioningCoreStack(PLNUStack):
 
     def build_process_cron_rule(self) -> events.Rule:
         """
-        Builds an EventBridge rule for scheduling getting records eligible for processing,
-        with the schedule depending on if it's deployed to prod or somewhere else
+        Builds an EventBridge rule for the nightly reconciliation run getting records eligible for processing.
+        Users are triggered by their own one-time schedule when their step is due (see build_step_schedules), this
+        run only picks up users overdue since before today, whose schedule couldn't be created or didn't fire
         :return events.Rule: Rule object to be used to tie eventbridge schedule to a lambda execution.
         """
-        if self.cdk_env.get('environment') == 'production':
-            schedule = events.Schedule.cron(minute='0/15')
-        else:
-            schedule = events.Schedule.cron(minute='0', hour='0')
-            # schedule = events.Schedule.cron(minute='0/3')
+        schedule = events.Schedule.cron(minute='0', hour='0')
         return events.Rule(self, "get_records_rule", schedule=schedule)
 
+    def build_step_schedules(self, function: _lambda.Function) -> dict:
+        """
+        Builds the EventBridge Scheduler group holding one-time schedules that trigger a lambda for a single user once
+        their step is due, and the role the schedules invoke the lambda with
+
+        :param aws_cdk.aws_lambda.Function function: Lambda function triggered by the schedules
+        :return dict: Environment variables scheduling lambdas need
+        """
+        group = scheduler.CfnScheduleGroup(self, "step_schedule_group", name="deprov_step_schedules")
+
+        role = iam.Role(self, "step_schedule_role", assumed_by=iam.ServicePrincipal("scheduler.amazonaws.com"))
+        function.grant_invoke(role)
+
+        return {'step_schedule_group': group.name,
+                'step_schedule_target_arn': function.function_arn,
+                'step_schedule_role_arn': role.role_arn}
+
+    def build_step_schedule_queue(self, function: _lambda.Function) -> sqs.Queue:
+        """
+        Builds the SQS queue feeding users to schedule to a Lambda function in batches. Unreadable messages are
+        retried, then moved to a dead letter queue.
+
+        :param aws_cdk.aws_lambda.Function function: Lambda function creating the schedules
+        :return sqs.Queue: The configured SQS queue
+        """
+        dead_letter_queue = sqs.Queue(self, "step_schedule_queue_dlq", retention_period=Duration.days(14))
+
+        queue = sqs.Queue(self, "step_schedule_queue",
+                          visibility_timeout=Duration.seconds(360),
+                          dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dead_letter_queue))
+
+        function.add_event_source(lambda_event_sources.SqsEventSource(
+            queue,
+            batch_size=10,
+            report_batch_item_failures=True
+        ))
+
+        return queue
+
+    def grant_step_scheduling(self, function: _lambda.Function, step_schedule_env: dict):
+        """
+        Allows a lambda to create one-time step schedules in the step schedule group
+
+        :param aws_cdk.aws_lambda.Function function: Lambda function to grant access to
+        :param dict step_schedule_env: Environment returned by build_step_schedules
+        """
+        function.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["scheduler:CreateSchedule"],
+                resources=[f"arn:aws:scheduler:{self.region}:{self.account}:schedule/"
+                           f"{step_schedule_env['step_schedule_group']}/*"]
+            )
+        )
+        function.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["iam:PassRole"],
+                resources=[step_schedule_env['step_schedule_role_arn']]
+            )
+        )
+
     def build_retry_cron_rule(self) -> events.Rule:
         """
         Builds and EventBridge rule for scheduling getting records that have lambdas in a retry state,
-        with the schedule depending on if it's deployed to prod or somewhere else
+        with the schedule depending on if it's deployed to prod or somewhere else.
+        Each failed lambda has its own retry time with exponential backoff, so in prod the rule polls
+        retry_due-index every minute for retries that have come due, which is a cheap query when none have. While
+        legacy failures are scanned for, which reads every failed user, it keeps running hourly
         :return events.Rule: Rule object to be used to tie eventbridge schedule to lambda execution
         """
 
-        if self.cdk_env.get('environment') == 'production':
+        if self.cdk_env.get('environment') == 'production' and not self.scan_legacy_failures:
+            schedule = events.Schedule.rate(Duration.minutes(1))
+        elif self.cdk_env.get('environment') == 'production':
             schedule = events.Schedule.cron(minute='0')
         else:
             schedule = events.Schedule.cron(minute='0', hour='0')
@@ -0,0 +1,25 @@
+import os
+
+from aws_cdk import Stack, aws_lambda as _lambda
+
+LAYER_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "src", "layers", "deprov_common")
+
+
+def shared_layer_init(stack: Stack):
+    """
+    Instantiate the `deprov_common` Lambda layer with the provided stack. The layer holds modules shared between
+    lambdas that are owned by this repository rather than `acct_decom_utils`.
+
+    :param stack: The AWS CDK stack in which to create the layer.
+    :type stack: aws_cdk.Stack
+
+    :return: An instance of the created Lambda layer.
+    :rtype: aws_lambda.LayerVersion
+    """
+
+    return _lambda.LayerVersion(
+        stack,
+        "deprov_common_layer",
+        code=_lambda.Code.from_asset(LAYER_PATH),
+        description="Modules shared across account deprovisioning lambdas"
+    )
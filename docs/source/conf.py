@@ -12,6 +12,7 @@ import sys
 autodoc_mock_imports = ["boto3"]
 
 sys.path.insert(0, os.path.abspath("../../"))
+sys.path.insert(0, os.path.abspath("../../src/layers/deprov_common/python"))
 print("sys.path: ", sys.path)
 
 project = 'Account Deprovisioning'
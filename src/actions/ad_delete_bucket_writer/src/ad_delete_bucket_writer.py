@@ -1,12 +1,15 @@
 import csv
+import io
 import json
 import os
+import uuid
+from typing import Dict, List
 
 import boto3
 from botocore.exceptions import ClientError
 
 from acct_decom_utils.plnu_logger import plnu_logger
-from datetime import datetime
+from datetime import datetime, timedelta
 
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
@@ -15,7 +18,6 @@ logger = plnu_logger.PLNULogger(log_level).get_logger()
 lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
-queue_url = os.getenv('queue_url')
 bucket_name = os.getenv('bucket_name')
 deploy_environment = os.getenv('deploy_environment')
 TIMESTAMP_STR_FORMAT = "%Y-%m-%dT%H-%M"
@@ -24,89 +26,169 @@ env = 'Dev'
 if deploy_environment == 'production':
     env = 'Prod'
 
+FIELDNAMES = ['action', 'username']
+OUTPUT_PREFIX = f"IAM/iam2ad/{env}/"
+
+# Minutes of batches combined into one file, 0 writes a file per batch. Batches are staged outside of the output
+# prefix until their window is compacted
+ACCUMULATE_WINDOW_MINUTES = int(os.getenv('accumulate_window_minutes', 0))
+STAGING_PREFIX = f"IAM/iam2ad_staging/{env}/"
+
+# Errors of a create-only put whose object exists, or is being created by another request
+OBJECT_EXISTS_ERRORS = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
 # BOTO3 Clients
 s3 = boto3.client('s3')
-sqs = boto3.client('sqs')
 
 
 def lambda_handler(event, context):
     """
     ad_delete_bucket_writer lambda handler.
 
-    Accumulates content of each record and updates S3 file by adding to it or creating a new one if it doesn't exist.
+    Reads a batch from the "ad_delete" queue and reports messages it couldn't read as batch item failures. Writes the
+    content of each record as a CSV row, encoded in memory and uploaded straight to S3. With
+    `accumulate_window_minutes` set, each batch is staged and the batches of a window are compacted into a single file
+    once the window has closed. Compaction is left to scheduled invocations, which carry no records, so it never runs
+    twice at once while batches are written concurrently.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    date_str = datetime.now().strftime(TIMESTAMP_STR_FORMAT)
-    csv_file_name = f'iam2ad{date_str}.csv'
-    csv_file_path = f'/tmp/{csv_file_name}'
+    now = datetime.now()
 
     try:
-        logger.info("Creating file..")
-        with open(csv_file_path, 'w', newline='') as csvfile:
-            fieldnames = ['action', 'username']
-            writer = csv.DictWriter(csvfile, fieldnames)
-            writer.writeheader()
-
-            sqs_messages_to_delete = []
-            for record in event['Records']:
+        if not event.get('Records'):
+            if ACCUMULATE_WINDOW_MINUTES:
+                # Batches of the window that just closed may still be in flight, so it is compacted by the next run
+                compact_closed_windows(window_start(now - timedelta(minutes=ACCUMULATE_WINDOW_MINUTES)))
+            return
+
+        rows = []
+        failed_ids = []
+        failed_groups = set()
+        for record in event['Records']:
+            # FIFO order: once a message of a group fails, the rest of the group is returned to the queue as well
+            group = record.get('attributes', {}).get('MessageGroupId')
+            if group in failed_groups:
+                failed_ids.append(record['messageId'])
+                continue
+            try:
                 body = json.loads(record['body'])
-                writer.writerow({
+                rows.append({
                     'action': body['action'],
                     'username': body['username']
                 })
-                logger.info("Creating file..")
-                sqs_messages_to_delete.append({
-                    'Id': record['messageId'],
-                    'ReceiptHandle': record['receiptHandle']
-                })
-        logger.info("Successfully created file.")
-
-        object_key = f"IAM/iam2ad/{env}/{csv_file_name}"
-        upload_to_s3(f'/tmp/{csv_file_name}', bucket_name, object_key)
-        sqs_msg_cleanup(queue_url, sqs_messages_to_delete)
+            except (ValueError, KeyError) as e:
+                logger.error(f"Invalid message {record['messageId']}: {e}")
+                failed_ids.append(record['messageId'])
+                failed_groups.add(group)
+
+        if rows:
+            if ACCUMULATE_WINDOW_MINUTES:
+                window = window_start(now).strftime(TIMESTAMP_STR_FORMAT)
+                object_key = f"{STAGING_PREFIX}{window}/{now.strftime('%Y-%m-%dT%H-%M-%S-%f')}-{uuid.uuid4().hex}.csv"
+            else:
+                # Batches are written concurrently, so every one gets its own file even within the same minute
+                object_key = f"{OUTPUT_PREFIX}iam2ad{now.strftime(TIMESTAMP_STR_FORMAT)}-{uuid.uuid4().hex}.csv"
+
+            upload_to_s3(encode_csv(rows), bucket_name, object_key)
     except Exception as e:
         logger.error(f"Failed to write to CSV file: {e}")
         raise
 
+    # Successful messages are deleted by the event source, failed ones are redelivered
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]}
+
 
-def upload_to_s3(file_name, bucket_name, object_key):
+def encode_csv(rows: List[dict], header: bool = True) -> bytes:
     """
-    Uploads a file to S3.
+    Encodes rows as CSV in memory
 
-    :param file_name: The path to the file to upload.
-    :param bucket_name: The name of the S3 bucket.
-    :param object_key: The object key for the file in S3.
+    :param rows: Rows with an `action` and a `username`
+    :param bool header: Whether to start with the header row
+
+    :return: The encoded CSV
+    :rtype: bytes
     """
-    try:
-        logger.info("Uploading file..")
-        s3.upload_file(Filename=file_name, Bucket=bucket_name, Key=object_key)
-        logger.info(f"File uploaded: s3://{bucket_name}/{object_key}")
-    except ClientError as e:
-        logger.error(f"Failed to upload file to S3: {e}")
-        raise
+    buffer = io.StringIO(newline='')
+    writer = csv.DictWriter(buffer, FIELDNAMES)
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
 
+def window_start(when: datetime) -> datetime:
+    """
+    :param datetime when: Any time
 
-def sqs_msg_cleanup(url, sqs_msgs):
+    :return: Start of the accumulation window `when` falls in
+    :rtype: datetime
     """
-    Deletes specified messages from an SQS queue
+    minutes = (when.hour * 60 + when.minute) // ACCUMULATE_WINDOW_MINUTES * ACCUMULATE_WINDOW_MINUTES
+    return when.replace(hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0)
+
 
-    :param url: The URL of the SQS queue
-    :param sqs_msgs: A list of dictionaries representing SQS messages to be deleted
+def compact_closed_windows(current_window: datetime):
+    """
+    Combines the staged batches of every window before `current_window` into one `iam2ad<window>.csv`, then removes
+    them. The file is only created if it doesn't exist yet, so a batch staged after its window was compacted goes to a
+    separate file, rather than replacing the first one.
+
+    :param datetime current_window: Start of the earliest window that isn't compacted yet
+    """
+    current = current_window.strftime(TIMESTAMP_STR_FORMAT)
+    staged: Dict[str, List[str]] = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=STAGING_PREFIX):
+        for obj in page.get('Contents', []):
+            window = obj['Key'][len(STAGING_PREFIX):].split('/', 1)[0]
+            if window < current:
+                staged.setdefault(window, []).append(obj['Key'])
+
+    for window, keys in sorted(staged.items()):
+        keys.sort()
+        rows = []
+        for key in keys:
+            content = s3.get_object(Bucket=bucket_name, Key=key)['Body'].read().decode('utf-8')
+            rows.extend(csv.DictReader(io.StringIO(content)))
+
+        content = encode_csv(rows)
+        try:
+            upload_to_s3(content, bucket_name, f"{OUTPUT_PREFIX}iam2ad{window}.csv", create_only=True)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in OBJECT_EXISTS_ERRORS:
+                raise
+            # The window was already compacted, or is being compacted right now
+            upload_to_s3(content, bucket_name, f"{OUTPUT_PREFIX}iam2ad{window}-{uuid.uuid4().hex}.csv")
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            s3.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]],
+                'Quiet': True
+            })
+        logger.info(f"Compacted {len(keys)} batches of {len(rows)} rows for window {window}")
+
+
+def upload_to_s3(content: bytes, bucket_name, object_key, create_only: bool = False):
     """
+    Uploads content to S3.
 
+    :param bytes content: The content to upload.
+    :param bucket_name: The name of the S3 bucket.
+    :param object_key: The object key for the file in S3.
+    :param bool create_only: Fail with `PreconditionFailed` instead of replacing an existing object.
+    """
+    put_args = {'Body': content, 'Bucket': bucket_name, 'Key': object_key, 'ContentType': 'text/csv'}
+    if create_only:
+        put_args['IfNoneMatch'] = '*'
     try:
-        logger.info("Attempting sqs cleanup..")
-        response = sqs.delete_message_batch(
-            QueueUrl=url,
-            Entries=sqs_msgs
-        )
-        failed = response.get('Failed', [])
-        if failed:
-            logger.error(f"Some messages failed to delete: {failed}")
-        else:
-            logger.info("Success.")
-    except boto3.exceptions.ClientError as e:
-        logger.error(f'Error deleting SQS messages: {e}')
+        logger.info("Uploading file..")
+        s3.put_object(**put_args)
+        logger.info(f"File uploaded: s3://{bucket_name}/{object_key}")
+    except ClientError as e:
+        if not (create_only and e.response['Error']['Code'] in OBJECT_EXISTS_ERRORS):
+            logger.error(f"Failed to upload file to S3: {e}")
         raise
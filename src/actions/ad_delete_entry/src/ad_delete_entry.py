@@ -5,7 +5,8 @@ from botocore.exceptions import ClientError
 from acct_decom_utils.plnu_logger import plnu_logger
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
 from acct_decom_utils.exceptions.exceptions import AcctDeprovException, RetryException
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.sns_publisher import sns_publisher
 from acct_decom_utils.event_table import event_table
 
 log_level = os.getenv('log_level', 'INFO')
@@ -23,20 +24,61 @@ if env == 'production':
 lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
+# Users handled by one execution, so the AD delete handler sends their messages together. Executions also take at
+# most 256 KiB of input
+RECORDS_PER_EXECUTION = int(os.getenv('records_per_execution', 100))
+MAX_INPUT_BYTES = 200 * 1024
+
 sfn = boto3.client('stepfunctions')
 
 
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     ad_delete_entry lambda handler
 
     Processes SNS messages, extracts records, and initiates the execution of an AWS Step Functions state machine for
-    each record.
+    up to `records_per_execution` records at a time. Records of an execution that can't be started are started one by
+    one instead, so each of them is retried on its own.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
     records = json.loads(event['Records'][0]['Sns']['Message'])
+    for start in range(0, len(records), RECORDS_PER_EXECUTION):
+        for chunk in sns_publisher.pack_records(records[start:start + RECORDS_PER_EXECUTION], MAX_INPUT_BYTES):
+            try:
+                start_batch_execution(chunk)
+            except ClientError as e:
+                logger.error(f"Step Function execution failed for {len(chunk)} records, starting them one by one: "
+                             f"{e.response['Error']['Message']}")
+                start_executions(chunk)
+
+
+def start_batch_execution(records):
+    """
+    Starts one execution of the state machine for several records, and reports each of them as a success
+
+    :param records: The input records to be processed by the Step Functions state machine
+    """
+    input_dict = {'records': records, 'action': 'suspend', 'waitSeconds': wait}
+    response = sfn.start_execution(
+        stateMachineArn=state_machine_arn,
+        input=json.dumps(input_dict)
+    )
+    logger.info(f'Step Function started successfully for {len(records)} records: {response}')
+
+    for record in records:
+        event_record = json.loads(json.dumps(record), cls=event_table.EventTableRecordDecoder)
+        outcome_publisher.handle_success(event_record, lambda_name, sns_arn)
+
+
+def start_executions(records):
+    """
+    Starts one execution per record, as executions were started before they carried several records
+
+    :param records: The input records to be processed by the Step Functions state machine
+    """
     for record in records:
         try:
             start_sfn_execution(record)
@@ -62,7 +104,7 @@ def start_sfn_execution(record):
 
         json_data = json.dumps(record)
         event_record = json.loads(json_data, cls=event_table.EventTableRecordDecoder)
-        handle_success(event_record, lambda_name, sns_arn)
+        outcome_publisher.handle_success(event_record, lambda_name, sns_arn)
     except ClientError as e:
         logger.error(f"Something went wrong. Error: {e.response['Error']['Message']}")
         raise RetryException(str(e), record)
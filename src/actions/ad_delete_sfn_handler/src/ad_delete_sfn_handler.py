@@ -1,9 +1,12 @@
 import os
+import hashlib
+import zlib
 import boto3
 import json
 
 from botocore.exceptions import ClientError
 from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.event_index import event_index
 
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
@@ -16,117 +19,158 @@ bucket_arn = os.getenv('bucket_arn')
 bucket_name = os.getenv('bucket_name')
 queue_url = os.getenv('queue_url')
 
+# Message groups the FIFO queue is spread over. A user's suspend and delete share a group, so they stay in order,
+# while different users are consumed in parallel
+MESSAGE_GROUP_SHARDS = int(os.getenv('message_group_shards', 16))
+
+# SendMessageBatch accepts at most 10 entries per call
+SEND_BATCH_SIZE = 10
+
 # BOTO3 Clients
 sqs = boto3.client('sqs')
-ddb = boto3.client('dynamodb')
 
 
 def lambda_handler(event, context):
     """
     `ad_delete_sfn_handler` lambda handler.
 
-    Extracts record information and sends the user's details, along with specified "suspend" or delete" actions,
-    to the "ad_delete" SQS queue
+    Extracts record information and sends the users' details, along with specified "suspend" or delete" actions,
+    to the "ad_delete" SQS queue, up to 10 users per call. Executions carry a list of `records`, executions started
+    before that carry a single `record` and get the same shape back.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    record = event['record']
+    records = event['records'] if 'records' in event else [event['record']]
     action = event['action']
     wait = event['waitSeconds']
 
     if action == 'suspend':
-        process_suspend(record, action, queue_url, lambda_name)
+        process_suspend(records, action, queue_url)
         action = 'delete'
     else:
-        process_delete(record, action, queue_url, lambda_name)
+        process_delete(records, action, queue_url)
         action = 'end'
 
-    return {'record': record, 'action': action, 'waitSeconds': wait}
+    if 'records' in event:
+        return {'records': records, 'action': action, 'waitSeconds': wait}
+    return {'record': records[0], 'action': action, 'waitSeconds': wait}
+
 
+def get_message_group_id(username: str) -> str:
+    """
+    :param str username: User the message is about
 
-def process_suspend(record, action, url, message_group_id):
+    :return: The user's message group, stable across invocations
+    :rtype: str
     """
-    Handles the suspend action by sending the record to the SQS queue.
+    return f"{lambda_name}-{zlib.crc32(username.encode('utf-8')) % MESSAGE_GROUP_SHARDS}"
+
 
+def build_message(record, action) -> dict:
+    """
     :param record: The record to be processed.
     :param action: The action to take.
-    :param url: The URL of the SQS queue.
-    :param message_group_id: The message group ID for FIFO queues.
-    """
-    logger.info(f"Processing suspend for {record.get('username')}")
 
-    message_body = {
+    :return: Message body for the "ad_delete" queue
+    :rtype: dict
+    """
+    return {
         "action": action,
         "id": record.get('universal_id'),
         "username": record.get('username'),
         "account_type": record.get('account_type')
     }
 
-    send_to_sqs(url, message_body, message_group_id)
 
+def process_suspend(records, action, url):
+    """
+    Handles the suspend action by sending the records to the SQS queue.
 
-def process_delete(record, action, url, message_group_id):
+    :param records: The records to be processed.
+    :param action: The action to take.
+    :param url: The URL of the SQS queue.
     """
-    Handles the delete action by checking the record's status in DynamoDB.
+    logger.info(f"Processing suspend for {[record.get('username') for record in records]}")
 
-    :param record: The record to be processed.
+    send_to_sqs(url, [build_message(record, action) for record in records])
+
+
+def process_delete(records, action, url):
+    """
+    Handles the delete action by checking that the records are still in DynamoDB, looked up together.
+
+    :param records: The records to be processed.
     :param action: The action to take.
     :param url: The URL of the SQS queue.
-    :param message_group_id: The message group ID for FIFO queues.
     """
-    record_username = record.get('username')
-    logger.info(f"Processing delete for {record_username}")
-
-    ddb_item = query_dynamodb(record_username)
-
-    if ddb_item:
-        ddb_username = ddb_item['username']['S']
-        if ddb_username == record_username:
-            message_body = {
-                "action": action,
-                "id": record.get('universal_id'),
-                "username": record_username,
-                "account_type": record.get('account_type'),
-            }
-            send_to_sqs(url, message_body, message_group_id)
-    else:
-        logger.warn(f"User {record_username} not in DynamoDB. Assuming user is rehired. Moving on.")
+    usernames = [record.get('username') for record in records]
+    logger.info(f"Processing delete for {usernames}")
 
+    existing = query_dynamodb(usernames)
 
-def query_dynamodb(username):
+    messages = []
+    for record in records:
+        if record.get('username') in existing:
+            messages.append(build_message(record, action))
+        else:
+            logger.warn(f"User {record.get('username')} not in DynamoDB. Assuming user is rehired. Moving on.")
+
+    send_to_sqs(url, messages)
+
+
+def query_dynamodb(usernames):
     """
-    Queries the DynamoDB table for the given username.
+    Looks the given usernames up in the DynamoDB table with BatchGetItem.
 
-    :param username: The username to query.
-    :return: The DynamoDB item or None if not found.
+    :param usernames: The usernames to query.
+    :return: The usernames that were found.
     """
+    existing = set()
+    unique = list(dict.fromkeys(usernames))
     try:
-        response = ddb.get_item(
-            TableName='EventState',
-            Key={'username': {'S': username}},
-        )
-        return response.get('Item')
-    except boto3.exceptions.Boto3Error as e:
-        logger.error(f'Failed to query DynamoDB for username {username}: {e}')
+        for start in range(0, len(unique), event_index.BATCH_GET_SIZE):
+            keys = [{'username': {'S': username}} for username in unique[start:start + event_index.BATCH_GET_SIZE]]
+            existing.update(record.username for record in event_index.get_records(keys))
+    except (ClientError, RuntimeError) as e:
+        logger.error(f'Failed to query DynamoDB for usernames {usernames}: {e}')
         raise e
+    return existing
 
 
-def send_to_sqs(queueurl, message_body, message_group_id):
+def send_to_sqs(queueurl, message_bodies, max_attempts=3):
     """
-    Sends a message to the SQS queue.
+    Sends messages to the SQS queue with SendMessageBatch, 10 per call. Each message is deduplicated on its action and
+    user, and entries SQS rejects are sent again.
 
     :param queueurl: The URL of the SQS queue.
-    :param message_body: The content of the message to be sent.
-    :param message_group_id: The message group ID for FIFO queues.
+    :param message_bodies: The contents of the messages to be sent.
+    :param max_attempts: Attempts made for each entry.
     """
-    try:
-        sqs.send_message(
-            QueueUrl=queueurl,
-            MessageBody=json.dumps(message_body),
-            MessageGroupId=message_group_id
-        )
-        logger.info(f"Message successfully sent to SQS: {message_body}")
-    except ClientError as e:
-        logger.error(f"Something went wrong: {e.response['Error']['Message']}")
-        raise e
+    for start in range(0, len(message_bodies), SEND_BATCH_SIZE):
+        entries = [{
+            'Id': str(index),
+            'MessageBody': json.dumps(message_body),
+            'MessageGroupId': get_message_group_id(message_body['username']),
+            'MessageDeduplicationId': hashlib.sha256(
+                f"{message_body['action']}#{message_body['username']}".encode('utf-8')).hexdigest()
+        } for index, message_body in enumerate(message_bodies[start:start + SEND_BATCH_SIZE])]
+
+        for attempt in range(1, max_attempts + 1):
+            try:
+                response = sqs.send_message_batch(QueueUrl=queueurl, Entries=entries)
+            except ClientError as e:
+                logger.error(f"Something went wrong: {e.response['Error']['Message']}")
+                raise e
+
+            failed_ids = {failure['Id'] for failure in response.get('Failed', [])}
+            entries = [entry for entry in entries if entry['Id'] in failed_ids]
+            if not entries:
+                break
+            logger.warning(f"SQS rejected {len(entries)} messages: {response['Failed']}")
+
+        if entries:
+            raise RuntimeError(f"Failed to send {len(entries)} messages to SQS after {max_attempts} attempts")
+
+        sent = min(start + SEND_BATCH_SIZE, len(message_bodies))
+        logger.info(f"{sent} of {len(message_bodies)} messages sent to SQS")
@@ -6,13 +6,18 @@ from typing import List
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.exceptions.exceptions import RetryException
 import boto3
+import threading
 
 from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.record_executor import record_executor
+from deprov_common.deadline import deadline
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 
 
 secret_id = 'account_deprovisioning_canvas'
+_canvas_lock = threading.Lock()
 
 # Values for passing into deporvisioning function decorator
 lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
@@ -33,7 +38,13 @@ class CanvasService:
         return cls.__instance
 
     def __init__(self):
+        # Records are processed concurrently, only the first caller loads the secret and builds the client
+        with _canvas_lock:
+            if self.service is not None:
+                return
+            self._load()
 
+    def _load(self):
         sm = boto3.client('secretsmanager')
         secret = sm.get_secret_value(SecretId=secret_id)
         secret_val = json.loads(secret['SecretString'])
@@ -46,32 +57,47 @@ class CanvasService:
         return self.service
 
 
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `force_logout_canvas` lambda handler.
 
-    Retrieves the specified user and forcefully logs them out.
+    Retrieves the specified users and forcefully logs them out, processing several users at once.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
 
-    records: List[event_table.EventTableRecord] = json.loads(event.get('Records')[0].get('Sns').get('Message'),
-                                                             cls=event_table.EventTableRecordDecoder)
-    for user_to_process in records:
-
-        uid = user_to_process.universal_id
-        acct_type = user_to_process.account_type
-        if acct_type == 'employee':
-            sis_id = f"UE{uid}"
-        else:
-            sis_id = f"US{uid}"
-        try:
-            terminate_canvas_session(sis_id, user_to_process)
-        except Exception as e:
-            logger.info(f"Something went wrong while terminiating Canvas session. {e}")
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
+    deferred = []
+    outcomes = record_executor.process_records(records, process_record, deadline=deadline.Deadline(context))
+    for outcome in outcomes:
+        if outcome.deferred:
+            deferred.append(outcome.record)
+            continue
+        if not outcome.ok:
+            logger.info(f"Something went wrong while terminiating Canvas session. {outcome.error}")
             continue
-        handle_success(user_to_process, lambda_name, sns_arn)
+        outcome_publisher.handle_success(outcome.record, lambda_name, sns_arn)
+
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
+
+
+def process_record(user_to_process: event_table.EventTableRecord):
+    """
+    Terminates the Canvas sessions of a single user
+
+    :param user_to_process: User's information
+    """
+    uid = user_to_process.universal_id
+    acct_type = user_to_process.account_type
+    if acct_type == 'employee':
+        sis_id = f"UE{uid}"
+    else:
+        sis_id = f"US{uid}"
+    terminate_canvas_session(sis_id, user_to_process)
 
 
 @deprovisioning_action(sns_arn, lambda_name)
@@ -1,4 +1,3 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 import os
@@ -6,10 +5,13 @@ import json
 
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import GoogleAcctDeprovException
+from deprov_common.google_services import google_services
+from deprov_common.google_batch import google_batch
+from deprov_common.deadline import deadline
 from typing import List
 
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.user',
@@ -28,81 +30,68 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
-class GoogleAdminService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleAdminService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-        self.service = build('admin', 'directory_v1', credentials=self.credentials)
-
-    def get_service(self):
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `force_logout_google` lambda handler.
 
-    Retrieves the specified user and logs them out.
+    Logs the specified users out. Sign outs are sent directly, as a batched request, without looking the users up
+    first; a user that doesn't exist has no session to end.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    records: List[event_table.EventTableRecord] = json.loads(
-        event.get('Records')[0].get('Sns').get('Message'),
-        cls=event_table.EventTableRecordDecoder)
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
 
-    admin_svc = GoogleAdminService()
-    service = admin_svc.get_service()
+    service = google_services.get_service('admin', 'directory_v1', SCOPES)
 
-    for record in records:
-        failure = False
-        try:
-            user = get_user(service, record)
-            logger.info(user)
-        # If user doesn't exist, skip it and continue to the next user
-        except Exception as e:
-            logger.warn(f"Response: {e}")
+    logouts = google_batch.execute_batch(service, [(record, build_logout(service, record)) for record in records],
+                                         deadline=deadline.Deadline(context))
+
+    deferred = []
+    for logout in logouts:
+        record = logout.key
+
+        if logout.deferred:
+            deferred.append(record)
+            continue
+
+        if logout.not_found:
             logger.info(f"Skipping: User {record.username} not found, no action required.")
+            outcome_publisher.handle_success(record, lambda_name, sns_arn)
             continue
+
         try:
-            response = user_logout(service, record)
-            logger.info(f"{record.username} has been successfully logged out. {response}")
+            user_logout(logout, record)
+            logger.info(f"{record.username} has been successfully logged out. {logout.response}")
         except Exception as e:
             logger.error(f"Google issue with {record.username} log out: {str(e)}")
-            failure = True
+            continue
+
+        outcome_publisher.handle_success(record, lambda_name, sns_arn)
 
-        if not failure:
-            handle_success(record, lambda_name, sns_arn)
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
 
-def get_user(service, record):
+def build_logout(service, record):
     """
-    Retrieves user information from a Google Admin SDK service based on the provided email
+    Builds the request signing a user out of all sessions using the provided Google Admin SDK service
 
-    :param service: Google Admin SDK service object used for interacting with user data
-    :param record: The user's record whose information is to be retrieved
+    :param service: The Google Admin SDK service object
+    :param record: User's record
     """
-    return service.users().get(userKey=f"{record.username}{domain}").execute()
+    return service.users().signOut(userKey=f"{record.username}{domain}")
 
 
 @deprovisioning_action(sns_arn, lambda_name)
-def user_logout(service, record):
+def user_logout(result: google_batch.BatchResult, record):
     """
-     Initiates a user logout using the provided Google Admin SDK service
+    Surfaces the failure, if any, of a user's batched logout so it is handled like any other failed action
 
-    :param service: The Google Admin SDK service object
-    :param record: A dictionary containing user information
+    :param result: Result of the user's sign out request
+    :param record: User's record
     """
-    email = f"{record.username}{domain}"
-    logger.info(f"Attempting {record.username} logout")
-    try:
-        return service.users().signOut(userKey=email).execute()
-    except HttpError as err:
-        raise GoogleAcctDeprovException(str(err), record, err.resp)
+    if not result.ok:
+        raise GoogleAcctDeprovException(str(result.error), record, result.error.resp)
@@ -1,13 +1,15 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import json
 import os
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
 from acct_decom_utils.exceptions.exceptions import GoogleAcctDeprovException, AcctDeprovException
+from deprov_common.google_services import google_services
+from deprov_common.google_batch import google_batch
+from deprov_common.deadline import deadline
 
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.user.security']
 
@@ -24,94 +26,117 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
-# This class is a singleton to ensure that we only have one instance of the Google admin service
-class GoogleAdminService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleAdminService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-        self.service = build('admin', 'directory_v1', credentials=self.credentials)
-
-    def get_service(self):
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `remove_asps` lambda handler.
 
-    Retrieves and removes a user's ASPs
+    Retrieves and removes users' ASPs. The listings of every user, and then every deletion, are sent as batched
+    requests.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    records = json.loads(event.get('Records')[0].get('Sns').get('Message'), cls=event_table.EventTableRecordDecoder)
-    admin_svc = GoogleAdminService()
-    service = admin_svc.get_service()
-
-    for user_to_process in records:
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
+    service = google_services.get_service('admin', 'directory_v1', SCOPES)
+
+    # Listings and deletions share the invocation's time, users whose calls weren't all sent are deferred as a whole
+    invocation_deadline = deadline.Deadline(context)
+    listings = google_batch.execute_batch(
+        service, [(record, get_user_asps(service, record.username + domain)) for record in records],
+        deadline=invocation_deadline)
+
+    to_process = []
+    deletions = []
+    deferred = []
+    for listing in listings:
+        user_to_process = listing.key
         username = user_to_process.username
         email = username + domain
 
-        failure = False
-        try:
-            asps = get_user_asps(service, email)
-            if asps is None or asps.get('items') is None:
-                logger.info(f"Skipping: No asp tokens associated with user {username}")
-                continue
-        except HttpError as e:
-            logger.warning(e)
+        if listing.deferred:
+            deferred.append(user_to_process)
+            continue
+
+        if not listing.ok:
+            logger.warning(listing.error)
             logger.info(f"Skipping: User {username} not found, no action required.")
             continue
+        asps = listing.response
+        if asps is None or asps.get('items') is None:
+            logger.info(f"Skipping: No asp tokens associated with user {username}")
+            continue
+
+        to_process.append(user_to_process)
         for asp in asps.get('items'):
+            code = asp.get('codeId')
+            deletions.append(((user_to_process, code), build_asp_removal(service, code, email)))
 
-            code = asp.get('clientId')
+    results = google_batch.execute_batch(service, deletions, deadline=invocation_deadline)
 
-            try:
-                remove_asp(user_to_process, service, code, email)
-            except Exception as e:
-                failure = True
-                logger.error(f"Failed to delete asp with clientId {code} from {username}: {e}")
+    failed = set()
+    unfinished = set()
+    for result in results:
+        user_to_process, code = result.key
+        if result.deferred:
+            unfinished.add(user_to_process.username)
+            continue
+        # Only the first failed deletion is reported, the record is retried as a whole
+        if result.ok or user_to_process.username in failed:
+            continue
+        failed.add(user_to_process.username)
+        try:
+            remove_asp(result, user_to_process, code, user_to_process.username + domain)
+        except Exception as e:
+            logger.error(f"Failed to delete asp with codeId {code} from {user_to_process.username}: {e}")
 
-        if not failure:
-            handle_success(user_to_process, lambda_name, sns_arn)
+    for user_to_process in to_process:
+        if user_to_process.username in failed:
+            continue
+        if user_to_process.username in unfinished:
+            deferred.append(user_to_process)
+            continue
+        outcome_publisher.handle_success(user_to_process, lambda_name, sns_arn)
 
-        logger.info("Successfully removed ASPs")
-    return {
-        'statusCode': 200,
-        'body': 'Success'
-    }
+    logger.info("Successfully removed ASPs")
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
 
 def get_user_asps(service, email):
     """
-    Retrieves user's ASPs
+    Builds the request retrieving user's ASPs
 
     :param service: The Google Admin SDK service object
     :param email: User's email address
     """
-    return service.asps().list(userKey=email).execute()
+    # ASPs are identified by their codeId, nothing else is needed from the listing
+    return service.asps().list(userKey=email, fields='items(codeId)')
+
+
+def build_asp_removal(service, code_id, email):
+    """
+    Builds the request removing one of the user's ASPs
+
+    :param service:  The Google Admin SDK service object
+    :param code_id: Authorized app's unique identifier
+    :param email: User's email address
+    """
+    return service.asps().delete(userKey=email, codeId=code_id)
 
 
 @deprovisioning_action(sns_arn, lambda_name)
-def remove_asp(record, service, code_id, email):
+def remove_asp(result: google_batch.BatchResult, record, code_id, email):
     """
-    Removes user's ASPs
+    Surfaces the failure, if any, of a batched ASP removal so it is handled like any other failed action
 
+    :param result: Result of the ASP removal request
     :param record: User's information
-    :param service:  The Google Admin SDK service object
     :param code_id: Authorized app's unique identifier
     :param email: User's email address
     """
-    try:
-        service.asps().delete(userKey=email, codeId=code_id).execute()
-    except HttpError as e:
-        msg = f"Failed to remove asp associated with codeId {code_id} for user {email}: {str(e)}"
+    if not result.ok:
+        msg = f"Failed to remove asp associated with codeId {code_id} for user {email}: {str(result.error)}"
         logger.error(msg)
-        raise GoogleAcctDeprovException(msg, record, e.resp)
+        raise GoogleAcctDeprovException(msg, record, result.error.resp)
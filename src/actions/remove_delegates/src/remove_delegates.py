@@ -1,16 +1,19 @@
 import acct_decom_utils.exceptions.exceptions
 import google.auth.exceptions
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import http.client
 import json
 import os
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import GoogleAcctDeprovException
+from deprov_common.google_services import google_services
+from deprov_common.google_batch import google_batch
+from deprov_common.record_executor import record_executor
+from deprov_common.deadline import deadline
 from typing import List
 import re
 
@@ -32,83 +35,82 @@ sns_arn = os.getenv('failure_topic_arn')
 remove_all_delegates_step = "emp-180"
 
 
-# This class is a singleton to ensure that we only have one instance of the google admin service
-class GoogleGMailService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleGMailService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-
-    def get_service(self, delegated_user):
-        self.service = build('gmail', 'v1', credentials=self.credentials.with_subject(delegated_user))
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `remove_delagates` lambda handler. Retrieves and removes user's delegates. Adds user's manager as a delegate
     """
-    records: List[event_table.EventTableRecord] = json.loads(
-        event.get('Records')[0].get('Sns').get('Message'),
-        cls=event_table.EventTableRecordDecoder)
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
+
+    deferred = []
+    outcomes = record_executor.process_records(records, process_record, deadline=deadline.Deadline(context))
+    for outcome in outcomes:
+        if outcome.deferred:
+            deferred.append(outcome.record)
+            continue
+        if not outcome.ok:
+            logger.error(f"Failed to process delegates for {outcome.record.username}: {str(outcome.error)}")
+            continue
 
-    gls = GoogleGMailService()
+        if outcome.result:
+            outcome_publisher.handle_success(outcome.record, lambda_name, sns_arn)
 
-    for record in records:
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
-        # Track if we've hit a failure scenario or not
-        failure = False
 
-        username = record.username
-        user_id = f"{username}{domain}"
-        mgr_email = record.mgr_email
-        service = gls.get_service(user_id)
+def process_record(record: event_table.EventTableRecord) -> bool:
+    """
+    Removes a single user's delegates and adds their manager as a delegate
 
-        logger.info(f"Processing delegate removal for {username}")
-        # Get list of delegates for user
-        try:
-            delegates_payload = get_delegates(record, service)
-            logger.info("Delegate data fetched.")
-        except Exception as e:
-            logger.error(f"Failed to get delegates for {user_id}: {str(e)}")
-            failure = True
-            continue
+    :param record: User's information
 
-        # User not being found is not an error condition, but there's nothing else to do
-        if delegates_payload is None:
-            handle_success(record, lambda_name, sns_arn)
-            continue
+    :return: True if every change was made, False if one failed and was reported
+    """
+    username = record.username
+    user_id = f"{username}{domain}"
+    mgr_email = record.mgr_email
+    service = google_services.get_service('gmail', 'v1', SCOPES, subject=user_id)
+
+    logger.info(f"Processing delegate removal for {username}")
+    # Get list of delegates for user
+    try:
+        delegates_payload = get_delegates(record, service)
+        logger.info("Delegate data fetched.")
+    except Exception as e:
+        logger.error(f"Failed to get delegates for {user_id}: {str(e)}")
+        return False
 
-        delegates = delegates_payload.get("delegates", [])
+    # User not being found is not an error condition, but there's nothing else to do
+    if delegates_payload is None:
+        return True
 
-        for delegate in delegates:
-            delegate_email = delegate.get("delegateEmail")
+    delegates = delegates_payload.get("delegates", [])
+    logger.info(f"Deleting {len(delegates)} delegates from {username}")
 
-            try:
-                delete_delegate(record, service, delegate_email)
-            except Exception as e:
-                # If deletion fails, lambda should be flagged for retry for user. Not going to continue on this user
-                logger.error(f"Failed to remove {delegate_email} from {user_id}: {str(e)}")
-                failure = True
-                break
+    # Every delegate of the user is removed in a single batched request
+    removals = google_batch.execute_batch(
+        service, [(delegate.get("delegateEmail"), build_delegate_removal(service, delegate.get("delegateEmail")))
+                  for delegate in delegates])
 
-        if mgr_email and record.next_step != remove_all_delegates_step:
+    for removal in removals:
+        try:
+            delete_delegate(removal, record, removal.key)
+        except Exception as e:
+            # If deletion fails, lambda should be flagged for retry for user. Not going to continue on this user
+            logger.error(f"Failed to remove {removal.key} from {user_id}: {str(e)}")
+            return False
 
-            try:
-                add_mgr_delegate(record, service)
-            except Exception as e:
-                logger.error(f"Failed to add {mgr_email} as delegate to {user_id}: {str(e)}")
-                failure = True
-                continue
+    if mgr_email and record.next_step != remove_all_delegates_step:
 
-        if not failure:
-            handle_success(record, lambda_name, sns_arn)
+        try:
+            add_mgr_delegate(record, service)
+        except Exception as e:
+            logger.error(f"Failed to add {mgr_email} as delegate to {user_id}: {str(e)}")
+            return False
+
+    return True
 
 
 class Response:
@@ -127,7 +129,7 @@ def get_delegates(record, service):
     """
     username = record.username
     try:
-        return service.users().settings().delegates().list(userId='me').execute()
+        return service.users().settings().delegates().list(userId='me', fields='delegates(delegateEmail)').execute()
     except HttpError as e:
         logger.error(f"Google issue getting delegate list from user: {str(e)}")
         raise GoogleAcctDeprovException(str(e), record, e.resp)
@@ -146,24 +148,29 @@ def get_delegates(record, service):
             raise e
 
 
+def build_delegate_removal(service, delegate_email):
+    """
+    Builds the request removing the specified delegate (which can be of any verification status), and revoking any
+    verification that may have been required for using it.
+
+    :param service: The Google GMail SDK service object
+    :param delegate_email: Email address of the delegate to remove
+    """
+    return service.users().settings().delegates().delete(userId='me', delegateEmail=delegate_email)
+
+
 @deprovisioning_action(sns_arn, lambda_name)
-def delete_delegate(record, service, delegate_email):
+def delete_delegate(result: google_batch.BatchResult, record, delegate_email):
     """
-    Removes the specified delegate (which can be of any verification status), and revokes any verification that may
-    have been required for using it.
+    Surfaces the failure, if any, of a batched delegate removal so it is handled like any other failed action
 
+    :param result: Result of the delegate removal request
     :param record: User's information
-    :param service: The Google GMail SDK service object
-    :param delegate_email:
+    :param delegate_email: Email address of the removed delegate
     """
-    username = record.username
-    logger.info(f"Deleting delegate {delegate_email} from {username}")
-    try:
-        service.users().settings().delegates().delete(userId='me', delegateEmail=delegate_email).execute()
-        logger.info("Success.")
-    except HttpError as e:
-        raise GoogleAcctDeprovException(str(e), record, e.resp)
-    logger.info(f"Successfully removed {delegate_email} from {username}")
+    if not result.ok:
+        raise GoogleAcctDeprovException(str(result.error), record, result.error.resp)
+    logger.info(f"Successfully removed {delegate_email} from {record.username}")
 
 
 @deprovisioning_action(sns_arn, lambda_name)
@@ -1,14 +1,16 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import json
 import os
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import (AcctDeprovException, GoogleAcctDeprovException,
                                                     GoogleRetryException, GoogleTerminalException)
+from deprov_common.google_services import google_services
+from deprov_common.record_executor import record_executor
+from deprov_common.deadline import deadline
 from typing import List
 
 PRODUCT_ID = "101031"
@@ -30,80 +32,39 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
-# This class is a singleton to ensure that we only have one instance of the google admin service.
-class GoogleLicenseService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleLicenseService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-        self.service = build('licensing', 'v1', credentials=self.credentials)
-
-    def get_service(self):
-        return self.service
-
-
-# This class is a singleton to ensure that we only have one instance of the google admin service
-class GoogleAdminService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleAdminService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-        self.service = build('admin', 'directory_v1', credentials=self.credentials)
-
-    def get_service(self):
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `remove_google_license` lambda_handler.
 
-    Revokes user's license
+    Revokes users' licenses, processing several users at once.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    gls = GoogleLicenseService()
-    gas = GoogleAdminService()
-    license_service = gls.get_service()
-    admin_service = gas.get_service()
-
-    records: List[event_table.EventTableRecord] = json.loads(
-        event.get('Records')[0].get('Sns').get('Message'),
-        cls=event_table.EventTableRecordDecoder)
-
-    for record in records:
-        failure = False
-        try:
-            process_user(record, license_service, admin_service, domain, EMP_SKU, STU_SKU)
-        except Exception as e:
-            logger.error(f"Failure in remove Google license workflow: {e}")
-            failure = True
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
+
+    # Services are cached per thread, so each worker fetches its own rather than sharing the handler's
+    def process(record):
+        return process_user(record, google_services.get_service('licensing', 'v1', SCOPES),
+                            google_services.get_service('admin', 'directory_v1', SCOPES), domain, EMP_SKU, STU_SKU)
+
+    deferred = []
+    outcomes = record_executor.process_records(records, process, deadline=deadline.Deadline(context))
+    for outcome in outcomes:
+        if outcome.deferred:
+            deferred.append(outcome.record)
+            continue
+        if not outcome.ok:
+            logger.error(f"Failure in remove Google license workflow: {outcome.error}")
             continue
 
-        if not failure:
-            handle_success(record, lambda_name, sns_arn)
+        if outcome.result:
+            outcome_publisher.handle_success(outcome.record, lambda_name, sns_arn)
 
-
-def get_user(admin_service, user_id, record):
-    try:
-        user = admin_service.users().get(userKey=user_id).execute()
-        return user
-    except HttpError as e:
-        logger.info(f"User {user_id} not found")
-        return None
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
 
 @deprovisioning_action(sns_arn, lambda_name)
@@ -132,17 +93,35 @@ def remove_user_license(license_service, user_id, sku, record):
 
 @deprovisioning_action(sns_arn, lambda_name)
 def move_user_to_org(admin_service, user_id, org_path, record):
+    """
+    Moves the user to the given org unit. The update is sent without looking the user up first, so a missing user is
+    reported through the return value rather than as an error.
+
+    :param admin_service: The Google Admin SDK service object
+    :param user_id: The user's current primary email address
+    :param org_path: Full path of the org unit to move the user to
+    :param record: User's information
+
+    :return: False if the user doesn't exist, True once the user has been moved
+    """
     try:
-        admin_service.users().update(userKey=user_id, body={"orgUnitPath": org_path}).execute()
+        admin_service.users().update(userKey=user_id, body={"orgUnitPath": org_path}, fields='orgUnitPath').execute()
         logger.info(f"Moved user {user_id} to org unit {org_path}")
         return True
     except HttpError as e:
+        if e.resp.status == 404:
+            return False
         logger.error(f"Error moving user {user_id} to {org_path}: {e}")
         raise GoogleAcctDeprovException(e.reason, record, e.resp)
 
 
 @deprovisioning_action(sns_arn, lambda_name)
 def process_user(record, license_service, admin_service, domain, emp_sku, stu_sku):
+    """
+    Moves the user to the former employees org unit and revokes their license
+
+    :return: True if the user's license is gone or the user doesn't exist, False if a change failed and was reported
+    """
     sku = ""
     user_id = f"{record.username}{domain}"
     if record.account_type == "employee":
@@ -152,17 +131,17 @@ def process_user(record, license_service, admin_service, domain, emp_sku, stu_sk
     former_employee_org_path = '/Former Employees'
 
     try:
-        # check if user exists
-        user = get_user(admin_service, user_id, record)
-        if not user:
+        # move user to inactive employee org, which also tells us whether the user exists
+        moved = move_user_to_org(admin_service, user_id, former_employee_org_path, record)
+        if moved is False:
             logger.info(f"User {user_id} not found. Not an error. Skipping.")
             return True
-
-        # move user to inactive employee org
-        move_user_to_org(admin_service, user_id, former_employee_org_path, record)
+        if not moved:
+            # The move failed and was reported by its decorator
+            return False
 
         # remove user license
-        remove_user_license(license_service, user_id, sku, record)
-        return True
+        return bool(remove_user_license(license_service, user_id, sku, record))
     except Exception as e:
         logger.error(e)
+        return False
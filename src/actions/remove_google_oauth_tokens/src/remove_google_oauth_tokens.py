@@ -1,13 +1,15 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import json
 import os
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import GoogleAcctDeprovException
+from deprov_common.google_services import google_services
+from deprov_common.google_batch import google_batch
+from deprov_common.deadline import deadline
 
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.user.security']
 
@@ -24,89 +26,114 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
-# This class is a singleton to ensure that we only have one instance of the google admin service
-class GoogleAdminService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleAdminService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-        self.service = build('admin', 'directory_v1', credentials=self.credentials)
-
-    def get_service(self):
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `remove_google_oauth_tokens` lambda handler.
 
-    Retrieves and removes all access tokens issued by a user for an application.
+    Retrieves and removes all access tokens issued by users for an application. The listings of every user, and then
+    every deletion, are sent as batched requests.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    records = json.loads(event.get('Records')[0].get('Sns').get('Message'), cls=event_table.EventTableRecordDecoder)
-    for user_to_process in records:
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
+    service = google_services.get_service('admin', 'directory_v1', SCOPES)
+
+    # Listings and deletions share the invocation's time, users whose calls weren't all sent are deferred as a whole
+    invocation_deadline = deadline.Deadline(context)
+    listings = google_batch.execute_batch(
+        service, [(record, get_user_tokens(service, record.username + domain)) for record in records],
+        deadline=invocation_deadline)
+
+    to_process = []
+    deletions = []
+    deferred = []
+    for listing in listings:
+        user_to_process = listing.key
         email = user_to_process.username + domain
-        admin_svc = GoogleAdminService()
-        service = admin_svc.get_service()
 
-        failure = False
-        try:
-            tokens = get_user_tokens(service, email)
-            if tokens is None or tokens.get('items') is None:
-                logger.info(f"No tokens found to remove for user {email}")
-                continue
-        except HttpError as e:
-            logger.warn(f"User {email} not found. Not an error. Moving on. \nResponse from server: {e}")
+        if listing.deferred:
+            deferred.append(user_to_process)
+            continue
+
+        if not listing.ok:
+            logger.warn(f"User {email} not found. Not an error. Moving on. \nResponse from server: {listing.error}")
+            continue
+        tokens = listing.response
+        if tokens is None or tokens.get('items') is None:
+            logger.info(f"No tokens found to remove for user {email}")
+            continue
+
+        to_process.append(user_to_process)
+        for token in tokens.get('items'):
+            client_id = token.get('clientId')
+            logger.info(f"Removing token with clientId {client_id} from {email}")
+            deletions.append(((user_to_process, client_id), build_token_removal(service, client_id, email)))
+
+    results = google_batch.execute_batch(service, deletions, deadline=invocation_deadline)
+
+    failed = set()
+    unfinished = set()
+    for result in results:
+        user_to_process, client_id = result.key
+        if result.deferred:
+            unfinished.add(user_to_process.username)
             continue
+        # Only the first failed deletion is reported, the record is retried as a whole
+        if result.ok or user_to_process.username in failed:
+            continue
+        failed.add(user_to_process.username)
         try:
-            for token in tokens.get('items'):
-                remove_token(user_to_process, service, token.get('clientId'), email)
+            remove_token(result, user_to_process, client_id, user_to_process.username + domain)
         except Exception as e:
-            failure = True
             logger.error(str(e))
 
-        if not failure:
-            handle_success(user_to_process, lambda_name, sns_arn)
+    for user_to_process in to_process:
+        if user_to_process.username in failed:
+            continue
+        if user_to_process.username in unfinished:
+            deferred.append(user_to_process)
+            continue
+        outcome_publisher.handle_success(user_to_process, lambda_name, sns_arn)
 
-    return {
-        'statusCode': 200,
-        'body': 'Success'
-    }
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
 
 def get_user_tokens(service, email):
     """
-    Returns the set of tokens specified user has issued to 3rd party applications.
+    Builds the request returning the set of tokens specified user has issued to 3rd party applications.
+
+    :param service: The Google Admin SDK service object
+    :param email: User's email address
+    """
+    return service.tokens().list(userKey=email, fields='items(clientId)')
+
+
+def build_token_removal(service, client_id, email):
+    """
+    Builds the request deleting all access tokens issued by a user for an application.
 
     :param service: The Google Admin SDK service object
+    :param client_id: The Client ID of the application the token is issued to.
     :param email: User's email address
     """
-    return service.tokens().list(userKey=email).execute()
+    return service.tokens().delete(userKey=email, clientId=client_id)
 
 
 @deprovisioning_action(sns_arn, lambda_name)
-def remove_token(record, service, client_id, email):
+def remove_token(result: google_batch.BatchResult, record, client_id, email):
     """
-    Deletes all access tokens issued by a user for an application.
+    Surfaces the failure, if any, of a batched token removal so it is handled like any other failed action
 
+    :param result: Result of the token removal request
     :param record: User's information
-    :param service: The Google Admin SDK service object
-    :param client_id: Identifies user in the API request. The value can be the user's primary email address,
-    alias email address, or unique user ID.
-    :param email: The Client ID of the application the token is issued to.
+    :param client_id: The Client ID of the application the token is issued to.
+    :param email: User's email address
     """
-    logger.info(f"Removing token with clientId {client_id} from {email}")
-    try:
-        service.tokens().delete(userKey=email, clientId=client_id).execute()
-    except HttpError as e:
+    if not result.ok:
         msg = f"Failed to remove oauth token associated with clientId {client_id} for user {email}"
         logger.error(msg)
-        raise GoogleAcctDeprovException(msg, record, e.resp)
+        raise GoogleAcctDeprovException(msg, record, result.error.resp)
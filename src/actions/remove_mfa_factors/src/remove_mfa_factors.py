@@ -1,9 +1,12 @@
 from userprovisioning.oneloginwrapper import oneloginwrapper
 from acct_decom_utils.plnu_logger import plnu_logger
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import RetryException, TerminalException
 from acct_decom_utils.event_table import event_table
+from deprov_common.record_executor import record_executor
+from deprov_common.deadline import deadline
 import json
 from typing import List
 import os
@@ -16,30 +19,33 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `remove_mfa_factors` lambda handler.
 
-    Removes user's OneLogin mfa factors.
+    Removes users' OneLogin mfa factors, processing several users at once.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    records: List[event_table.EventTableRecord] = json.loads(
-        event.get('Records')[0].get('Sns').get('Message'),
-        cls=event_table.EventTableRecordDecoder)
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
 
-    for record in records:
-        failure = False
-        try:
-            remove_mfa_factors(record)
-        except Exception as e:
-            logger.error(e)
-            failure = True
+    deferred = []
+    outcomes = record_executor.process_records(records, remove_mfa_factors, deadline=deadline.Deadline(context))
+    for outcome in outcomes:
+        if outcome.deferred:
+            deferred.append(outcome.record)
             continue
+        if not outcome.ok:
+            logger.error(outcome.error)
+            continue
+
+        outcome_publisher.handle_success(outcome.record, lambda_name, sns_arn)
 
-        if not failure:
-            handle_success(record, lambda_name, sns_arn)
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
 
 @deprovisioning_action(sns_arn, lambda_name)
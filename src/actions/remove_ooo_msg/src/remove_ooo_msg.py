@@ -1,5 +1,4 @@
 from google.auth.exceptions import RefreshError
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 import os
@@ -8,10 +7,13 @@ import time
 
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import GoogleAcctDeprovException
+from deprov_common.google_services import google_services
+from deprov_common.record_executor import record_executor
+from deprov_common.deadline import deadline
 from typing import List
 from string import Template
 from datetime import datetime, timezone
@@ -31,23 +33,7 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
-class GoogleGMailService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleGMailService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-
-    def get_service(self, delegated_user):
-        self.service = build('gmail', 'v1', credentials=self.credentials.with_subject(delegated_user))
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     remove_ooo_msg lambda handler.
@@ -57,11 +43,8 @@ def lambda_handler(event, context):
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    records: List[event_table.EventTableRecord] = json.loads(
-        event.get('Records')[0].get('Sns').get('Message'),
-        cls=event_table.EventTableRecordDecoder)
-
-    gls = GoogleGMailService()
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
 
     current_dir = os.path.dirname(os.path.abspath(__file__))
     ooo_html_path = os.path.join(current_dir, "ooo.html")
@@ -69,50 +52,57 @@ def lambda_handler(event, context):
     with open(ooo_html_path, 'r') as html_file:
         html_content = html_file.read()
 
-    for record in records:
-
-        failure = False
-
-        username = record.username
-        user_id = f"{username}{domain}"
-        service = gls.get_service(user_id)
-
-        user_data = {
-            'first_name': record.firstname,
-            'last_name': record.lastname,
-            'manager_first': record.mgr_first,
-            'manager_last': record.mgr_last,
-            'manager_email': record.mgr_email,
-            'cpy_yr': datetime.now(timezone.utc).year
-        }
-        template = Template(html_content)
-
-        message_config = {
-            'enableAutoReply': True,
-            'responseSubject': f"{record.firstname} {record.lastname} - Employment Status Update",
-            'responseBodyHtml': template.substitute(user_data),
-            'restrictToDomain': False,
-            'startTime': round(time.time() * 1000)
-        }
-
-        logger.info(f"Processing out of office message for {username}")
-        try:
-            set_user_ooo_msg(record, service, message_config)
-            logger.info(f"Successfuly processed out of office message for {username}.")
-        except Exception as e:
-
-            for item in e.args:
-                print(item)
-                print(type(item))
-
-            logger.error(f"Failed to update out of office message for {user_id}: {str(e)}")
-            failure = True
+    template = Template(html_content)
+
+    deferred = []
+    outcomes = record_executor.process_records(records, lambda record: process_record(record, template),
+                                               deadline=deadline.Deadline(context))
+    for outcome in outcomes:
+        if outcome.deferred:
+            deferred.append(outcome.record)
             continue
+        if not outcome.ok:
+            logger.error(f"Failed to update out of office message for {outcome.record.username}{domain}: "
+                         f"{str(outcome.error)}")
+            continue
+
+        outcome_publisher.handle_success(outcome.record, lambda_name, sns_arn)
 
-        if not failure:
-            handle_success(record, lambda_name, sns_arn)
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
-        return {'statusCode': 200, 'body': 'Success'}
+
+def process_record(record, template: Template):
+    """
+    Sets the departure notification as a single user's out of office message
+
+    :param record: User's information
+    :param template: Out of office message template
+    """
+    username = record.username
+    user_id = f"{username}{domain}"
+    service = google_services.get_service('gmail', 'v1', SCOPES, subject=user_id)
+
+    user_data = {
+        'first_name': record.firstname,
+        'last_name': record.lastname,
+        'manager_first': record.mgr_first,
+        'manager_last': record.mgr_last,
+        'manager_email': record.mgr_email,
+        'cpy_yr': datetime.now(timezone.utc).year
+    }
+
+    message_config = {
+        'enableAutoReply': True,
+        'responseSubject': f"{record.firstname} {record.lastname} - Employment Status Update",
+        'responseBodyHtml': template.substitute(user_data),
+        'restrictToDomain': False,
+        'startTime': round(time.time() * 1000)
+    }
+
+    logger.info(f"Processing out of office message for {username}")
+    set_user_ooo_msg(record, service, message_config)
+    logger.info(f"Successfuly processed out of office message for {username}.")
 
 
 @deprovisioning_action(sns_arn, lambda_name)
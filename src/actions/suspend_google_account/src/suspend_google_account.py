@@ -1,4 +1,3 @@
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 import json
@@ -6,10 +5,13 @@ import os
 
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.google_credentials import google_credentials
 from acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper import deprovisioning_action
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.outcome_publisher import outcome_publisher
+from deprov_common.action_event import action_event
 from acct_decom_utils.exceptions.exceptions import GoogleAcctDeprovException
+from deprov_common.google_services import google_services
+from deprov_common.google_batch import google_batch
+from deprov_common.deadline import deadline
 from typing import List
 
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.user']
@@ -27,83 +29,70 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
-class GoogleAdminService:
-    __instance = None
-    service = None
-
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(GoogleAdminService, cls).__new__(cls)
-        return cls.__instance
-
-    def __init__(self):
-        self.credentials = google_credentials.GoogleApiCredentials(scopes=SCOPES).get_credentials()
-        self.service = build('admin', 'directory_v1', credentials=self.credentials)
-
-    def get_service(self):
-        return self.service
-
-
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     suspend_google_account lambda handler.
 
-    Suspends a user's Google account
+    Suspends users' Google accounts. Suspensions are sent directly, as a batched request, without looking the users up
+    first; a user that doesn't exist has nothing to suspend.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    records: List[event_table.EventTableRecord] = json.loads(
-        event.get('Records')[0].get('Sns').get('Message'),
-        cls=event_table.EventTableRecordDecoder)
+    action = action_event.ActionEvent(event, lambda_name)
+    records = outcome_publisher.skip_completed(action.records, lambda_name, sns_arn)
+
+    service = google_services.get_service('admin', 'directory_v1', SCOPES)
 
-    admin_svc = GoogleAdminService()
-    service = admin_svc.get_service()
+    suspensions = google_batch.execute_batch(
+        service, [(record, build_suspension(service, record)) for record in records],
+        deadline=deadline.Deadline(context))
 
-    for record in records:
-        username = record.username
+    deferred = []
+    for suspension in suspensions:
+        record = suspension.key
 
-        user = get_user(service, record)
-        if not user:
-            logger.warn(f"{username}'s account does not exist. Not an error, moving on.")
+        if suspension.deferred:
+            deferred.append(record)
+            continue
+
+        if suspension.not_found:
+            logger.warn(f"{record.username}'s account does not exist. Not an error, moving on.")
+            outcome_publisher.handle_success(record, lambda_name, sns_arn)
             continue
 
         try:
-            response = suspend_user_acct(service, record)
-            logger.info(f"{username}'s account has been suspended. {response}")
+            suspend_user_acct(suspension, record)
+            logger.info(f"{record.username}'s account has been suspended. {suspension.response}")
         except Exception as e:
             logger.error(e)
             continue
 
-        handle_success(record, lambda_name, sns_arn)
+        outcome_publisher.handle_success(record, lambda_name, sns_arn)
+
+    # Records the invocation ran out of time for are picked up by another invocation of this lambda
+    return action.redeliver(deferred, lambda_name)
 
 
-def get_user(service, record):
+def build_suspension(service, record):
     """
-    Retrieves user information from a Google Admin SDK service based on the provided email
+    Builds the request suspending the specified user's account.
 
-    :param service: Google Admin SDK service object used for interacting with user data
-    :param record: The user's record whose information is to be retrieved
+    :param service: The Google Admin SDK service object
+    :param record: User's information
     """
-    try:
-        return service.users().get(userKey=f"{record.username}{domain}").execute()
-    except HttpError as err:
-        logger.error(str(err))
+    return service.users().update(userKey=f"{record.username}{domain}", body={'suspended': True}, fields='suspended')
 
 
 @deprovisioning_action(sns_arn, lambda_name)
-def suspend_user_acct(service, record):
+def suspend_user_acct(result: google_batch.BatchResult, record):
     """
-    Suspends the specified user's account.
+    Surfaces the failure, if any, of a user's batched suspension so it is handled like any other failed action
 
-    :param service: The Google Admin SDK service object
+    :param result: Result of the user's suspension request
     :param record: User's information
     """
-    username = record.username
-    email = f"{username}{domain}"
-    logger.info(record.to_json())
-    try:
-        return service.users().update(userKey=email, body={'suspended': True}).execute()
-    except HttpError as err:
-        logger.error(f"Google issue suspending current account: {str(err)}")
-        raise GoogleAcctDeprovException(str(err), record, err.resp)
+    if not result.ok:
+        logger.error(f"Google issue suspending current account: {str(result.error)}")
+        raise GoogleAcctDeprovException(str(result.error), record, result.error.resp)
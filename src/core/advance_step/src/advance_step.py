@@ -1,100 +1,182 @@
 import json
 import boto3
 import os
+import time
 from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
 from botocore.exceptions import ClientError
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.step_registry import step_registry
+from deprov_common.step_scheduler import step_scheduler
+from deprov_common.event_index import event_index
 
 log_level = os.getenv('log_level', 'INFD')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
 
-ssm = boto3.client('ssm')
+AWS_REGION = 'us-west-2'
+TABLE_NAME = 'EventState'
 
+# TransactWriteItems accepts up to 100 items, smaller chunks keep a single conflicting user from cancelling too many
+TRANSACT_CHUNK_SIZE = int(os.getenv('advance_batch_size', 25))
+MAX_ATTEMPTS = 3
 
-def update_step(event_to_update: event_table.EventTableRecord, param):
+# Outcomes reported per record
+ADVANCED = 'advanced'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
+
+
+class AdvanceStepException(Exception):
+    pass
+
+
+def build_step_update(event_to_update: event_table.EventTableRecord, step: step_registry.Step):
     """
-    Advances user to the next step in the deprovisioning process. Calculates `next_step` date and updates
-    `previous_step`, `next_step`, and `next_step_date` in DynamoDB
+    Builds the transactional update that advances user to the next step in the deprovisioning process. Calculates
+    `next_step` date and updates `previous_step`, `next_step`, `next_step_shard` and `next_step_date`. The update is
+    conditional on the user still being on the step being processed, so a replayed message can't advance a user twice.
 
     :param event_to_update: User's record
     :type event_to_update: event_table.EventTableRecord
 
-    :param param: Next step data
-    :type param: str
-    """
-    AWS_REGION = 'us-west-2'
-    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
-    table = dynamodb.Table('EventState')
+    :param step: The user's current step, as configured in the step registry
+    :type step: step_registry.Step
 
-    param_dict = json.loads(param)
+    :return: `Update` entry for TransactWriteItems
+    :rtype: dict
+    """
     date = datetime.strptime(event_to_update.next_step_date, event_table.TIMESTAMP_STR_FORMAT)
-    new_date = date + timedelta(days=int(param_dict.get("next_step_delay")))
+    new_date = date + timedelta(days=step.next_step_delay)
     new_date_str = datetime.strftime(new_date, event_table.TIMESTAMP_STR_FORMAT)
-    next_step = param_dict.get("next_step")
+    next_step = step.next_step
     previous_step = event_to_update.next_step
 
-    try:
-        table.update_item(
-            Key={
+    return {
+        'Update': {
+            'TableName': TABLE_NAME,
+            'Key': {
                 'username': event_to_update.username
             },
-            UpdateExpression="set previous_step=:prev,next_step=:nxt,next_step_date=:nd",
-            ExpressionAttributeValues={
+            'UpdateExpression': "set previous_step=:prev,next_step=:nxt,next_step_shard=:shard,next_step_date=:nd",
+            'ConditionExpression': "next_step = :prev",
+            'ExpressionAttributeValues': {
                 ':prev': previous_step,
                 ':nxt': next_step,
+                ':shard': event_index.step_shard(event_to_update.username, next_step),
                 ':nd': new_date_str
             }
-        )
-    except ClientError as err:
-        logger.error(f"Couldn't update: {err.response['Error']['Message']}")
-
+        }
+    }
 
-def get_step_params():
-    """
-    Uses the AWS Systems Manager (SSM) client to retrieve and format parameters specified by path. Returns the
-    formatted parameters in a dictionary
 
-    :return: Formatted parameters in a dictionary
-    :rtype: dict
+def advance_records(updates: List[Tuple[str, dict]]) -> Dict[str, str]:
     """
-    param_dict = {}
-    paginator = ssm.get_paginator('get_parameters_by_path')
+    Writes step updates in chunked transactions. When a transaction is cancelled, users whose condition failed are
+    reported as skipped (already advanced) and the remaining users of the chunk are retried. A user listed more than
+    once is only updated once, a transaction can't touch the same item twice.
 
-    # Handle pagination
-    for page in paginator.paginate(
-            Path='/deprovisioning/steps',
-            Recursive=True
-    ):
-        for parameter in page['Parameters']:
-            param_parts = parameter.get('Name').split('/')
-            step_name = param_parts[-1]
-            acct_type = param_parts[-2]
+    :param updates: Username and `Update` entry pairs, as built by `build_step_update`
+    :type updates: List[Tuple[str, dict]]
 
-            if acct_type not in param_dict:
-                param_dict[acct_type] = {}
-
-            param_dict[acct_type][step_name] = parameter.get('Value')
+    :return: Outcome (`advanced`, `skipped` or `failed`) keyed by username
+    :rtype: Dict[str, str]
+    """
+    outcomes = {}
+
+    unique = {}
+    for username, update in updates:
+        if username in unique:
+            logger.warning(f"{username} is listed more than once, advancing once")
+            continue
+        unique[username] = update
+    updates = list(unique.items())
+
+    for start in range(0, len(updates), TRANSACT_CHUNK_SIZE):
+        pending = updates[start:start + TRANSACT_CHUNK_SIZE]
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                dynamodb.meta.client.transact_write_items(TransactItems=[update for _, update in pending])
+                outcomes.update({username: ADVANCED for username, _ in pending})
+                pending = []
+                break
+            except ClientError as err:
+                error = err.response['Error']
+                if error['Code'] != 'TransactionCanceledException':
+                    logger.warning(f"Couldn't update chunk (attempt {attempt}): {error['Message']}")
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+
+                reasons = err.response.get('CancellationReasons', [])
+                retry = []
+                for (username, update), reason in zip(pending, reasons):
+                    if reason.get('Code') == 'ConditionalCheckFailed':
+                        step_name = update['Update']['ExpressionAttributeValues'][':prev']
+                        logger.info(f"{username} is no longer on step {step_name}, skipping")
+                        outcomes[username] = SKIPPED
+                    else:
+                        retry.append((username, update))
+                pending = retry
+                if not pending:
+                    break
+
+        for username, _ in pending:
+            logger.error(f"Couldn't advance {username} after {MAX_ATTEMPTS} attempts")
+            outcomes[username] = FAILED
+
+    return outcomes
+
+
+def next_steps(updates: List[Tuple[str, dict]], outcomes: Dict[str, str]) -> List[Tuple[str, str, str]]:
+    """
+    :param updates: Step updates, as built by `build_step_update`, keyed by username
+    :param outcomes: Outcome of each user's update
 
-    return param_dict
+    :return: Username, next step and next step date of every user that was advanced
+    :rtype: List[Tuple[str, str, str]]
+    """
+    advanced = []
+    for username, update in updates:
+        if outcomes.get(username) == ADVANCED:
+            values = update['Update']['ExpressionAttributeValues']
+            advanced.append((username, values[':nxt'], values[':nd']))
+    return advanced
 
 
 def lambda_handler(event, context):
     """
-    Advances user to the next step in the deprovisioning process.
+    Advances user to the next step in the deprovisioning process, and schedules the next step for when it is due.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    params = get_step_params()
+    steps = step_registry.StepRegistry().get_graph()
 
     records = json.loads(event.get('Records')[0].get('Sns').get('Message'), cls=event_table.EventTableRecordDecoder)
+    updates = []
     for record in records:
         acct_type = record.account_type
         step_name = record.next_step
-        update_step(record, params[acct_type][step_name])
+        step = steps.get(acct_type, step_name)
+        if step is None:
+            logger.error(f"No step configured for {acct_type}:{step_name}, not advancing {record.username}")
+            continue
+        updates.append((record.username, build_step_update(record, step)))
+
+    outcomes = advance_records(updates)
+    step_scheduler.schedule_steps(next_steps(updates, outcomes))
+    failed = [username for username, outcome in outcomes.items() if outcome == FAILED]
+    logger.info(f"Advanced {list(outcomes.values()).count(ADVANCED)}, skipped {list(outcomes.values()).count(SKIPPED)}"
+                f", failed {len(failed)} of {len(records)} records")
+
+    if failed:
+        # Let lambda retry the message, users that were already advanced will be skipped by the step condition
+        raise AdvanceStepException(f"Failed to advance {failed}")
 
     return {
         'statusCode': 200,
-        'body': "Success"
+        'body': json.dumps(outcomes)
     }
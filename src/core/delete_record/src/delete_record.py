@@ -1,6 +1,7 @@
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.failed_lambda_processing.handle_success import handle_success
+from deprov_common.event_index import event_index
+from deprov_common.outcome_publisher import outcome_publisher
 
 import json
 import os
@@ -12,28 +13,43 @@ lambda_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 sns_arn = os.getenv('failure_topic_arn')
 
 
+class DeleteRecordException(Exception):
+    pass
+
+
+@outcome_publisher.buffered
 def lambda_handler(event, context):
     """
     `delete_record` lambda handler.
 
-    Removes specified user from 'EventState' DynamoDB/account deprovisioning process.
+    Removes specified users from 'EventState' DynamoDB/account deprovisioning process. Users are deleted 25 at a time
+    and their success notifications are published in batches.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    if 'Records' in event and 'Sns' in event['Records'][0]:
+    from_topic = 'Records' in event and 'Sns' in event['Records'][0]
+    if from_topic:
         records = json.loads(
             event.get('Records')[0].get('Sns').get('Message'),
             cls=event_table.EventTableRecordDecoder)
     else:
         records = json.loads(event['body'], cls=event_table.EventTableRecordDecoder)
 
-    for record in records:
-        if record.account_type == 'student':
-            pass
+    failed = event_index.delete_records([record.username for record in records])
 
-        et = event_table.EventTable()
-        et.delete(record.username)
-        handle_success(record, sns_arn, lambda_name)
+    for record in records:
+        if record.username in failed:
+            logger.error(f"Failed to delete {record.username}")
+            continue
+        outcome_publisher.handle_success(record, lambda_name, sns_arn)
+
+    logger.info(f"Deleted {len(records) - len(failed)} of {len(records)} records")
+
+    if failed and from_topic:
+        # Let lambda retry the message, deleting users that are already gone is a no-op
+        raise DeleteRecordException(f"Failed to delete {sorted(failed)}")
+    if failed:
+        return {"status": 500, "message": "Delete failed", "failed": sorted(failed)}
 
     return {"status": 200, "message": "Delete successful"}
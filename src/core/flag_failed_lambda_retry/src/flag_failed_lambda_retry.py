@@ -1,7 +1,6 @@
-from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.failure_state import failure_state
 import os
-import json
 
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
@@ -11,18 +10,15 @@ def lambda_handler(event, context):
     """
     `flag_failed_lambda_retry` lambda handler.
 
-    Update 'EventState' DynamoDB table to add info about a failed Lambda execution.
+    Update 'EventState' DynamoDB table to add info about failed Lambda executions. Receives `retry` messages in
+    batches from SQS and records all of a user's failures with one update.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    msg = json.loads(event.get('Records')[0].get('Sns').get('Message'))
+    outcomes, invalid = failure_state.parse_outcomes(event)
+    failed = invalid + failure_state.process_outcomes(outcomes, failure_state.flag_failures)
 
-    username = msg.get('username')
-    lambda_name = msg.get('lambda_name')
-
-    evt_table = event_table.EventTable()
-    record = json.loads(json.dumps(
-        evt_table.add_failed_lambda(username, lambda_name), cls=event_table.EventTableRecordEncoder),
-        cls=event_table.EventTableRecordDecoder)
-    logger.info(f'Add failed lambda reponse: {record.HTTPStatusCode}')
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]
+    }
@@ -1,7 +1,14 @@
 import json
+import time
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.step_registry import step_registry
+from deprov_common.event_index import event_index
+from deprov_common.sns_publisher import sns_publisher
+from deprov_common.step_scheduler import step_scheduler
+from datetime import datetime, timedelta
 import os
 
 topic_arn = os.environ.get("deprov_topic_arn")
@@ -9,75 +16,149 @@ topic_arn = os.environ.get("deprov_topic_arn")
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
 
+# Number of (account type, step) partitions queried and published at the same time
+step_concurrency = int(os.getenv('step_concurrency', 8))
+
+# While users are triggered by their own schedule, which fires at midnight UTC of their `next_step_date` like the
+# reconciliation run does, the reconciliation run only picks up users overdue by at least this long
+RECONCILE_GRACE = timedelta(days=1)
+
+# Milliseconds left at which the shard backfill stops and returns where to resume from
+BACKFILL_RESERVE_MS = 15000
+
+# boto3 clients are thread safe, so the worker threads share this one
 sns = boto3.client('sns')
-ssm = boto3.client('ssm')
 
 
-def get_step_params():
+class GetRecordsException(Exception):
+    pass
+
+
+def reconcile_due_by() -> datetime:
+    """
+    :return: Upper bound for the `next_step_date` of users published by the reconciliation run. Users due today are
+        left to their schedule when steps are scheduled, so they aren't published twice
+    :rtype: datetime
+    """
+    now = datetime.now()
+    return now - RECONCILE_GRACE if step_scheduler.enabled() else now
+
+
+def process_step(acct_type: str, step: str, due_by: datetime) -> dict:
     """
-    Uses the AWS Systems Manager (SSM) client to retrieve and format parameters specified by path. Returns the
-    formatted parameters in a dictionary
+    Queries the pending records for a single step and publishes them to the deprovisioning topic
 
-    :return: Formatted parameters in a dictionary
+    :param str acct_type: The type of account. e.g "employee" or "student"
+    :param str step: Step name. e.g "emp-1"
+    :param datetime due_by: Upper bound for the `next_step_date` of the records
+
+    :return: Record count, elapsed time and any error for the step
     :rtype: dict
     """
-    param_dict = {}
-    paginator = ssm.get_paginator('get_parameters_by_path')
+    logger.info(f"Processing records for step {acct_type}:{step}")
+    started = time.perf_counter()
+    result = {'account_type': acct_type, 'step': step, 'records': 0}
+
+    try:
+        pending = event_index.iter_pending_events(step, due_by=due_by)
+        result['records'] = sns_publisher.publish_records(sns, topic_arn, pending, step)
+    except Exception as e:
+        logger.error(f"Failed to process records for {acct_type}:{step}: {e}")
+        result['error'] = str(e)
+
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000)
 
-    # Handle pagination
-    for page in paginator.paginate(
-            Path='/deprovisioning/steps',
-            Recursive=True
-    ):
-        for parameter in page['Parameters']:
-            param_parts = parameter.get('Name').split('/')
-            step_name = param_parts[-1]
-            acct_type = param_parts[-2]
+    if result['records']:
+        logger.info(f"Published {result['records']} records for {acct_type}:{step} in {result['elapsed_ms']}ms")
+    elif 'error' not in result:
+        logger.warn(f"No pending records found for {acct_type}:{step}")
 
-            if acct_type not in param_dict:
-                param_dict[acct_type] = {}
+    return result
 
-            param_dict[acct_type][step_name] = parameter.get('Value')
 
-    return param_dict
+def process_user(username: str, step: str) -> dict:
+    """
+    Publishes a single user whose step has come due, as triggered by the user's one-time schedule. The user is only
+    published if they are still waiting on that step and it is due, so late or repeated triggers are no-ops.
+
+    :param str username: User to process
+    :param str step: Step the user was scheduled for. e.g "emp-1"
+
+    :return: Record count for the user's step
+    :rtype: dict
+    """
+    result = {'username': username, 'step': step, 'records': 0}
+    today = datetime.now().strftime(event_table.TIMESTAMP_STR_FORMAT)
+
+    records = [record for record in event_index.get_records([{'username': {'S': username}}])
+               if record.next_step == step and record.next_step_date <= today]
+    if not records:
+        logger.info(f"{username} is no longer due for {step}, skipping")
+        return result
+
+    result['records'] = sns_publisher.publish_records(sns, topic_arn, records, step)
+    logger.info(f"Published {username} for {step}")
+    return result
+
+
+def backfill_step_shards(event, context) -> dict:
+    """
+    Runs the `next_step_shard-index` backfill for as long as the invocation has time. When it isn't done, the response
+    holds the `start_key` to invoke the lambda with again, along with `"backfill_step_shards": true`.
+
+    :param event: The event data passed to the Lambda function, with the `start_key` of the previous run if any
+    :param context: The Lambda execution context.
+
+    :return: Number of users sharded and the key to resume from
+    :rtype: dict
+    """
+    def should_stop() -> bool:
+        return context is not None and context.get_remaining_time_in_millis() < BACKFILL_RESERVE_MS
+
+    sharded, start_key = event_index.backfill_step_shards(event.get('start_key'), should_stop=should_stop)
+    logger.info(f"Sharded {sharded} users, {'done' if start_key is None else 'more to go'}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'sharded': sharded, 'start_key': start_key, 'done': start_key is None})
+    }
 
 
 def lambda_handler(event, context):
     """
     `get_records_to_process` lambda handler.
 
-    Retrieves pending events from 'EventTable' DynamoDB table for processing.
+    Triggered by a user's one-time schedule, publishes that user once their step is due. Invoked by hand with
+    `{"backfill_step_shards": true}`, shards users written before `next_step_shard-index`. Otherwise, as the
+    reconciliation run, retrieves pending events from 'EventTable' DynamoDB table for processing, see
+    `reconcile_due_by`. Every step is queried and published in parallel, bounded by `step_concurrency`. A step that
+    fails doesn't stop the others, the invocation fails once every step has been attempted.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    params = get_step_params()
-
-    for acct_type in params.keys():
-
-        logger.info(f"Processing steps for account type {acct_type}")
-        for step in params[acct_type].keys():
-            logger.info(f"Processing records for step {step}")
-
-            evt_table = event_table.EventTable()
-            pending = evt_table.get_pending_events(step)
-
-            if pending:
-                sns.publish(
-                    TargetArn=topic_arn,
-                    Message=json.dumps({'default': json.dumps(pending, cls=event_table.EventTableRecordEncoder)}),
-                    MessageStructure='json',
-                    MessageAttributes={
-                        'step': {
-                            'DataType': 'String',
-                            'StringValue': f'{step}'
-                        }
-                    }
-                )
-            else:
-                logger.warn(f"No pending records found for {acct_type}:{step}")
+    if isinstance(event, dict) and event.get('backfill_step_shards'):
+        return backfill_step_shards(event, context)
+
+    target = step_scheduler.scheduled_target(event)
+    if target:
+        return {
+            'statusCode': 200,
+            'body': json.dumps(process_user(*target))
+        }
+
+    steps = step_registry.StepRegistry().get_graph()
+    due_by = reconcile_due_by()
+
+    with ThreadPoolExecutor(max_workers=step_concurrency) as executor:
+        futures = [executor.submit(process_step, step.account_type, step.name, due_by) for step in steps]
+        results = [future.result() for future in futures]
+
+    failed = [f"{result['account_type']}:{result['step']}" for result in results if 'error' in result]
+    if failed:
+        # Fail the invocation so errors are alarmed on, steps that succeeded are already published
+        raise GetRecordsException(f"Failed to process steps {failed}: {json.dumps(results)}")
 
     return {
         'statusCode': 200,
-        'body': "Success"
+        'body': json.dumps(results)
     }
@@ -1,22 +1,54 @@
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
 from acct_decom_utils.exceptions.exceptions import InsertException
+from deprov_common.step_scheduler import step_scheduler
+from deprov_common.event_index import event_index
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Optional
+import base64
+import boto3
 import json
 import os
 
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
 
+TABLE_NAME = 'EventState'
+
+# Records written at the same time by a bulk insert. Each is a conditional put, so an existing user is never replaced
+bulk_write_concurrency = int(os.getenv('bulk_write_concurrency', 16))
+
+REQUIRED_FIELDS = ['username', 'account_type', 'insert_date']
+ACCOUNT_TYPES = ['employee', 'student']
+
+# Per-record results of a bulk insert
+INSERTED = 'inserted'
+EXISTS = 'exists'
+INVALID = 'invalid'
+FAILED = 'failed'
+
+# The resource's client takes and returns plain Python values instead of DynamoDB's typed JSON
+dynamodb = boto3.resource('dynamodb', config=Config(max_pool_connections=max(10, bulk_write_concurrency)))
+
 
 def lambda_handler(event, context):
     """
     `insert_record` lambda handler.
 
-    Inserts a record into 'EventState' DynamoDB table.
+    Inserts a record into 'EventState' DynamoDB table, and schedules the user's first step for when it is due.
+    Requests to the bulk endpoint carry a list of records instead, see `insert_records`.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
+    records = bulk_records(event)
+    if records is not None:
+        return insert_records(records)
+
     event_json = json.dumps(event)
     insert_rec: event_table.EventTableRecord = json.loads(event_json, cls=event_table.EventTableRecordDecoder)
 
@@ -31,6 +63,16 @@ def lambda_handler(event, context):
     except InsertException as e:
         # Likely need to add some sort of notification here, for now just logging
         logger.error(f"Failed to insert record: {str(e)}")
+    else:
+        # `EventTable` doesn't know about shards, so the user is added to `next_step_shard-index` separately. Until
+        # then the user is still found through `next_step-index`
+        try:
+            event_index.set_step_shard(insert_rec.username, insert_rec.next_step)
+        except Exception as e:
+            logger.error(f"Failed to shard {insert_rec.username}: {str(e)}")
+
+        step_date = getattr(insert_rec, 'next_step_date', None) or insert_rec.insert_date
+        step_scheduler.schedule_step(insert_rec.username, insert_rec.next_step, step_date)
 
     return {
         "status": 200,
@@ -52,3 +94,159 @@ def get_step_prefix(account_type: str):
         return "stu"
     else:
         return ""
+
+
+def bulk_records(event) -> Optional[List[dict]]:
+    """
+    Reads the records of a bulk insert request. The body is either a JSON array, an object with a `records` array, or
+    NDJSON, which the API passes base64 encoded as `ndjson_base64`.
+
+    :param event: The event data passed to the Lambda function.
+
+    :return: Records to insert, or None if this isn't a bulk request
+    :rtype: Optional[List[dict]]
+    """
+    if isinstance(event, list):
+        return event
+    if isinstance(event.get('records'), list):
+        return event['records']
+    if 'ndjson_base64' in event:
+        body = base64.b64decode(event['ndjson_base64']).decode('utf-8')
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                records.append({'_error': f"Invalid JSON: {e}"})
+        return records
+    return None
+
+
+def insert_records(records: List[dict]) -> dict:
+    """
+    Inserts many records at once. Records are validated in one pass and users that already exist are looked up with
+    `BatchGetItem`, then the rest are written with conditional puts, `bulk_write_concurrency` at a time. A user
+    inserted in the meantime by another request is reported as existing rather than overwritten.
+    Written users are queued to get their first step scheduled, which happens after the response (202).
+
+    :param records: Records as sent to the single record endpoint
+
+    :return: Response with one result per record, in the order they were sent
+    :rtype: dict
+    """
+    results: List[dict] = []
+    items: Dict[str, dict] = {}
+    for record in records:
+        username = record.get('username') if isinstance(record, dict) else None
+        result = {'username': username}
+        results.append(result)
+
+        error = validate_record(record)
+        if not error and username in items:
+            error = 'Duplicate username in request'
+        if error:
+            result.update(status=INVALID, error=error)
+            continue
+        items[username] = build_item(record)
+
+    existing = set()
+    usernames = list(items)
+    for start in range(0, len(usernames), event_index.BATCH_GET_SIZE):
+        keys = [{'username': {'S': username}} for username in usernames[start:start + event_index.BATCH_GET_SIZE]]
+        existing.update(record.username for record in event_index.get_records(keys))
+
+    to_write = [item for username, item in items.items() if username not in existing]
+    with ThreadPoolExecutor(max_workers=max(1, min(bulk_write_concurrency, len(to_write)))) as executor:
+        written = dict(zip((item['username'] for item in to_write), executor.map(write_item, to_write)))
+
+    for result in results:
+        if 'status' in result:
+            continue
+        username = result['username']
+        result['status'] = EXISTS if username in existing else written[username]
+        if result['status'] == FAILED:
+            result['error'] = 'Write failed, please retry'
+
+    inserted = [items[result['username']] for result in results if result['status'] == INSERTED]
+    step_scheduler.enqueue_steps([(item['username'], item['next_step'], item['next_step_date']) for item in inserted])
+
+    counts = {status: [result['status'] for result in results].count(status)
+              for status in [INSERTED, EXISTS, INVALID, FAILED]}
+    logger.info(f"Bulk insert of {len(records)} records: {counts}")
+
+    return {
+        "status": 202,
+        "message": "Bulk insert processed",
+        "counts": counts,
+        "results": results
+    }
+
+
+def validate_record(record) -> Optional[str]:
+    """
+    :param record: Record as sent to the bulk endpoint
+
+    :return: Why the record can't be inserted, or None if it is valid
+    :rtype: Optional[str]
+    """
+    if not isinstance(record, dict):
+        return 'Record must be an object'
+    if '_error' in record:
+        return record['_error']
+    missing = [field for field in REQUIRED_FIELDS if not record.get(field)]
+    if missing:
+        return f"Missing {', '.join(missing)}"
+    if record['account_type'] not in ACCOUNT_TYPES:
+        return f"Unknown account type {record['account_type']}"
+    for field in ['insert_date', 'next_step_date']:
+        if field not in record:
+            continue
+        try:
+            datetime.strptime(record[field], event_table.TIMESTAMP_STR_FORMAT)
+        except (TypeError, ValueError):
+            return f"Invalid {field} {record[field]}"
+    return None
+
+
+def build_item(record: dict) -> dict:
+    """
+    :param dict record: Valid record as sent to the bulk endpoint
+
+    :return: The record as stored in 'EventState', waiting on the account type's first step from its `insert_date`
+        unless it has a `next_step_date` of its own
+    :rtype: dict
+    """
+    insert_rec: event_table.EventTableRecord = json.loads(json.dumps(record), cls=event_table.EventTableRecordDecoder)
+    insert_rec.next_step = f"{get_step_prefix(insert_rec.account_type)}-1"
+    # `next_step_date` is the sort key of the step indexes, a user without it is never picked up
+    if not getattr(insert_rec, 'next_step_date', None):
+        insert_rec.next_step_date = insert_rec.insert_date
+
+    item = json.loads(json.dumps(insert_rec, cls=event_table.EventTableRecordEncoder), parse_float=Decimal)
+    item['next_step_shard'] = event_index.step_shard(insert_rec.username, insert_rec.next_step)
+    return item
+
+
+def write_item(item: dict) -> str:
+    """
+    Writes a single item, on the condition that the user doesn't exist yet
+
+    :param dict item: Item to write
+
+    :return: `inserted`, `exists` if the user was inserted in the meantime, or `failed`
+    :rtype: str
+    """
+    try:
+        dynamodb.meta.client.put_item(TableName=TABLE_NAME, Item=item,
+                                      ConditionExpression='attribute_not_exists(username)')
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return EXISTS
+        logger.error(f"Failed to write {item['username']}: {str(err)}")
+        return FAILED
+    except Exception as e:
+        logger.error(f"Failed to write {item['username']}: {str(e)}")
+        return FAILED
+    return INSERTED
@@ -1,7 +1,6 @@
 from acct_decom_utils.plnu_logger import plnu_logger
-from acct_decom_utils.event_table import event_table
+from deprov_common.failure_state import failure_state
 import os
-import json
 
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
@@ -11,17 +10,19 @@ def lambda_handler(event, context):
     """
     `remove_failure_state` lambda handler.
 
-    Handles removing a given lambda from the list of failed lambdas for a user in their dynamodb record
+    Handles removing lambdas from the list of failed lambdas for users in their dynamodb record. Receives `clear`
+    messages in batches from SQS and removes all of a user's succeeded lambdas with one update.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    msg = json.loads(event.get('Records')[0].get('Sns').get('Message'))
-    evt_table = event_table.EventTable()
-    evt_table.remove_failed_lambda(msg.get("username"), msg.get("lambda_name"))
-    logger.info('Successfully removed failure state')
+    outcomes, invalid = failure_state.parse_outcomes(event)
+    failed = invalid + failure_state.process_outcomes(outcomes, failure_state.clear_failures)
+    if failed:
+        logger.warning(f"Failed to remove failure state for {len(failed)} messages, returning them to the queue")
+    else:
+        logger.info('Successfully removed failure state')
 
     return {
-        'statusCode': 200,
-        'body': 'Success'
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]
     }
@@ -2,11 +2,26 @@ import json
 import boto3
 from acct_decom_utils.event_table import event_table
 from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.event_index import event_index
+from deprov_common.failure_state import failure_state
+from deprov_common.sns_publisher import sns_publisher
 import os
-from typing import List
+from collections import defaultdict
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Dict, Iterator, List, Tuple
 
 topic_arn = os.environ.get("deprov_topic_arn")
 
+# Users flagged before `next_retry_at` was introduced are only found by scanning `has_failed_lambdas-index`. Turn this
+# off once no such users are left, the scan reads every failed user on every run
+SCAN_LEGACY_FAILURES = os.getenv('scan_legacy_failures', 'true').lower() == 'true'
+
+# Failed users published and leased together, so a run holds no more than this many records at once
+PAGE_SIZE = 100
+
+sns = boto3.client('sns')
+
 log_level = os.getenv('log_level', 'INFO')
 logger = plnu_logger.PLNULogger(log_level).get_logger()
 
@@ -15,36 +30,115 @@ def lambda_handler(event, context):
     """
     retry_failed_lambdas lambda handler.
 
-    Process records of failed Lambda executions with a failure count less than 3.
+    Process records of failed Lambda executions whose retry is due, as long as they have retries left. Failed users
+    are grouped by the lambda to retry and published together, several records per message and several messages per
+    call. Published retries are then leased so the next run doesn't publish them again while they are running.
+    Retries carry the step the lambda failed on as `origin_step`, the records themselves have moved on to the next one.
+    Failed users are handled `PAGE_SIZE` at a time.
 
     :param event: The event data passed to the Lambda function.
     :param context: The Lambda execution context.
     """
-    sns = boto3.client('sns')
-
     logger.info("Retrying failed lambdas")
-    evt_table = event_table.EventTable()
-    failed_items: List[event_table.EventTableRecord] = evt_table.get_failed_items()
-
-    for failed_item in failed_items:
-        logger.info(f"Found failed lambdas for {failed_item.username}")
-        for lambda_name, fail_count in failed_item.failed_lambdas.items():
-            logger.info(f"Publishing retry of lambda {lambda_name} for {failed_item.username}")
-            if fail_count < 3:
-                sns.publish(
-                    TargetArn=topic_arn,
-                    # Downstream lambdas expecting list of records, so need to wrap even though sending single record
-                    Message=json.dumps({'default': json.dumps([failed_item], cls=event_table.EventTableRecordEncoder)}),
-                    MessageStructure='json',
-                    MessageAttributes={
-                        'step': {
-                            'DataType': 'String',
-                            'StringValue': f'{lambda_name}'
-                        }
-                    }
-                )
+    now = datetime.now(timezone.utc)
+    totals: Dict[Tuple[str, str], int] = defaultdict(int)
+    failed_items = iter_failed_items()
+    while True:
+        page = list(islice(failed_items, PAGE_SIZE))
+        if not page:
+            break
+        for key, count in retry_page(page, now).items():
+            totals[key] += count
 
     return {
         'statusCode': 200,
-        'body': "Success"
+        'body': json.dumps([{'lambda_name': lambda_name, 'step': step, 'records': count}
+                            for (lambda_name, step), count in totals.items()])
     }
+
+
+def retry_page(failed_items: List[event_table.EventTableRecord], now: datetime) -> Dict[Tuple[str, str], int]:
+    """
+    Publishes the due retries of a page of failed users and leases them
+
+    :param failed_items: Failed users' records
+    :param datetime now: Time the retries were looked up
+
+    :return: Number of users published, keyed by lambda name and failed step
+    :rtype: Dict[Tuple[str, str], int]
+    """
+    retries: Dict[Tuple[str, str], List[event_table.EventTableRecord]] = defaultdict(list)
+    for failed_item in failed_items:
+        logger.info(f"Found failed lambdas for {failed_item.username}")
+        for lambda_name in failure_state.due_lambdas(*retry_state(failed_item), now):
+            logger.info(f"Queueing retry of lambda {lambda_name} for {failed_item.username}")
+            retries[(lambda_name, failed_step(failed_item))].append(failed_item)
+
+    # The lambda name is used as the step, the lambdas are subscribed to their own name
+    published = sns_publisher.publish_grouped_records(sns, topic_arn, retries)
+    for (lambda_name, step), count in published.items():
+        logger.info(f"Published retry of lambda {lambda_name} for {count} users on step {step}")
+
+    lease_published(failed_items, retries, published, now)
+    return published
+
+
+def iter_failed_items() -> Iterator[event_table.EventTableRecord]:
+    """
+    Lazily yields users with failed lambdas that are due for a retry, a page at a time
+
+    :return: Iterator of failed users' records
+    """
+    yield from event_index.iter_retry_due_events()
+
+    # Users flagged before `next_retry_at` was introduced aren't in the due index
+    if SCAN_LEGACY_FAILURES:
+        yield from event_index.iter_legacy_failed_events()
+
+
+def retry_state(record: event_table.EventTableRecord):
+    """
+    :param record: Failed user's record
+
+    :return: The user's `failed_lambdas` and `retry_at` maps
+    """
+    return getattr(record, 'failed_lambdas', None) or {}, getattr(record, 'retry_at', None)
+
+
+def failed_step(record: event_table.EventTableRecord) -> str:
+    """
+    :param record: Failed user's record
+
+    :return: Step the user's lambdas failed on. `advance_step` moves users on as soon as their step is published, so
+        by the time a retry is due that is the user's previous step
+    :rtype: str
+    """
+    return getattr(record, 'previous_step', None) or record.next_step
+
+
+def lease_published(failed_items: List[event_table.EventTableRecord],
+                    retries: Dict[Tuple[str, str], List[event_table.EventTableRecord]],
+                    published: Dict[Tuple[str, str], int], now: datetime):
+    """
+    Leases the retries that were published and moves every failed user to their next retry. Users without a due
+    retry are updated too, which takes users whose retries are used up out of `retry_due-index` and schedules users
+    flagged before retries were scheduled.
+
+    :param failed_items: Every failed user found
+    :param retries: Users queued for a retry, keyed by lambda name and failed step
+    :param published: Number of users published, keyed by lambda name and failed step
+    :param datetime now: Time the retries were looked up
+    """
+    leased: Dict[str, List[str]] = defaultdict(list)
+    for (lambda_name, step), records in retries.items():
+        if published.get((lambda_name, step), 0) == len(records):
+            for record in records:
+                leased[record.username].append(lambda_name)
+
+    for failed_item in failed_items:
+        try:
+            failure_state.lease_retries(failed_item.username, *retry_state(failed_item),
+                                        leased.get(failed_item.username, []), now)
+        except Exception as e:
+            # The retry is published, it will just be scheduled again by the next run
+            logger.error(f"Failed to lease retries of {failed_item.username}: {e}")
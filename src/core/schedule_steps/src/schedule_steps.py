@@ -0,0 +1,35 @@
+import json
+import os
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.step_scheduler import step_scheduler
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+
+def lambda_handler(event, context):
+    """
+    `schedule_steps` lambda handler.
+
+    Creates the one-time step schedules of users queued by `step_scheduler.enqueue_steps`, such as the users of a bulk
+    insert. Each message holds a list of username, step and step date. Users that can't be scheduled are logged and
+    picked up by the nightly reconciliation run, only unreadable messages are returned to the queue.
+
+    :param event: The event data passed to the Lambda function.
+    :param context: The Lambda execution context.
+    """
+    steps = []
+    failed = []
+    for message in event.get('Records', []):
+        try:
+            steps.extend((username, step, step_date) for username, step, step_date in json.loads(message['body']))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Invalid schedule message {message.get('messageId')}: {e}")
+            failed.append(message.get('messageId'))
+
+    scheduled = step_scheduler.schedule_steps(steps)
+    logger.info(f"Scheduled {scheduled} of {len(steps)} users")
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]
+    }
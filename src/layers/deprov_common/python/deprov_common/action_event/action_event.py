@@ -0,0 +1,139 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+from acct_decom_utils.event_table import event_table
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.deadline import deadline
+from deprov_common.idempotency import idempotency
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+
+class ActionEvent:
+    """
+    Records delivered to an action lambda, either as a batch of SQS messages from the lambda's queue (raw SNS
+    messages) or as a direct SNS invocation. Every message holds a list of records. The step each record was
+    published for is read from the message and handed to the idempotency ledger, records of retries that don't carry
+    it bypass the ledger.
+    """
+
+    def __init__(self, event, lambda_name: Optional[str] = None):
+        self.records: List[event_table.EventTableRecord] = []
+        self.from_queue = False
+        self.steps: Dict[str, Optional[str]] = {}
+        self._message_ids: Dict[str, List[str]] = {}
+        self._failed_message_ids: List[str] = []
+
+        for message in event.get('Records', []):
+            if 'Sns' in message:
+                records = decode_records(message.get('Sns').get('Message'))
+                self._set_steps(records, message, lambda_name)
+                self.records.extend(records)
+                continue
+
+            self.from_queue = True
+            message_id = message.get('messageId')
+            try:
+                records = decode_records(message.get('body'))
+            except ValueError as e:
+                # Redelivered until it lands in the dead letter queue, without holding up the rest of the batch
+                logger.error(f"Couldn't decode message {message_id}: {e}")
+                self._failed_message_ids.append(message_id)
+                continue
+            for record in records:
+                self._message_ids.setdefault(record.username, []).append(message_id)
+            self._set_steps(records, message, lambda_name)
+            self.records.extend(records)
+
+        idempotency.set_trigger_steps(self.steps)
+
+    def _set_steps(self, records: Sequence, message: dict, lambda_name: Optional[str]):
+        step = message_step(message, lambda_name)
+        # By the time a retry is published the records' `next_step` has moved on, so without the step it was first
+        # published for, the step the work belongs to is unknown
+        if step or legacy_retry(message, lambda_name):
+            self.steps.update({record.username: step for record in records})
+
+    def redeliver(self, records: Sequence, lambda_name: str) -> Optional[dict]:
+        """
+        Hands records that weren't processed to another invocation of the lambda. Messages from the queue holding them
+        are reported as batch item failures, so SQS redelivers just those messages once their visibility timeout
+        passes. Records already completed in them are skipped through the idempotency ledger.
+        Records from a direct SNS invocation are deferred through the deprovisioning topic instead.
+
+        :param records: Records to process again
+        :param str lambda_name: Name of the lambda handling the event
+
+        :return: The handler's response, a partial batch response for SQS events
+        :rtype: Optional[dict]
+        """
+        if not self.from_queue:
+            by_step: Dict[Optional[str], list] = {}
+            for record in records:
+                by_step.setdefault(self.steps.get(record.username), []).append(record)
+            for step, step_records in by_step.items():
+                deadline.defer_records(step_records, lambda_name, step)
+            return None
+
+        failed = list(self._failed_message_ids)
+        for record in records:
+            for message_id in self._message_ids.get(record.username, []):
+                if message_id not in failed:
+                    failed.append(message_id)
+        if records:
+            logger.warning(f"Returning {len(failed)} messages to the queue for another invocation of {lambda_name}")
+            deadline.emit_deferred_metric(lambda_name, len(records))
+
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
+
+
+def decode_records(message: str) -> List[event_table.EventTableRecord]:
+    """
+    :param str message: Message published by `sns_publisher`
+
+    :return: The records it holds
+    :rtype: List[event_table.EventTableRecord]
+    """
+    return json.loads(message, cls=event_table.EventTableRecordDecoder)
+
+
+def message_step(message: dict, lambda_name: Optional[str] = None) -> Optional[str]:
+    """
+    :param dict message: SQS message or SNS record of the event
+    :param str lambda_name: Name of the lambda handling the event
+
+    :return: Step the message's records were first published for: its `origin_step` attribute, or its `step` attribute
+        unless that only addresses the lambda (retries published before `origin_step` existed)
+    :rtype: Optional[str]
+    """
+    attributes = message_attributes(message)
+    step = attributes.get('origin_step') or attributes.get('step')
+    if not step or step == lambda_name:
+        return None
+    return step
+
+
+def legacy_retry(message: dict, lambda_name: Optional[str] = None) -> bool:
+    """
+    :param dict message: SQS message or SNS record of the event
+    :param str lambda_name: Name of the lambda handling the event
+
+    :return: True for retries published before `origin_step` existed, which only address the lambda
+    :rtype: bool
+    """
+    attributes = message_attributes(message)
+    return bool(lambda_name) and not attributes.get('origin_step') and attributes.get('step') == lambda_name
+
+
+def message_attributes(message: dict) -> Dict[str, str]:
+    """
+    :param dict message: SQS message or SNS record of the event
+
+    :return: String values of the message's attributes, keyed by name
+    :rtype: Dict[str, str]
+    """
+    if 'Sns' in message:
+        return {name: value.get('Value') for name, value in message['Sns'].get('MessageAttributes', {}).items()}
+    return {name: value.get('stringValue') for name, value in message.get('messageAttributes', {}).items()}
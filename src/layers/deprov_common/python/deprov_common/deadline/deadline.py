@@ -0,0 +1,93 @@
+import json
+import os
+import time
+from typing import Optional, Sequence
+
+import boto3
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.sns_publisher import sns_publisher
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Milliseconds left before the lambda times out at which no new record is started. Records already in flight need
+# to finish within it, so it should cover at least one slow API call
+RESERVE_MS = int(os.getenv('deadline_reserve_ms', 15000))
+
+METRIC_NAMESPACE = 'AccountDeprovisioning'
+
+topic_arn = os.getenv('deprov_topic_arn')
+
+sns = boto3.client('sns')
+
+
+class Deadline:
+    """
+    Tracks the time an invocation has left, based on the Lambda context it was given
+    """
+
+    def __init__(self, context, reserve_ms: int = RESERVE_MS):
+        self.context = context
+        self.reserve_ms = reserve_ms
+
+    def remaining_ms(self) -> int:
+        """
+        :return: Milliseconds before the lambda times out, or a very large number when running without a context
+        :rtype: int
+        """
+        if self.context is None:
+            return 2 ** 31
+        return self.context.get_remaining_time_in_millis()
+
+    def expired(self) -> bool:
+        """
+        :return: True once starting another record would risk the invocation timing out
+        :rtype: bool
+        """
+        return self.remaining_ms() <= self.reserve_ms
+
+
+def defer_records(records: Sequence, lambda_name: str, origin_step: Optional[str] = None) -> int:
+    """
+    Publishes records the invocation ran out of time for back to the deprovisioning topic so another invocation of
+    the same lambda picks them up.
+
+    The records are tagged with the lambda's name as their `step`, the same way failed lambdas are retried, rather than
+    with the step they came from. That step is also subscribed to by `advance_step` and every other action of the step,
+    which have already processed these records. That step is carried as `origin_step` instead.
+
+    :param records: Records that weren't processed
+    :param str lambda_name: Name of the lambda deferring the records
+    :param str origin_step: Step the records were first published for, if known
+
+    :return: Number of records deferred
+    :rtype: int
+    """
+    if not records:
+        return 0
+
+    deferred = sns_publisher.publish_records(sns, topic_arn, records, lambda_name, origin_step=origin_step)
+    logger.warning(f"Running out of time, deferred {deferred} records to another invocation of {lambda_name}")
+    emit_deferred_metric(lambda_name, deferred)
+    return deferred
+
+
+def emit_deferred_metric(lambda_name: str, count: int):
+    """
+    Writes the number of deferred records to the log in CloudWatch embedded metric format
+
+    :param str lambda_name: Name of the lambda deferring the records
+    :param int count: Number of records deferred
+    """
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRIC_NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': 'DeferredRecords', 'Unit': 'Count'}]
+            }]
+        },
+        'FunctionName': lambda_name,
+        'DeferredRecords': count
+    }))
@@ -0,0 +1,358 @@
+import heapq
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Callable, Iterator, List, Optional, Set, Tuple
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from acct_decom_utils.event_table import event_table
+
+TABLE_NAME = 'EventState'
+NEXT_STEP_INDEX = 'next_step-index'
+NEXT_STEP_SHARD_INDEX = 'next_step_shard-index'
+FAILED_LAMBDAS_INDEX = 'has_failed_lambdas-index'
+RETRY_DUE_INDEX = 'retry_due-index'
+
+# Value of `has_failed_lambdas` while a user has failed lambdas, the partition key of `retry_due-index`
+FAILED_FLAG = 'true'
+
+# `next_retry_at` is stored in UTC so it sorts lexicographically
+RETRY_AT_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Users of a step are spread over this many `next_step_shard-index` partitions
+MAX_STEP_SHARDS = 32
+STEP_SHARDS = max(1, min(int(os.getenv('step_shards', 8)), MAX_STEP_SHARDS))
+
+# Shards queried per step. When `step_shards` is lowered, keep this at the previous value until the users written to
+# the higher shards have moved on, or they aren't found
+STEP_SHARD_READS = max(STEP_SHARDS, min(int(os.getenv('step_shard_reads', STEP_SHARDS)), MAX_STEP_SHARDS))
+
+# Rollout of `next_step_shard-index`, which has to be added to the table in a deployment of its own:
+# - `off`: the index doesn't exist yet, steps are read from `next_step-index`
+# - `backfill`: the index exists, users without a shard are still read from `next_step-index` until
+#   `backfill_step_shards` has been run
+# - `on`: every user has a shard, only the shard index is read
+SHARD_INDEX_OFF = 'off'
+SHARD_INDEX_BACKFILL = 'backfill'
+SHARD_INDEX_ON = 'on'
+STEP_SHARD_INDEX = os.getenv('step_shard_index', SHARD_INDEX_OFF)
+
+# BatchGetItem accepts at most 100 keys per call, BatchWriteItem 25 requests
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+_deserializer = TypeDeserializer()
+
+# Low level clients are thread safe, unlike boto3 resources, so one client can be shared by concurrent queries
+_client = None
+
+
+def get_client():
+    """
+    :return: Shared DynamoDB client, created on first use
+    """
+    global _client
+    if _client is None:
+        _client = boto3.client('dynamodb')
+    return _client
+
+
+def item_to_record(item: dict) -> event_table.EventTableRecord:
+    """
+    Converts a low level DynamoDB item into an `EventTableRecord`
+
+    :param dict item: Item as returned by the DynamoDB client
+
+    :return: The decoded record
+    :rtype: event_table.EventTableRecord
+    """
+    plain = {key: _deserializer.deserialize(value) for key, value in item.items()}
+    return json.loads(json.dumps(plain, default=_decimal_default), cls=event_table.EventTableRecordDecoder)
+
+
+def step_shard(username: str, step: str) -> str:
+    """
+    :param str username: User's username
+    :param str step: Step the user is waiting on. e.g "emp-1"
+
+    :return: The user's `next_step_shard`, `<step>#<shard>` with a shard that is stable for the user
+    :rtype: str
+    """
+    return f"{step}#{zlib.crc32(username.encode('utf-8')) % STEP_SHARDS}"
+
+
+def set_step_shard(username: str, step: str):
+    """
+    Adds `next_step_shard` to a user written without it, as long as the user is still waiting on `step`
+
+    :param str username: User's username
+    :param str step: Step the user is waiting on. e.g "emp-1"
+    """
+    try:
+        get_client().update_item(
+            TableName=TABLE_NAME,
+            Key={'username': {'S': username}},
+            UpdateExpression='SET next_step_shard = :shard',
+            ConditionExpression='next_step = :step',
+            ExpressionAttributeValues={
+                ':shard': {'S': step_shard(username, step)},
+                ':step': {'S': step}
+            }
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def backfill_step_shards(start_key: Optional[dict] = None, page_size: int = 500,
+                         should_stop: Callable[[], bool] = lambda: False) -> Tuple[int, Optional[dict]]:
+    """
+    One-off migration adding `next_step_shard` to users written before `next_step_shard-index`, through
+    `set_step_shard`. The table is scanned a page at a time until it is done or `should_stop` returns True, then the
+    key to resume from is returned.
+
+    :param dict start_key: Key returned by the previous run, None to start from the beginning
+    :param int page_size: Items read per scan page
+    :param should_stop: Called between pages, returning True when the caller is running out of time
+
+    :return: Number of users sharded, and the key to resume from or None once the whole table is done
+    :rtype: Tuple[int, Optional[dict]]
+    """
+    scan_args = {
+        'TableName': TABLE_NAME,
+        'ProjectionExpression': 'username, next_step',
+        'FilterExpression': 'attribute_exists(next_step) AND attribute_not_exists(next_step_shard)',
+        'Limit': page_size
+    }
+    sharded = 0
+    while True:
+        if start_key:
+            scan_args['ExclusiveStartKey'] = start_key
+        page = get_client().scan(**scan_args)
+        for item in page.get('Items', []):
+            set_step_shard(item['username']['S'], item['next_step']['S'])
+            sharded += 1
+
+        start_key = page.get('LastEvaluatedKey')
+        if not start_key or should_stop():
+            return sharded, start_key
+
+
+def iter_pending_events(step: str, due_by: Optional[datetime] = None, page_size: Optional[int] = None,
+                        executor: Optional[ThreadPoolExecutor] = None) -> Iterator[event_table.EventTableRecord]:
+    """
+    Lazily yields records waiting on `step` whose `next_step_date` has passed, oldest first. The first
+    `STEP_SHARD_READS` shards of `next_step_shard-index` are queried and merged by `next_step_date`. Until the shard
+    index is rolled out (see `STEP_SHARD_INDEX`), records are read from `next_step-index` as well, or only.
+
+    Queries run on the caller's thread, a page at a time as the merge needs them. Callers already querying several
+    steps at once get their parallelism from that. Given an `executor`, every query is instead run on it, a page ahead
+    of the merge.
+
+    :param str step: Step name to query. e.g "emp-1"
+    :param datetime due_by: Upper bound for `next_step_date`, defaults to now
+    :param int page_size: Optional page size limit for each query
+    :param executor: Optional pool to prefetch pages on
+
+    :return: Iterator of pending records
+    """
+    due = (due_by or datetime.now()).strftime(event_table.TIMESTAMP_STR_FORMAT)
+    queries = []
+    if STEP_SHARD_INDEX != SHARD_INDEX_OFF:
+        for shard in range(STEP_SHARD_READS):
+            queries.append({
+                'TableName': TABLE_NAME,
+                'IndexName': NEXT_STEP_SHARD_INDEX,
+                'KeyConditionExpression': 'next_step_shard = :shard AND next_step_date <= :due',
+                'ExpressionAttributeValues': {
+                    ':shard': {'S': f"{step}#{shard}"},
+                    ':due': {'S': due}
+                }
+            })
+
+    if STEP_SHARD_INDEX != SHARD_INDEX_ON:
+        legacy_query = {
+            'TableName': TABLE_NAME,
+            'IndexName': NEXT_STEP_INDEX,
+            'KeyConditionExpression': 'next_step = :step AND next_step_date <= :due',
+            'ExpressionAttributeValues': {
+                ':step': {'S': step},
+                ':due': {'S': due}
+            }
+        }
+        if STEP_SHARD_INDEX == SHARD_INDEX_BACKFILL:
+            # Sharded users are read from their shard. The filter doesn't save reads, which is why this query is
+            # dropped once the backfill is done
+            legacy_query['FilterExpression'] = 'attribute_not_exists(next_step_shard)'
+        queries.append(legacy_query)
+
+    if page_size:
+        for query_args in queries:
+            query_args['Limit'] = page_size
+
+    streams = [_iter_query(executor, query_args) for query_args in queries]
+    for item in heapq.merge(*streams, key=lambda item: item['next_step_date']['S']):
+        yield item_to_record(item)
+
+
+def _iter_query(executor: Optional[ThreadPoolExecutor], query_args: dict) -> Iterator[dict]:
+    if executor is None:
+        while True:
+            page = get_client().query(**query_args)
+            yield from page.get('Items', [])
+            last_key = page.get('LastEvaluatedKey')
+            if not last_key:
+                return
+            query_args = {**query_args, 'ExclusiveStartKey': last_key}
+
+    # The next page is requested as soon as a page arrives, so every shard is read while the merge is consuming
+    future = executor.submit(get_client().query, **query_args)
+    while future:
+        page = future.result()
+        last_key = page.get('LastEvaluatedKey')
+        future = None
+        if last_key:
+            query_args = {**query_args, 'ExclusiveStartKey': last_key}
+            future = executor.submit(get_client().query, **query_args)
+        yield from page.get('Items', [])
+
+
+def format_retry_at(when: datetime) -> str:
+    """
+    :param datetime when: Timezone aware time
+
+    :return: `when` as stored in `next_retry_at`
+    :rtype: str
+    """
+    return when.astimezone(timezone.utc).strftime(RETRY_AT_FORMAT)
+
+
+def iter_retry_due_events(due_by: Optional[datetime] = None,
+                          page_size: Optional[int] = None) -> Iterator[event_table.EventTableRecord]:
+    """
+    Lazily yields records with failed lambdas whose `next_retry_at` has passed. `retry_due-index` is sparse and keys
+    only, so each page of due usernames is followed by a `BatchGetItem` for their full records, one page at a time.
+
+    :param datetime due_by: Upper bound for `next_retry_at`, defaults to now
+    :param int page_size: Optional page size limit for each query
+
+    :return: Iterator of records due for a retry
+    """
+    due_by = due_by or datetime.now(timezone.utc)
+    query_args = {
+        'TableName': TABLE_NAME,
+        'IndexName': RETRY_DUE_INDEX,
+        'KeyConditionExpression': 'has_failed_lambdas = :flag AND next_retry_at <= :due',
+        'ExpressionAttributeValues': {
+            ':flag': {'S': FAILED_FLAG},
+            ':due': {'S': format_retry_at(due_by)}
+        }
+    }
+    if page_size:
+        query_args['Limit'] = page_size
+
+    while True:
+        page = get_client().query(**query_args)
+        keys = [{'username': item['username']} for item in page.get('Items', [])]
+        for start in range(0, len(keys), BATCH_GET_SIZE):
+            yield from get_records(keys[start:start + BATCH_GET_SIZE])
+
+        last_key = page.get('LastEvaluatedKey')
+        if not last_key:
+            return
+        query_args['ExclusiveStartKey'] = last_key
+
+
+def get_records(keys: List[dict], max_attempts: int = 5) -> Iterator[event_table.EventTableRecord]:
+    """
+    Fetches up to 100 full records with `BatchGetItem`, retrying unprocessed keys with a short backoff. Records that
+    no longer exist are skipped.
+
+    :param keys: Low level keys of the records
+    :param int max_attempts: Attempts made before unprocessed keys are given up on
+
+    :return: Iterator of the records found
+    """
+    request = {TABLE_NAME: {'Keys': keys}}
+    for attempt in range(1, max_attempts + 1):
+        response = get_client().batch_get_item(RequestItems=request)
+        for item in response.get('Responses', {}).get(TABLE_NAME, []):
+            yield item_to_record(item)
+
+        request = response.get('UnprocessedKeys')
+        if not request:
+            return
+        time.sleep(0.05 * 2 ** attempt)
+
+    raise RuntimeError(f"Couldn't fetch {len(request[TABLE_NAME]['Keys'])} records after {max_attempts} attempts")
+
+
+def delete_records(usernames: List[str], max_attempts: int = 5) -> Set[str]:
+    """
+    Deletes users with `BatchWriteItem`, 25 at a time, retrying unprocessed deletes with a short backoff
+
+    :param usernames: Users to delete
+    :param int max_attempts: Attempts made for each chunk
+
+    :return: Usernames that couldn't be deleted
+    :rtype: Set[str]
+    """
+    usernames = list(dict.fromkeys(usernames))
+    failed = set()
+    for start in range(0, len(usernames), BATCH_WRITE_SIZE):
+        request = {TABLE_NAME: [{'DeleteRequest': {'Key': {'username': {'S': username}}}}
+                                for username in usernames[start:start + BATCH_WRITE_SIZE]]}
+        for attempt in range(1, max_attempts + 1):
+            request = get_client().batch_write_item(RequestItems=request).get('UnprocessedItems')
+            if not request:
+                break
+            time.sleep(0.05 * 2 ** attempt)
+
+        if request:
+            failed.update(entry['DeleteRequest']['Key']['username']['S'] for entry in request[TABLE_NAME])
+
+    return failed
+
+
+def iter_legacy_failed_events(page_size: Optional[int] = None) -> Iterator[event_table.EventTableRecord]:
+    """
+    Lazily yields records flagged with failed lambdas before retries were scheduled, which aren't in
+    `retry_due-index`. `has_failed_lambdas-index` is sparse, so scanning it only reads flagged users, whatever value
+    their flag was written with.
+
+    :param int page_size: Optional page size limit for each scan
+
+    :return: Iterator of flagged records without `next_retry_at` or `retry_at`
+    """
+    scan_args = {
+        'TableName': TABLE_NAME,
+        'IndexName': FAILED_LAMBDAS_INDEX,
+        # Users whose retries are all used up have `retry_at` but no `next_retry_at`
+        'FilterExpression': 'attribute_not_exists(next_retry_at) AND attribute_not_exists(retry_at)'
+    }
+    if page_size:
+        scan_args['Limit'] = page_size
+
+    while True:
+        page = get_client().scan(**scan_args)
+        for item in page.get('Items', []):
+            yield item_to_record(item)
+
+        last_key = page.get('LastEvaluatedKey')
+        if not last_key:
+            return
+        scan_args['ExclusiveStartKey'] = last_key
+
+
+def _decimal_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,382 @@
+import json
+import os
+import random
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.event_index import event_index
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+TABLE_NAME = 'EventState'
+
+# Value of `has_failed_lambdas` while a user has failed lambdas. The attribute is removed, along with
+# `next_retry_at`, once none are left, which keeps `has_failed_lambdas-index` and `retry_due-index` sparse
+FAILED_FLAG = event_index.FAILED_FLAG
+
+# Retries made for a failed lambda before it is left to the terminal failure path
+MAX_RETRIES = int(os.getenv('max_retries', 3))
+
+# Seconds before the first retry, doubled for every further failure up to the maximum
+RETRY_BASE_DELAY = int(os.getenv('retry_base_delay', 60))
+RETRY_MAX_DELAY = int(os.getenv('retry_max_delay', 6 * 60 * 60))
+
+# Seconds a published retry has to report its outcome before it is published again
+RETRY_LEASE = int(os.getenv('retry_lease', 15 * 60))
+
+# Attempts made to schedule a user's retries while their failure state keeps changing underneath
+SCHEDULE_ATTEMPTS = 5
+
+# Ids of the `retry` messages counted in the user's `failed_lambdas`, kept until every failed lambda is cleared
+FAILURE_TOKENS = 'failure_tokens'
+
+dynamodb = boto3.resource('dynamodb')
+table = dynamodb.Table(TABLE_NAME)
+
+
+@dataclass
+class Outcome:
+    """
+    A single `retry` or `clear` message from the failure topic. `message_id` is the SQS message to report if the
+    outcome can't be applied, `token` identifies the message across deliveries.
+    """
+    message_id: Optional[str]
+    username: str
+    lambda_name: str
+    token: Optional[str] = None
+
+
+def parse_outcomes(event) -> Tuple[List[Outcome], List[str]]:
+    """
+    Reads every outcome in the event. Supports batches delivered by SQS (raw SNS messages) as well as direct SNS
+    invocations. A message that can't be read doesn't stop the rest of the batch from being applied.
+
+    :param event: The event data passed to the Lambda function.
+
+    :return: Outcomes in the order they were received, and the message ids of SQS messages that couldn't be read, for
+        SQS to move to the dead-letter queue once they run out of receives
+    :rtype: Tuple[List[Outcome], List[str]]
+    """
+    outcomes = []
+    invalid = []
+    for record in event.get('Records', []):
+        if 'Sns' in record:
+            message_id, token, body = None, record.get('Sns').get('MessageId'), record.get('Sns').get('Message')
+        else:
+            message_id, token, body = record.get('messageId'), record.get('messageId'), record.get('body')
+        try:
+            msg = json.loads(body)
+            outcomes.append(Outcome(message_id, msg['username'], msg['lambda_name'], token))
+        except (TypeError, ValueError, KeyError) as e:
+            logger.error(f"Invalid outcome message {message_id}: {body} ({e})")
+            if message_id:
+                invalid.append(message_id)
+
+    return outcomes, invalid
+
+
+def process_outcomes(outcomes: List[Outcome], update: Callable[[str, List[Outcome]], None]) -> List[str]:
+    """
+    Groups outcomes per user and applies each user's outcomes with a single `update` call
+
+    :param outcomes: Outcomes to apply
+    :param update: Either `flag_failures` or `clear_failures`
+
+    :return: Message ids of the outcomes that couldn't be applied, for SQS to redeliver
+    :rtype: List[str]
+    """
+    by_username: Dict[str, List[Outcome]] = OrderedDict()
+    for outcome in outcomes:
+        by_username.setdefault(outcome.username, []).append(outcome)
+
+    failed = []
+    failed_users = 0
+    for username, user_outcomes in by_username.items():
+        try:
+            update(username, user_outcomes)
+        except Exception as e:
+            lambdas = list(dict.fromkeys(outcome.lambda_name for outcome in user_outcomes))
+            logger.error(f"Failed to update failure state of {username} for {lambdas}: {e}")
+            failed.extend(outcome.message_id for outcome in user_outcomes if outcome.message_id)
+            failed_users += 1
+
+    logger.info(f"Applied {len(outcomes)} outcomes to {len(by_username) - failed_users} users")
+    return failed
+
+
+def retry_delay(failures: int) -> timedelta:
+    """
+    Exponential backoff with jitter: the delay doubles with every failure, up to `RETRY_MAX_DELAY`, and a random half
+    of it is added so users failing together don't retry together.
+
+    :param int failures: Number of times the lambda has failed for the user
+
+    :return: Time to wait before the next retry
+    :rtype: timedelta
+    """
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** max(0, failures - 1))
+    return timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+def flag_failures(username: str, outcomes: List[Outcome]):
+    """
+    Atomically adds failures to the user's `failed_lambdas` map and flags the user as having failed lambdas, in one
+    update no matter how many lambdas failed. The update is conditional on none of the outcomes' tokens being in the
+    user's `failure_tokens` yet, so a message delivered again isn't counted twice. Each failed lambda is then
+    scheduled for a retry after a backoff based on how many times it has failed.
+
+    :param str username: User whose lambdas failed
+    :param outcomes: The user's `retry` outcomes
+    """
+    pending = list(outcomes)
+    item = None
+    for attempt in range(1, SCHEDULE_ATTEMPTS + 1):
+        try:
+            item = _add_failures(username, pending)
+            break
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt == SCHEDULE_ATTEMPTS:
+                raise
+
+        item = table.get_item(Key={'username': username}, ConsistentRead=True).get('Item')
+        if item is None:
+            logger.info(f"Skipped failure state update for {username}: user no longer exists")
+            return
+
+        counted = set(item.get(FAILURE_TOKENS) or [])
+        pending = [outcome for outcome in pending if not outcome.token or outcome.token not in counted]
+        if not pending:
+            # Already counted, the retries are scheduled again in case scheduling failed after the count
+            logger.info(f"Failures of {username} were already counted")
+            break
+
+    now = datetime.now(timezone.utc)
+    failed = item.get('failed_lambdas') or {}
+    lambdas = [lambda_name for lambda_name in dict.fromkeys(outcome.lambda_name for outcome in outcomes)
+               if lambda_name in failed]
+    schedule_retries(username, failed, item.get('retry_at'),
+                     {lambda_name: now + retry_delay(int(failed[lambda_name])) for lambda_name in lambdas})
+
+
+def _add_failures(username: str, outcomes: List[Outcome]) -> dict:
+    names = {'#failed': 'failed_lambdas'}
+    values = {':zero': 0, ':flag': FAILED_FLAG}
+    updates = ['has_failed_lambdas = :flag']
+    conditions = ['attribute_exists(username)']
+    for index, (lambda_name, count) in enumerate(Counter(outcome.lambda_name for outcome in outcomes).items()):
+        names[f'#l{index}'] = lambda_name
+        values[f':c{index}'] = count
+        updates.append(f'#failed.#l{index} = if_not_exists(#failed.#l{index}, :zero) + :c{index}')
+
+    tokens = list(dict.fromkeys(outcome.token for outcome in outcomes if outcome.token))
+    if tokens:
+        names['#tokens'] = FAILURE_TOKENS
+        values[':none'] = []
+        values[':tokens'] = tokens
+        updates.append('#tokens = list_append(if_not_exists(#tokens, :none), :tokens)')
+        for index, token in enumerate(tokens):
+            values[f':t{index}'] = token
+            conditions.append(f'NOT contains(#tokens, :t{index})')
+
+    update_args = {
+        'Key': {'username': username},
+        'UpdateExpression': 'SET ' + ', '.join(updates),
+        'ConditionExpression': ' AND '.join(conditions),
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values,
+        'ReturnValues': 'ALL_NEW'
+    }
+    try:
+        return table.update_item(**update_args)['Attributes']
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ValidationException':
+            raise
+
+    # The map doesn't exist yet, so its entries can't be set. Create it, then apply the update
+    _update({
+        'Key': update_args['Key'],
+        'UpdateExpression': 'SET #failed = if_not_exists(#failed, :empty)',
+        'ConditionExpression': 'attribute_exists(username)',
+        'ExpressionAttributeNames': {'#failed': 'failed_lambdas'},
+        'ExpressionAttributeValues': {':empty': {}}
+    })
+    return table.update_item(**update_args)['Attributes']
+
+
+def due_lambdas(failed: Mapping[str, int], retry_at: Optional[Mapping[str, str]], now: datetime) -> List[str]:
+    """
+    :param failed: The user's `failed_lambdas` map
+    :param retry_at: The user's `retry_at` map, if any
+    :param datetime now: Current time
+
+    :return: Failed lambdas that still have retries left and whose retry time has passed
+    :rtype: List[str]
+    """
+    now_str = event_index.format_retry_at(now)
+    retry_at = retry_at or {}
+    return [lambda_name for lambda_name, count in failed.items()
+            if int(count) < MAX_RETRIES and retry_at.get(lambda_name, now_str) <= now_str]
+
+
+def lease_retries(username: str, failed: Mapping[str, int], retry_at: Optional[Mapping[str, str]],
+                  lambdas: List[str], now: datetime):
+    """
+    Pushes back the retry time of lambdas whose retry was just published by `RETRY_LEASE`, so they aren't published
+    again while the retry is running. The retry's own outcome then clears or reschedules them.
+
+    :param str username: User whose retries were published
+    :param failed: The user's `failed_lambdas` map
+    :param retry_at: The user's `retry_at` map, if any
+    :param lambdas: Lambdas whose retry was published
+    :param datetime now: Current time
+    """
+    lease_until = now + timedelta(seconds=RETRY_LEASE)
+    schedule_retries(username, failed, retry_at, {lambda_name: lease_until for lambda_name in lambdas})
+
+
+def schedule_retries(username: str, failed: Mapping[str, int], retry_at: Optional[Mapping[str, str]],
+                     changes: Dict[str, datetime]):
+    """
+    Sets the retry time of the given lambdas and moves the user's `next_retry_at` to the earliest retry still pending,
+    which is what `retry_due-index` is sorted by. Users without pending retries are taken out of the index.
+
+    The update only applies while the user's `failed_lambdas` and `retry_at` are still the ones the schedule was
+    computed from. When another update got in between, the user is read again and the schedule recomputed, dropping
+    changes for lambdas that were cleared or failed again since.
+
+    :param str username: User to schedule retries for
+    :param failed: The user's `failed_lambdas` map
+    :param retry_at: The user's `retry_at` map, if any
+    :param changes: New retry time keyed by lambda name
+    """
+    for attempt in range(1, SCHEDULE_ATTEMPTS + 1):
+        try:
+            _schedule_retries(username, failed, retry_at, changes)
+            return
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt == SCHEDULE_ATTEMPTS:
+                raise
+
+        item = table.get_item(Key={'username': username}, ConsistentRead=True).get('Item')
+        if item is None:
+            logger.info(f"Skipped retry schedule of {username}: user no longer exists")
+            return
+
+        logger.info(f"Failure state of {username} changed while scheduling retries, recomputing")
+        current = item.get('failed_lambdas') or {}
+        changes = {lambda_name: retry for lambda_name, retry in changes.items()
+                   if lambda_name in current and int(current[lambda_name]) == int(failed.get(lambda_name, -1))}
+        failed, retry_at = current, item.get('retry_at')
+
+
+def _schedule_retries(username: str, failed: Mapping[str, int], retry_at: Optional[Mapping[str, str]],
+                      changes: Dict[str, datetime]):
+    schedule = {lambda_name: retry for lambda_name, retry in (retry_at or {}).items() if lambda_name in failed}
+    schedule.update({lambda_name: event_index.format_retry_at(retry) for lambda_name, retry in changes.items()})
+    pending = [retry for lambda_name, retry in schedule.items() if int(failed[lambda_name]) < MAX_RETRIES]
+
+    names = {'#failed': 'failed_lambdas', '#retry': 'retry_at'}
+    values = {':flag': FAILED_FLAG, ':schedule': schedule, ':zero': 0}
+    conditions = ['attribute_exists(username)']
+    if failed:
+        values[':failed'] = dict(failed)
+        conditions.append('#failed = :failed')
+    else:
+        conditions.append('(attribute_not_exists(#failed) OR size(#failed) = :zero)')
+    if retry_at:
+        values[':retry'] = dict(retry_at)
+        conditions.append('#retry = :retry')
+    else:
+        conditions.append('(attribute_not_exists(#retry) OR size(#retry) = :zero)')
+
+    # The whole map is written, entries of lambdas that are no longer failed are dropped with it
+    expression = 'SET has_failed_lambdas = :flag, #retry = :schedule'
+    if pending:
+        values[':next'] = min(pending)
+        expression += ', next_retry_at = :next'
+    else:
+        # Every failed lambda is out of retries
+        expression += ' REMOVE next_retry_at'
+
+    table.update_item(
+        Key={'username': username},
+        UpdateExpression=expression,
+        ConditionExpression=' AND '.join(conditions),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def clear_failures(username: str, outcomes: List[Outcome]):
+    """
+    Atomically removes lambdas from the user's `failed_lambdas` and `retry_at` maps, in one update no matter how
+    many lambdas succeeded. Users without failure state, which is most of them, take that one call. The user's failure
+    flag, retry time and failure tokens are removed once no failed lambdas are left.
+
+    :param str username: User whose lambdas succeeded
+    :param outcomes: The user's `clear` outcomes
+    """
+    lambdas = list(dict.fromkeys(outcome.lambda_name for outcome in outcomes))
+    try:
+        item = _remove_entries(username, lambdas, ['#failed', '#retry'])
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        old = err.response.get('Item') or {}
+        if 'failed_lambdas' not in old:
+            return
+        # Flagged before retries were scheduled, so the user has no `retry_at` map to remove from
+        try:
+            item = _remove_entries(username, lambdas, ['#failed'])
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return
+
+    if 'has_failed_lambdas' in item and not item.get('failed_lambdas'):
+        _update({
+            'Key': {'username': username},
+            'UpdateExpression': 'REMOVE has_failed_lambdas, next_retry_at, #retry, #tokens',
+            # A failure recorded since the removal above keeps the flag
+            'ConditionExpression': 'attribute_not_exists(#failed) OR size(#failed) = :zero',
+            'ExpressionAttributeNames': {'#failed': 'failed_lambdas', '#retry': 'retry_at',
+                                         '#tokens': FAILURE_TOKENS},
+            'ExpressionAttributeValues': {':zero': 0}
+        })
+
+
+def _remove_entries(username: str, lambdas: List[str], maps: List[str]) -> dict:
+    # The maps have to exist for their entries to be removed. When one doesn't, the update fails its condition and
+    # the item is returned with the error
+    names = {'#failed': 'failed_lambdas', '#retry': 'retry_at'}
+    names = {name: names[name] for name in maps}
+    removals = []
+    for index, lambda_name in enumerate(lambdas):
+        names[f'#l{index}'] = lambda_name
+        removals.extend(f'{name}.#l{index}' for name in maps)
+
+    return table.update_item(
+        Key={'username': username},
+        UpdateExpression='REMOVE ' + ', '.join(removals),
+        ConditionExpression=' AND '.join(f'attribute_exists({name})' for name in maps),
+        ExpressionAttributeNames=names,
+        ReturnValues='ALL_NEW',
+        ReturnValuesOnConditionCheckFailure='ALL_OLD'
+    )['Attributes']
+
+
+def _update(update_args: dict) -> Optional[dict]:
+    try:
+        return table.update_item(**update_args).get('Attributes')
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # The user's record is gone (deprovisioning finished) or a newer failure was recorded, both are fine
+        logger.info(f"Skipped failure state update for {update_args['Key']['username']}: condition not met")
+        return None
@@ -0,0 +1,146 @@
+import os
+from dataclasses import dataclass
+from typing import Any, Iterable, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.deadline import deadline as deadline_
+from deprov_common.rate_limiter import rate_limiter
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Google accepts more calls per batch for some APIs, but 100 is the limit they share
+MAX_BATCH_SIZE = 100
+
+
+@dataclass
+class BatchResult:
+    """
+    Outcome of one request sent as part of a batch. `key` is whatever the caller paired with the request, usually the
+    record it was made for. `deferred` is set for requests that weren't sent because the invocation was running out
+    of time.
+    """
+    key: Any
+    response: Optional[Any] = None
+    error: Optional[HttpError] = None
+    deferred: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.deferred
+
+    @property
+    def not_found(self) -> bool:
+        """
+        True when the call failed because the resource (usually the user) doesn't exist
+        """
+        return self.error is not None and self.error.resp.status == 404
+
+    @property
+    def throttled(self) -> bool:
+        """
+        True when the call was rejected by Google's rate limits and can be retried
+        """
+        return self.error is not None and rate_limiter.is_throttled(self.error)
+
+
+def execute_batch(service, requests: Iterable[Tuple[Any, HttpRequest]], batch_size: int = MAX_BATCH_SIZE,
+                  deadline: Optional[deadline_.Deadline] = None) -> List[BatchResult]:
+    """
+    Sends requests built from `service` in batches of up to `batch_size` calls per HTTP round trip and maps every
+    sub-response back to the key it was added with. A failed call doesn't fail the batch, its `HttpError` is returned
+    on its result instead so the caller can hand it to its own failure handling.
+
+    Once `deadline` has expired no new batch is sent, and throttled calls aren't retried. Their results are returned
+    as deferred, for the caller to hand to another invocation.
+
+    :param service: Google API service object the requests were built from
+    :param requests: Pairs of key and unexecuted request
+    :param int batch_size: Maximum number of calls sent in one batch
+    :param deadline: Deadline of the invocation, if batches should stop being sent before it times out
+
+    :return: One result per request, in the order the requests were given
+    :rtype: List[BatchResult]
+    """
+    def expired() -> bool:
+        return deadline is not None and deadline.expired()
+
+    results = []
+    chunk = []
+    for key, request in requests:
+        chunk.append((key, request))
+        if len(chunk) >= batch_size:
+            results.extend(_execute_chunk(service, chunk, expired))
+            chunk = []
+
+    if chunk:
+        results.extend(_execute_chunk(service, chunk, expired))
+
+    return results
+
+
+def _execute_chunk(service, chunk: List[Tuple[Any, HttpRequest]], expired) -> List[BatchResult]:
+    if expired():
+        return [BatchResult(key, deferred=True) for key, _ in chunk]
+
+    results = [BatchResult(key) for key, _ in chunk]
+
+    # No point wrapping a single call in a multipart batch, rate limited requests handle their own throttling
+    if len(chunk) == 1:
+        try:
+            results[0].response = chunk[0][1].execute()
+        except HttpError as e:
+            results[0].error = e
+        return results
+
+    # Every call of a batch counts against the API's quota, so the batch takes one token per call
+    limiter = rate_limiter.get_limiter(getattr(chunk[0][1], 'api', None) or 'default')
+    pending = list(range(len(chunk)))
+    for attempt in range(1, rate_limiter.MAX_ATTEMPTS + 1):
+        limiter.acquire(len(pending))
+        _send_batch(service, chunk, results, pending)
+
+        throttled = [index for index in pending if results[index].throttled]
+        if not throttled:
+            limiter.on_success()
+            break
+        if attempt == rate_limiter.MAX_ATTEMPTS:
+            break
+        if expired():
+            for index in throttled:
+                results[index].error = None
+                results[index].deferred = True
+            break
+
+        delay = max(rate_limiter.retry_delay(results[index].error, attempt) for index in throttled)
+        logger.warning(f"{len(throttled)} of {len(pending)} batched calls throttled, retrying in {delay:.2f}s")
+        limiter.on_throttle(delay)
+        for index in throttled:
+            results[index].error = None
+        pending = throttled
+
+    return results
+
+
+def _send_batch(service, chunk: List[Tuple[Any, HttpRequest]], results: List[BatchResult], pending: List[int]):
+    def callback(request_id, response, exception):
+        result = results[int(request_id)]
+        if exception is not None:
+            result.error = exception
+        else:
+            result.response = response
+
+    batch = service.new_batch_http_request(callback=callback)
+    for index in pending:
+        batch.add(chunk[index][1], request_id=str(index))
+
+    try:
+        batch.execute()
+    except HttpError as e:
+        # The batch itself was rejected, so none of its calls were made
+        logger.error(f"Batch of {len(pending)} requests failed: {e}")
+        for index in pending:
+            if results[index].ok and results[index].response is None:
+                results[index].error = e
@@ -0,0 +1,179 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from acct_decom_utils.google_credentials import google_credentials
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.rate_limiter import rate_limiter
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Seconds before an HTTP request to a Google API is abandoned
+HTTP_TIMEOUT = int(os.getenv('google_http_timeout', 30))
+
+# Number of delegated (per subject) credentials and services kept before the least recently used are dropped
+SUBJECT_CACHE_SIZE = int(os.getenv('google_subject_cache_size', 128))
+
+# Delegated credentials whose token expires within this margin are replaced instead of reused
+EXPIRY_MARGIN = timedelta(seconds=int(os.getenv('google_token_expiry_margin', 300)))
+
+_lock = threading.Lock()
+_credentials: Dict[Tuple[str, ...], object] = {}
+_subject_credentials: 'OrderedDict[Tuple[Tuple[str, ...], str], object]' = OrderedDict()
+_discovery_docs: Dict[Tuple[str, str], str] = {}
+
+# httplib2 connections are not thread safe, so every thread keeps its own pooled transports and services
+_local = threading.local()
+
+
+def get_credentials(scopes: Iterable[str]):
+    """
+    Returns service account credentials for the scopes, loading them from Secrets Manager only once per container
+
+    :param scopes: OAuth scopes the credentials are issued for
+
+    :return: Google service account credentials
+    """
+    key = tuple(sorted(scopes))
+    with _lock:
+        if key not in _credentials:
+            _credentials[key] = google_credentials.GoogleApiCredentials(scopes=list(key)).get_credentials()
+        return _credentials[key]
+
+
+def get_delegated_credentials(scopes: Iterable[str], subject: str):
+    """
+    Returns credentials impersonating `subject`, reusing the ones created for an earlier request for the same user
+    while their token is still valid. Reusing them skips both rebuilding the credentials and the token exchange
+    Google needs for each new delegated token.
+
+    :param scopes: OAuth scopes the credentials are issued for
+    :param str subject: User to impersonate through domain wide delegation
+
+    :return: Delegated Google service account credentials
+    """
+    key = (tuple(sorted(scopes)), subject)
+    with _lock:
+        credentials = _subject_credentials.get(key)
+        if credentials is not None and not is_expiring(credentials):
+            _subject_credentials.move_to_end(key)
+            return credentials
+
+    credentials = get_credentials(scopes).with_subject(subject)
+
+    with _lock:
+        _subject_credentials[key] = credentials
+        _subject_credentials.move_to_end(key)
+        while len(_subject_credentials) > SUBJECT_CACHE_SIZE:
+            _subject_credentials.popitem(last=False)
+
+    return credentials
+
+
+def is_expiring(credentials) -> bool:
+    """
+    :param credentials: Google credentials
+
+    :return: True if the credentials hold a token that has expired or will within `EXPIRY_MARGIN`
+    :rtype: bool
+    """
+    if credentials.expiry is None:
+        # No token minted yet, it will be fetched on first use
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return credentials.expiry - EXPIRY_MARGIN <= now
+
+
+def get_discovery_doc(api: str, version: str) -> str:
+    """
+    Returns the discovery document bundled with `google-api-python-client`, read from disk once per container
+
+    :param str api: API name. e.g "admin"
+    :param str version: API version. e.g "directory_v1"
+
+    :return: Discovery document JSON
+    :rtype: str
+    """
+    key = (api, version)
+    with _lock:
+        if key not in _discovery_docs:
+            doc = discovery_cache.get_static_doc(api, version)
+            if doc is None:
+                raise ValueError(f"No bundled discovery document for {api} {version}")
+            _discovery_docs[key] = doc
+        return _discovery_docs[key]
+
+
+def get_service(api: str, version: str, scopes: Iterable[str], subject: Optional[str] = None):
+    """
+    Returns a Google API service object, reusing one built earlier by this thread when possible. Services are built
+    from the bundled discovery document over a keep-alive authorized transport, so a warm container makes no
+    discovery requests and keeps its connections to Google open between invocations. Services for a delegated
+    subject are kept in a bounded LRU cache and rebuilt once the subject's token is close to expiring.
+
+    :param str api: API name. e.g "admin"
+    :param str version: API version. e.g "directory_v1"
+    :param scopes: OAuth scopes the service needs
+    :param str subject: User to impersonate through domain wide delegation, if any
+
+    :return: Google API service object
+    """
+    if subject:
+        return _get_subject_service(api, version, scopes, subject)
+
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+
+    key = (api, version, tuple(sorted(scopes)))
+    if key not in services:
+        services[key] = build_service(api, version, get_credentials(scopes))
+
+    return services[key]
+
+
+def _get_subject_service(api: str, version: str, scopes: Iterable[str], subject: str):
+    services = getattr(_local, 'subject_services', None)
+    if services is None:
+        services = _local.subject_services = OrderedDict()
+
+    key = (api, version, tuple(sorted(scopes)), subject)
+    credentials = get_delegated_credentials(scopes, subject)
+    cached = services.get(key)
+
+    # A service is only reused while it is bound to the credentials currently cached for the subject
+    if cached is not None and cached[0] is credentials:
+        services.move_to_end(key)
+        return cached[1]
+
+    service = build_service(api, version, credentials)
+    services[key] = (credentials, service)
+    services.move_to_end(key)
+    while len(services) > SUBJECT_CACHE_SIZE:
+        services.popitem(last=False)
+
+    return service
+
+
+def build_service(api: str, version: str, credentials):
+    """
+    Builds a Google API service object from the bundled discovery document. Every request made through the service
+    is paced by the API's rate limiter and retried in-process while Google throttles it.
+
+    :param str api: API name. e.g "admin"
+    :param str version: API version. e.g "directory_v1"
+    :param credentials: Credentials to authorize requests with
+
+    :return: Google API service object
+    """
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    logger.debug(f"Building {api} {version} service")
+    return build_from_document(get_discovery_doc(api, version), http=http,
+                               requestBuilder=rate_limiter.request_builder(api))
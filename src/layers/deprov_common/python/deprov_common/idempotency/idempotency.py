@@ -0,0 +1,141 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+from acct_decom_utils.plnu_logger import plnu_logger
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Ledger of completed (username, step, lambda) work. Without it every record is processed
+TABLE_NAME = os.getenv('idempotency_table')
+
+# Days a completed entry is kept before DynamoDB expires it, long enough to cover every retry of a step
+TTL_DAYS = int(os.getenv('idempotency_ttl_days', 30))
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+_client = None
+
+# Step each user's records were received for, as set by `set_trigger_steps` for the current invocation
+_trigger_steps: Dict[str, Optional[str]] = {}
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = boto3.client('dynamodb')
+    return _client
+
+
+def set_trigger_steps(steps: Mapping[str, Optional[str]]):
+    """
+    Sets the step the invocation's records were published for, as read from the messages that delivered them. Retries
+    carry fresh records whose `next_step` has moved on, so the message's step is what identifies the work.
+
+    :param steps: Step keyed by username, None for users whose step can't be told, which bypass the ledger. Users
+        without an entry fall back to their record's `next_step`
+    """
+    global _trigger_steps
+    _trigger_steps = dict(steps)
+
+
+def ledger_key(record, lambda_name: str) -> Optional[str]:
+    """
+    :param record: User's record
+    :param str lambda_name: Name of the lambda processing the record
+
+    :return: Ledger key of the step the record was received for, `<username>#<step>#<lambda_name>`, or None if the
+        step is unknown
+    :rtype: Optional[str]
+    """
+    if record.username in _trigger_steps:
+        step = _trigger_steps[record.username]
+        if not step:
+            return None
+    else:
+        step = getattr(record, 'next_step', '')
+    return f"{record.username}#{step}#{lambda_name}"
+
+
+def split_completed(records: Sequence, lambda_name: str) -> Tuple[List, List]:
+    """
+    Looks the records up in the ledger with `BatchGetItem` and separates the ones the lambda has already completed
+    for the step they were received for. Lookup errors are logged and the records are treated as not completed, the
+    ledger only saves work. Records whose step is unknown are always processed.
+
+    :param records: Records received by the lambda
+    :param str lambda_name: Name of the lambda processing the records
+
+    :return: Records still to process and records already completed, each in the order received
+    :rtype: Tuple[List, List]
+    """
+    if not TABLE_NAME or not records:
+        return list(records), []
+
+    keys = list({ledger_key(record, lambda_name) for record in records} - {None})
+    completed: Set[str] = set()
+    try:
+        for start in range(0, len(keys), BATCH_GET_SIZE):
+            completed.update(_get_completed(keys[start:start + BATCH_GET_SIZE]))
+    except Exception as e:
+        logger.error(f"Failed to read the idempotency ledger, processing every record: {e}")
+        return list(records), []
+
+    pending = [record for record in records if ledger_key(record, lambda_name) not in completed]
+    done = [record for record in records if ledger_key(record, lambda_name) in completed]
+    if done:
+        logger.info(f"Skipping {len(done)} records already completed by {lambda_name}")
+    return pending, done
+
+
+def mark_completed(record, lambda_name: str):
+    """
+    Records that the lambda completed the step the record was received for. The put is conditional on the entry not
+    existing, so the first completion and its expiry are kept when the same work is reported twice.
+
+    :param record: User's record
+    :param str lambda_name: Name of the lambda that completed the record
+    """
+    key = ledger_key(record, lambda_name)
+    if not TABLE_NAME or not key:
+        return
+
+    expires_at = datetime.now(timezone.utc) + timedelta(days=TTL_DAYS)
+    try:
+        get_client().put_item(
+            TableName=TABLE_NAME,
+            Item={
+                'idempotency_key': {'S': key},
+                'completed_at': {'S': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')},
+                'expires_at': {'N': str(int(expires_at.timestamp()))}
+            },
+            ConditionExpression='attribute_not_exists(idempotency_key)'
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return
+        logger.error(f"Failed to record completion of {lambda_name} for {record.username}: {err}")
+    except Exception as e:
+        logger.error(f"Failed to record completion of {lambda_name} for {record.username}: {e}")
+
+
+def _get_completed(keys: List[str], max_attempts: int = 5) -> Set[str]:
+    request = {TABLE_NAME: {'Keys': [{'idempotency_key': {'S': key}} for key in keys],
+                            'ProjectionExpression': 'idempotency_key'}}
+    completed = set()
+    for attempt in range(1, max_attempts + 1):
+        response = get_client().batch_get_item(RequestItems=request)
+        for item in response.get('Responses', {}).get(TABLE_NAME, []):
+            completed.add(item['idempotency_key']['S'])
+
+        request = response.get('UnprocessedKeys')
+        if not request:
+            return completed
+        time.sleep(0.05 * 2 ** attempt)
+
+    raise RuntimeError(f"Couldn't read {len(request[TABLE_NAME]['Keys'])} ledger entries after {max_attempts} attempts")
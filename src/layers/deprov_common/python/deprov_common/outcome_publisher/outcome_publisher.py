@@ -0,0 +1,131 @@
+import functools
+import json
+import os
+import threading
+from typing import Dict, List, Sequence
+
+import boto3
+from acct_decom_utils.failed_lambda_processing import handle_success as success_handler
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.idempotency import idempotency
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Opt-in: when disabled every success is published straight away by `acct_decom_utils`
+BUFFER_OUTCOMES = os.getenv('buffer_outcomes', 'false').lower() == 'true'
+
+# PublishBatch accepts at most 10 entries per call
+PUBLISH_BATCH_SIZE = 10
+CLEAR_FAILURE_TYPE = 'clear'
+
+sns = boto3.client('sns')
+
+_lock = threading.Lock()
+_buffers: Dict[str, List[dict]] = {}
+
+
+def handle_success(record, lambda_name: str, sns_arn: str):
+    """
+    Drop-in replacement for `acct_decom_utils`' `handle_success`. With `buffer_outcomes` enabled the `clear` message
+    is buffered and sent with up to 9 others in a single `PublishBatch` call, once the buffer is full or the handler
+    returns (see `buffered`). The success is also written to the idempotency ledger, so redeliveries of the same step
+    are skipped by `skip_completed`.
+
+    :param record: User's record
+    :param str lambda_name: Name of the lambda the record succeeded for
+    :param str sns_arn: ARN of the failure topic
+    """
+    idempotency.mark_completed(record, lambda_name)
+    _report_success(record, lambda_name, sns_arn)
+
+
+def skip_completed(records: Sequence, lambda_name: str, sns_arn: str) -> List:
+    """
+    Drops records the lambda already completed for the step they were received for, according to the idempotency
+    ledger. Their success is reported again without calling any external API, which clears failure state left by the
+    redelivery.
+
+    :param records: Records received by the lambda
+    :param str lambda_name: Name of the lambda processing the records
+    :param str sns_arn: ARN of the failure topic
+
+    :return: Records still to process
+    :rtype: List
+    """
+    pending, completed = idempotency.split_completed(records, lambda_name)
+    for record in completed:
+        _report_success(record, lambda_name, sns_arn)
+    return pending
+
+
+def flush():
+    """
+    Publishes every buffered message
+    """
+    with _lock:
+        pending = {sns_arn: buffer for sns_arn, buffer in _buffers.items() if buffer}
+        _buffers.clear()
+
+    for sns_arn, buffer in pending.items():
+        for start in range(0, len(buffer), PUBLISH_BATCH_SIZE):
+            _publish(sns_arn, buffer[start:start + PUBLISH_BATCH_SIZE])
+
+
+def buffered(handler):
+    """
+    Decorates a lambda handler so buffered outcomes are flushed when it returns or raises
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush()
+
+    return wrapper
+
+
+def _report_success(record, lambda_name: str, sns_arn: str):
+    if not BUFFER_OUTCOMES:
+        success_handler.handle_success(record, lambda_name, sns_arn)
+        return
+
+    # remove_failure_state only reads the username and lambda name
+    entry = {
+        'Message': json.dumps({'username': record.username, 'lambda_name': lambda_name}),
+        'MessageAttributes': {
+            'failure_type': {
+                'DataType': 'String',
+                'StringValue': CLEAR_FAILURE_TYPE
+            }
+        }
+    }
+
+    with _lock:
+        buffer = _buffers.setdefault(sns_arn, [])
+        buffer.append(entry)
+        if len(buffer) < PUBLISH_BATCH_SIZE:
+            return
+        _buffers[sns_arn] = []
+
+    _publish(sns_arn, buffer)
+
+
+def _publish(sns_arn: str, entries: List[dict]):
+    batch = [{'Id': str(index), **entry} for index, entry in enumerate(entries)]
+    try:
+        response = sns.publish_batch(TopicArn=sns_arn, PublishBatchRequestEntries=batch)
+    except Exception as e:
+        logger.error(f"Failed to publish batch of {len(batch)} outcomes, publishing them one by one: {e}")
+        failed_ids = [entry['Id'] for entry in batch]
+    else:
+        failed_ids = [failure['Id'] for failure in response.get('Failed', [])]
+
+    for entry in batch:
+        if entry['Id'] not in failed_ids:
+            continue
+        try:
+            sns.publish(TargetArn=sns_arn, Message=entry['Message'], MessageAttributes=entry['MessageAttributes'])
+        except Exception as e:
+            logger.error(f"Failed to publish outcome {entry['Message']}: {e}")
@@ -0,0 +1,219 @@
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Callable, Dict, Optional, TypeVar
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from acct_decom_utils.plnu_logger import plnu_logger
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Requests per second allowed per API before Google has to throttle us. Override with the `google_rate_limits`
+# env var, a JSON object of API name to rate. e.g {"admin": 40, "gmail": 5}
+DEFAULT_RATES = {
+    'admin': 25.0,
+    'gmail': 10.0,
+    'licensing': 5.0
+}
+DEFAULT_RATE = float(os.getenv('google_rate_limit', 10))
+RATES = {**DEFAULT_RATES, **json.loads(os.getenv('google_rate_limits', '{}'))}
+
+# Attempts made for a throttled call before its error is raised to the caller
+MAX_ATTEMPTS = int(os.getenv('google_max_attempts', 5))
+
+# Longest single wait, in seconds, so retries stay well within the lambda timeout
+MAX_BACKOFF = float(os.getenv('google_max_backoff', 20))
+BASE_BACKOFF = 0.5
+
+# Throttling halves the allowed rate, every successful call wins back a small share of the configured rate
+DECREASE_FACTOR = 0.5
+INCREASE_FACTOR = 0.05
+MIN_RATE_FACTOR = 0.05
+
+THROTTLED_STATUSES = {429, 503}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket whose refill rate adapts to throttling (additive increase, multiplicative decrease).
+    Once Google asks us to back off, every caller waits until the backoff has passed, not just the throttled one.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.max_rate = rate
+        self.min_rate = rate * MIN_RATE_FACTOR
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """
+        Blocks until `tokens` can be taken from the bucket. Asking for more than the burst size waits for a full bucket
+        and leaves it in debt, so large batches are paced rather than refused.
+
+        :param float tokens: Number of calls about to be made
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    needed = min(tokens, self.burst)
+                    if self._tokens >= needed:
+                        self._tokens -= tokens
+                        return
+                    wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * INCREASE_FACTOR)
+
+    def on_throttle(self, delay: float):
+        """
+        Lowers the rate and pauses every caller of the bucket for `delay` seconds
+
+        :param float delay: Seconds to wait before the next call
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            self._tokens = min(self._tokens, 0)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+
+_lock = threading.Lock()
+_limiters: Dict[str, TokenBucket] = {}
+
+
+def get_limiter(api: str) -> TokenBucket:
+    """
+    Returns the bucket shared by every call to `api` made from this container
+
+    :param str api: API name. e.g "admin"
+
+    :return: The API's token bucket
+    :rtype: TokenBucket
+    """
+    with _lock:
+        if api not in _limiters:
+            _limiters[api] = TokenBucket(float(RATES.get(api, DEFAULT_RATE)))
+        return _limiters[api]
+
+
+def is_throttled(error: HttpError) -> bool:
+    """
+    :param error: Error returned by a Google API call
+
+    :return: True if the call was rejected because of rate limits or a temporary outage and is worth retrying
+    :rtype: bool
+    """
+    status = error.resp.status
+    if status in THROTTLED_STATUSES:
+        return True
+    return status == 403 and bool(_error_reasons(error) & RATE_LIMIT_REASONS)
+
+
+def retry_delay(error: HttpError, attempt: int) -> float:
+    """
+    Seconds to wait before retrying a throttled call. Google's `Retry-After` is honored when present, otherwise the
+    delay is an exponential backoff with full jitter.
+
+    :param error: Error returned by the throttled call
+    :param int attempt: Number of attempts made so far
+
+    :return: Delay in seconds, never more than `MAX_BACKOFF`
+    :rtype: float
+    """
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return min(MAX_BACKOFF, retry_after)
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+def call_with_backoff(api: str, call: Callable[[], T]) -> T:
+    """
+    Makes a Google API call through the API's rate limiter, retrying it in-process while Google throttles it
+
+    :param str api: API name. e.g "admin"
+    :param call: Function making a single API call
+
+    :return: Whatever `call` returns
+    """
+    limiter = get_limiter(api)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        limiter.acquire()
+        try:
+            response = call()
+        except HttpError as e:
+            if attempt == MAX_ATTEMPTS or not is_throttled(e):
+                raise
+            delay = retry_delay(e, attempt)
+            logger.warning(f"{api} call throttled with {e.resp.status}, retrying in {delay:.2f}s")
+            limiter.on_throttle(delay)
+            continue
+        limiter.on_success()
+        return response
+
+
+class RateLimitedHttpRequest(HttpRequest):
+    """
+    `HttpRequest` whose `execute` goes through the rate limiter of the API it belongs to. Services built with
+    `request_builder` create these for every method call.
+    """
+
+    def __init__(self, *args, api: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.api = api
+
+    def execute(self, http=None, num_retries=0):
+        return call_with_backoff(self.api, lambda: super(RateLimitedHttpRequest, self).execute(
+            http=http, num_retries=num_retries))
+
+
+def request_builder(api: str):
+    """
+    :param str api: API name. e.g "admin"
+
+    :return: `requestBuilder` for `build_from_document` creating rate limited requests for the API
+    """
+    return partial(RateLimitedHttpRequest, api=api)
+
+
+def _error_reasons(error: HttpError):
+    try:
+        content = json.loads(error.content.decode('utf-8'))
+        return {detail.get('reason') for detail in content.get('error', {}).get('errors', [])}
+    except (ValueError, AttributeError):
+        return set()
+
+
+def _retry_after(error: HttpError) -> Optional[float]:
+    value = error.resp.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+from acct_decom_utils.plnu_logger import plnu_logger
+from deprov_common.deadline import deadline as deadline_
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Records processed at the same time by one invocation. Calls are I/O bound, so this is about how much load the
+# downstream APIs can take rather than the lambda's CPU
+RECORD_CONCURRENCY = int(os.getenv('record_concurrency', 8))
+
+# Worker threads live as long as the container, so what they cache per thread (e.g Google API services) is reused by
+# later invocations
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+@dataclass
+class RecordOutcome:
+    """
+    Outcome of processing one record. `error` holds the exception raised for the record, if any, and `deferred` is
+    set for records that weren't started because the invocation was running out of time.
+    """
+    record: Any
+    result: Any = None
+    error: Optional[BaseException] = None
+    deferred: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.deferred
+
+
+def process_records(records: Sequence[Any], process: Callable[[Any], Any], concurrency: int = RECORD_CONCURRENCY,
+                    deadline: Optional[deadline_.Deadline] = None) -> Iterator[RecordOutcome]:
+    """
+    Runs `process` for every record on a bounded thread pool. Outcomes are yielded as records complete, so the caller
+    can keep handling success and failure per record from the handler's thread.
+    An exception raised for one record is returned on its outcome and doesn't affect the others.
+
+    Once `deadline` has expired no new record is started. Records in flight are finished and the rest are yielded as
+    deferred, for the caller to hand to `deadline.defer_records`.
+
+    :param records: Records to process
+    :param process: Function processing a single record
+    :param int concurrency: Maximum number of records processed at once, no more than `RECORD_CONCURRENCY`
+    :param deadline: Deadline of the invocation, if records should stop being started before it times out
+
+    :return: One outcome per record
+    :rtype: Iterator[RecordOutcome]
+    """
+    def run(record) -> RecordOutcome:
+        try:
+            return RecordOutcome(record, result=process(record))
+        except Exception as e:
+            return RecordOutcome(record, error=e)
+
+    def expired() -> bool:
+        return deadline is not None and deadline.expired()
+
+    workers = max(1, min(concurrency, RECORD_CONCURRENCY, len(records)))
+    remaining = deque(records)
+
+    if workers == 1:
+        while remaining and not expired():
+            yield run(remaining.popleft())
+    else:
+        logger.debug(f"Processing {len(records)} records with {workers} workers")
+        executor = get_executor()
+        in_flight = set()
+        while remaining or in_flight:
+            # Only as many records as there are workers are submitted, so the deadline is checked before each one
+            while remaining and len(in_flight) < workers and not expired():
+                in_flight.add(executor.submit(run, remaining.popleft()))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    for record in remaining:
+        yield RecordOutcome(record, deferred=True)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    :return: The thread pool shared by every invocation of the container, created on first use
+    :rtype: ThreadPoolExecutor
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=RECORD_CONCURRENCY, thread_name_prefix='record')
+        return _executor
@@ -0,0 +1,178 @@
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from acct_decom_utils.event_table import event_table
+from acct_decom_utils.plnu_logger import plnu_logger
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# SNS caps a message, attributes included, at 256 KiB. Keep some room for the attributes.
+SNS_MAX_BYTES = 256 * 1024
+MAX_MESSAGE_BYTES = SNS_MAX_BYTES - 2 * 1024
+
+# PublishBatch accepts at most 10 entries, and their combined size is held to the same budget as a single message
+PUBLISH_BATCH_SIZE = 10
+
+# Bytes added around the escaped record list by `{"default": "[...]"}`
+_ENVELOPE_BYTES = len(json.dumps({'default': '[]'}))
+_SEPARATOR_BYTES = len(json.dumps(', ')) - 2
+
+
+def encoded_size(record) -> int:
+    """
+    Number of bytes a record adds to a `MessageStructure='json'` message, once JSON encoded as part of the record list
+    and escaped again into the `default` string.
+
+    :param record: Record to measure
+
+    :return: Encoded size in bytes
+    :rtype: int
+    """
+    return len(json.dumps(json.dumps(record, cls=event_table.EventTableRecordEncoder))) - 2
+
+
+def pack_records(records: Iterable, max_bytes: int = MAX_MESSAGE_BYTES) -> Iterator[List]:
+    """
+    Groups records into lists that each fit in a single SNS message, measured in encoded bytes rather than record
+    count. Records are consumed lazily, so only one message worth of records is held at a time.
+
+    :param records: Records to pack
+    :param int max_bytes: Size budget for each message
+
+    :return: Iterator of record lists
+    """
+    batch = []
+    batch_bytes = _ENVELOPE_BYTES
+    for record in records:
+        size = encoded_size(record)
+        added = size + (_SEPARATOR_BYTES if batch else 0)
+        if batch and batch_bytes + added > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = _ENVELOPE_BYTES
+            added = size
+        if _ENVELOPE_BYTES + size > max_bytes:
+            logger.warning(f"Record of {size} bytes exceeds the SNS message budget of {max_bytes} bytes")
+        batch.append(record)
+        batch_bytes += added
+
+    if batch:
+        yield batch
+
+
+def build_message(records: List) -> str:
+    """
+    :param records: Records to send
+
+    :return: Message body for a `MessageStructure='json'` publish
+    :rtype: str
+    """
+    return json.dumps({'default': json.dumps(records, cls=event_table.EventTableRecordEncoder)})
+
+
+def message_attributes(step: str, origin_step: Optional[str] = None) -> dict:
+    """
+    :param str step: Value of the `step` attribute used by subscription filter policies
+    :param str origin_step: Step the records were first published for, when they are sent again to a single lambda
+
+    :return: Message attributes for a publish
+    :rtype: dict
+    """
+    attributes = {
+        'step': {
+            'DataType': 'String',
+            'StringValue': f'{step}'
+        }
+    }
+    if origin_step:
+        attributes['origin_step'] = {
+            'DataType': 'String',
+            'StringValue': f'{origin_step}'
+        }
+    return attributes
+
+
+def publish_records(sns, topic_arn: str, records: Iterable, step: str, max_bytes: int = MAX_MESSAGE_BYTES,
+                    origin_step: Optional[str] = None) -> int:
+    """
+    Publishes records to a topic in as many size bounded messages as needed, tagged with the `step` attribute used by
+    subscription filter policies.
+
+    :param sns: boto3 SNS client
+    :param str topic_arn: Topic to publish to
+    :param records: Records to publish, consumed lazily
+    :param str step: Value of the `step` message attribute
+    :param int max_bytes: Size budget for each message
+    :param str origin_step: Value of the `origin_step` message attribute, if any
+
+    :return: Number of records published
+    :rtype: int
+    """
+    published = 0
+    for batch in pack_records(records, max_bytes):
+        sns.publish(
+            TargetArn=topic_arn,
+            Message=build_message(batch),
+            MessageStructure='json',
+            MessageAttributes=message_attributes(step, origin_step)
+        )
+        published += len(batch)
+
+    return published
+
+
+def publish_grouped_records(sns, topic_arn: str, records_by_step: Mapping[Union[str, Tuple[str, str]], Iterable],
+                            max_bytes: int = MAX_MESSAGE_BYTES) -> Dict[Union[str, Tuple[str, str]], int]:
+    """
+    Publishes several groups of records, each tagged with its own `step` attribute, in as few calls as possible.
+    Every group is packed into size bounded messages, and messages are sent up to 10 at a time with `PublishBatch`
+    while their combined size stays within `max_bytes`.
+
+    :param sns: boto3 SNS client
+    :param str topic_arn: Topic to publish to
+    :param records_by_step: Records to publish keyed by the value of their `step` message attribute, or by a
+        `(step, origin_step)` pair to also tag them with the step they were first published for
+    :param int max_bytes: Size budget for each message, and for all messages of one `PublishBatch` call
+
+    :return: Number of records published, keyed like `records_by_step`
+    :rtype: Dict[Union[str, Tuple[str, str]], int]
+    """
+    published = {key: 0 for key in records_by_step}
+    entries = []
+    entries_bytes = 0
+    for key, records in records_by_step.items():
+        step, origin_step = key if isinstance(key, tuple) else (key, None)
+        for batch in pack_records(records, max_bytes):
+            entry = {
+                'Message': build_message(batch),
+                'MessageStructure': 'json',
+                'MessageAttributes': message_attributes(step, origin_step)
+            }
+            entry_bytes = len(entry['Message'].encode('utf-8')) + len(f'{step}{origin_step or ""}'.encode('utf-8'))
+            if entries and (len(entries) == PUBLISH_BATCH_SIZE or entries_bytes + entry_bytes > max_bytes):
+                _publish_batch(sns, topic_arn, entries)
+                entries = []
+                entries_bytes = 0
+            entries.append(entry)
+            entries_bytes += entry_bytes
+            published[key] += len(batch)
+
+    if entries:
+        _publish_batch(sns, topic_arn, entries)
+
+    return published
+
+
+def _publish_batch(sns, topic_arn: str, entries: List[dict]):
+    batch = [{'Id': str(index), **entry} for index, entry in enumerate(entries)]
+    response = sns.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=batch)
+
+    # Entries SNS couldn't take are sent on their own, a failure there is left to the caller
+    failed_ids = {failure['Id'] for failure in response.get('Failed', [])}
+    for entry in batch:
+        if entry['Id'] in failed_ids:
+            logger.warning(f"Batched publish of entry {entry['Id']} failed, publishing it on its own")
+            sns.publish(TargetArn=topic_arn, Message=entry['Message'], MessageStructure='json',
+                        MessageAttributes=entry['MessageAttributes'])
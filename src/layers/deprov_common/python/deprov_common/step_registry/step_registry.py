@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, Iterator, Mapping, Optional
+
+import boto3
+from acct_decom_utils.plnu_logger import plnu_logger
+
+STEP_PARAM_PATH = '/deprovisioning/steps'
+
+# Seconds a loaded step graph is trusted before SSM is asked for the current parameter versions again
+DEFAULT_TTL_SECONDS = 300
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+
+@dataclass(frozen=True)
+class Step:
+    """
+    A single deprovisioning step as stored under `/deprovisioning/steps/<account_type>/<name>`
+    """
+    account_type: str
+    name: str
+    previous_step: str
+    next_step: str
+    next_step_delay: int
+    version: int
+
+
+class StepGraph:
+    """
+    Immutable, parsed view of every step parameter, keyed by account type and then step name
+    """
+
+    def __init__(self, steps: Dict[str, Dict[str, Step]], fingerprint: str):
+        self._steps = MappingProxyType({acct_type: MappingProxyType(dict(acct_steps))
+                                        for acct_type, acct_steps in steps.items()})
+        self.fingerprint = fingerprint
+
+    def account_types(self):
+        """
+        :return: Account types that have at least one step configured
+        """
+        return self._steps.keys()
+
+    def steps(self, account_type: str) -> Mapping[str, Step]:
+        """
+        :param str account_type: The type of account. e.g "employee" or "student"
+
+        :return: Read-only mapping of step name to step for the account type
+        """
+        return self._steps.get(account_type, MappingProxyType({}))
+
+    def get(self, account_type: str, step_name: str) -> Optional[Step]:
+        """
+        :param str account_type: The type of account. e.g "employee" or "student"
+        :param str step_name: Name of the step. e.g "emp-1"
+
+        :return: The matching step, or None if it is not configured
+        """
+        return self.steps(account_type).get(step_name)
+
+    def __iter__(self) -> Iterator[Step]:
+        for acct_steps in self._steps.values():
+            yield from acct_steps.values()
+
+
+# This class is a singleton so every invocation in a warm container shares one cached step graph
+class StepRegistry:
+    __instance = None
+
+    def __new__(cls):
+        if cls.__instance is None:
+            cls.__instance = super(StepRegistry, cls).__new__(cls)
+            cls.__instance._initialized = False
+        return cls.__instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._initialized = True
+        self.ttl = int(os.getenv('step_registry_ttl', DEFAULT_TTL_SECONDS))
+        self._ssm = boto3.client('ssm')
+        self._lock = threading.Lock()
+        self._graph: Optional[StepGraph] = None
+        self._checked_at = 0.0
+
+    def get_graph(self) -> StepGraph:
+        """
+        Returns the cached step graph, refreshing it from SSM once the TTL has passed. A refresh only re-parses the
+        parameters when their name/version fingerprint has changed, and falls back to the cached graph if SSM can't
+        be reached.
+
+        :return: The current step graph
+        :rtype: StepGraph
+        """
+        with self._lock:
+            if self._graph is not None and time.monotonic() - self._checked_at < self.ttl:
+                return self._graph
+
+            try:
+                parameters = self._fetch_parameters()
+            except Exception as e:
+                if self._graph is None:
+                    raise
+                logger.warning(f"Failed to refresh step parameters, using cached steps: {e}")
+                self._checked_at = time.monotonic()
+                return self._graph
+
+            fingerprint = self._fingerprint(parameters)
+            if self._graph is None or self._graph.fingerprint != fingerprint:
+                self._graph = self._parse(parameters, fingerprint)
+                logger.info(f"Loaded step graph {fingerprint[:12]} with {len(parameters)} steps")
+            self._checked_at = time.monotonic()
+            return self._graph
+
+    def _fetch_parameters(self):
+        parameters = []
+        paginator = self._ssm.get_paginator('get_parameters_by_path')
+
+        # Handle pagination
+        for page in paginator.paginate(Path=STEP_PARAM_PATH, Recursive=True):
+            parameters.extend(page['Parameters'])
+
+        return parameters
+
+    @staticmethod
+    def _fingerprint(parameters) -> str:
+        versions = sorted(f"{parameter.get('Name')}:{parameter.get('Version')}" for parameter in parameters)
+        return hashlib.sha256('\n'.join(versions).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _parse(parameters, fingerprint: str) -> StepGraph:
+        steps: Dict[str, Dict[str, Step]] = {}
+        for parameter in parameters:
+            param_parts = parameter.get('Name').split('/')
+            step_name = param_parts[-1]
+            acct_type = param_parts[-2]
+            value = json.loads(parameter.get('Value'))
+
+            steps.setdefault(acct_type, {})[step_name] = Step(
+                account_type=acct_type,
+                name=step_name,
+                previous_step=value.get('previous_step'),
+                next_step=value.get('next_step'),
+                next_step_delay=int(value.get('next_step_delay')),
+                version=int(parameter.get('Version', 0))
+            )
+
+        return StepGraph(steps, fingerprint)
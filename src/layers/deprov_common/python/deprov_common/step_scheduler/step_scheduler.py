@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from acct_decom_utils.event_table import event_table
+from acct_decom_utils.plnu_logger import plnu_logger
+
+log_level = os.getenv('log_level', 'INFO')
+logger = plnu_logger.PLNULogger(log_level).get_logger()
+
+# Without these, users are only picked up by the reconciliation run of `get_records_to_process`
+SCHEDULE_GROUP = os.getenv('step_schedule_group')
+TARGET_ARN = os.getenv('step_schedule_target_arn')
+ROLE_ARN = os.getenv('step_schedule_role_arn')
+
+# Queue read by `schedule_steps`, for callers that can't wait for every schedule to be created
+QUEUE_URL = os.getenv('step_schedule_queue_url')
+
+# Steps are due from midnight UTC of their `next_step_date`, the same way `next_step-index` is queried
+SCHEDULE_TIMEZONE = 'UTC'
+AT_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Steps already due are triggered shortly after being scheduled, a one-time schedule in the past never fires
+MIN_LEAD = timedelta(minutes=1)
+
+# Schedule names are limited to 64 characters out of [0-9a-zA-Z-_.]
+MAX_NAME_LENGTH = 64
+_INVALID_NAME_CHARS = re.compile(r'[^0-9a-zA-Z\-_.]')
+
+# Schedules created at the same time, each user is a separate CreateSchedule call
+SCHEDULE_CONCURRENCY = int(os.getenv('step_schedule_concurrency', 8))
+
+# Users per queued message, and messages per SendMessageBatch call (at most 10)
+STEPS_PER_MESSAGE = 100
+SEND_BATCH_SIZE = 10
+
+_client = None
+_sqs = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = boto3.client('scheduler', config=Config(max_pool_connections=max(10, SCHEDULE_CONCURRENCY),
+                                                          retries={'mode': 'adaptive', 'max_attempts': 5}))
+    return _client
+
+
+def get_sqs():
+    global _sqs
+    if _sqs is None:
+        _sqs = boto3.client('sqs')
+    return _sqs
+
+
+def enabled() -> bool:
+    return bool(SCHEDULE_GROUP and TARGET_ARN and ROLE_ARN)
+
+
+def schedule_name(username: str, step: str, step_date: str) -> str:
+    """
+    :param str username: User to trigger
+    :param str step: Step to trigger
+    :param str step_date: Date the step is due
+
+    :return: Name of the user's schedule for the step, unique per user, step and date so a user inserted again with
+        another date gets a schedule of their own
+    :rtype: str
+    """
+    key = f"{username}.{step}.{step_date}"
+    name = _INVALID_NAME_CHARS.sub('_', key)
+    if len(name) <= MAX_NAME_LENGTH:
+        return name
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return f"{name[:MAX_NAME_LENGTH - len(digest) - 1]}.{digest}"
+
+
+def schedule_step(username: str, step: str, step_date: str, now: Optional[datetime] = None) -> bool:
+    """
+    Creates a one-time EventBridge Scheduler schedule that triggers `get_records_to_process` for just this user once
+    `step_date` comes, and deletes itself afterwards. Scheduling the same user, step and date again is a no-op.
+    Errors are logged rather than raised, the nightly reconciliation run picks up users whose schedule is missing.
+
+    :param str username: User to trigger
+    :param str step: Step the user is waiting on. e.g "emp-1"
+    :param str step_date: The user's `next_step_date`
+    :param datetime now: Current time, defaults to now
+
+    :return: True if the user is scheduled
+    :rtype: bool
+    """
+    if not enabled():
+        return False
+
+    try:
+        due = datetime.strptime(step_date, event_table.TIMESTAMP_STR_FORMAT).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError) as e:
+        logger.error(f"Can't schedule {username} for {step}, invalid step date {step_date}: {e}")
+        return False
+    due = max(due, (now or datetime.now(timezone.utc)) + MIN_LEAD)
+
+    try:
+        get_client().create_schedule(
+            Name=schedule_name(username, step, step_date),
+            GroupName=SCHEDULE_GROUP,
+            ScheduleExpression=f"at({due.strftime(AT_FORMAT)})",
+            ScheduleExpressionTimezone=SCHEDULE_TIMEZONE,
+            FlexibleTimeWindow={'Mode': 'OFF'},
+            ActionAfterCompletion='DELETE',
+            Target={
+                'Arn': TARGET_ARN,
+                'RoleArn': ROLE_ARN,
+                'Input': json.dumps({'username': username, 'step': step})
+            }
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConflictException':
+            logger.info(f"{username} is already scheduled for {step} on {step_date}")
+            return True
+        logger.error(f"Failed to schedule {username} for {step}: {err}")
+        return False
+
+    logger.info(f"Scheduled {username} for {step} at {due.strftime(AT_FORMAT)}")
+    return True
+
+
+def schedule_steps(steps: Iterable[Tuple[str, str, str]]) -> int:
+    """
+    Schedules several users at the same time, bounded by `step_schedule_concurrency`, see `schedule_step`
+
+    :param steps: Username, step and step date of each user
+
+    :return: Number of users scheduled
+    :rtype: int
+    """
+    if not enabled():
+        return 0
+
+    steps = list(steps)
+    if not steps:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    get_client()
+    with ThreadPoolExecutor(max_workers=max(1, min(SCHEDULE_CONCURRENCY, len(steps)))) as executor:
+        return sum(executor.map(lambda step: schedule_step(*step, now=now), steps))
+
+
+def enqueue_steps(steps: Iterable[Tuple[str, str, str]]) -> int:
+    """
+    Hands users to the `schedule_steps` lambda through its queue instead of scheduling them here, 100 users per
+    message and 10 messages per `SendMessageBatch` call. Without a queue configured, users are scheduled straight away.
+    Users whose message can't be sent are logged and left to the nightly reconciliation run.
+
+    :param steps: Username, step and step date of each user
+
+    :return: Number of users queued
+    :rtype: int
+    """
+    if not enabled():
+        return 0
+    if not QUEUE_URL:
+        return schedule_steps(steps)
+
+    steps = [list(step) for step in steps]
+    messages = [steps[start:start + STEPS_PER_MESSAGE] for start in range(0, len(steps), STEPS_PER_MESSAGE)]
+    queued = 0
+    for start in range(0, len(messages), SEND_BATCH_SIZE):
+        entries = [{'Id': str(index), 'MessageBody': json.dumps(message)}
+                   for index, message in enumerate(messages[start:start + SEND_BATCH_SIZE])]
+        try:
+            response = get_sqs().send_message_batch(QueueUrl=QUEUE_URL, Entries=entries)
+        except ClientError as err:
+            logger.error(f"Failed to queue {len(entries)} schedule messages: {err}")
+            continue
+        failed_ids = {failure['Id'] for failure in response.get('Failed', [])}
+        for entry in entries:
+            count = len(json.loads(entry['MessageBody']))
+            if entry['Id'] in failed_ids:
+                logger.error(f"Failed to queue {count} users for scheduling")
+            else:
+                queued += count
+
+    return queued
+
+
+def scheduled_target(event) -> Optional[Tuple[str, str]]:
+    """
+    :param event: The event data passed to `get_records_to_process`
+
+    :return: Username and step of a scheduled trigger, or None for the reconciliation run
+    :rtype: Optional[Tuple[str, str]]
+    """
+    if isinstance(event, dict) and event.get('username') and event.get('step'):
+        return event['username'], event['step']
+    return None
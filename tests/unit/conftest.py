@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import sys
+import types
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path.insert(0, os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python"))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+
+def _stub_acct_decom_utils():
+    """
+    Registers a minimal stand-in for the private `acct_decom_utils` package, covering what the lambdas and the shared
+    layer import, so the unit tests run without access to its repository
+    """
+    def module(name, **attributes):
+        stub = types.ModuleType(name)
+        stub.__dict__.update(attributes)
+        sys.modules[name] = stub
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, stub)
+        return stub
+
+    class EventTableRecord:
+        def __init__(self, **attributes):
+            self.__dict__.update(attributes)
+
+    class EventTableRecordDecoder(json.JSONDecoder):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, object_hook=self.decode_record, **kwargs)
+
+        @staticmethod
+        def decode_record(value):
+            return EventTableRecord(**value) if 'username' in value else value
+
+    class EventTableRecordEncoder(json.JSONEncoder):
+        def default(self, o):
+            if isinstance(o, EventTableRecord):
+                return o.__dict__
+            return super().default(o)
+
+    class PLNULogger:
+        def __init__(self, level):
+            self.logger = logging.getLogger('acct_decom_utils')
+
+        def get_logger(self):
+            return self.logger
+
+    class AcctDeprovException(Exception):
+        def __init__(self, msg, record=None, *args):
+            super().__init__(msg)
+            self.record = record
+
+    def deprovisioning_action(sns_arn, lambda_name):
+        return lambda function: function
+
+    module('acct_decom_utils')
+    module('acct_decom_utils.event_table')
+    module('acct_decom_utils.event_table.event_table', TIMESTAMP_STR_FORMAT='%Y-%m-%d',
+           EventTableRecord=EventTableRecord, EventTableRecordDecoder=EventTableRecordDecoder,
+           EventTableRecordEncoder=EventTableRecordEncoder, EventTable=object)
+    module('acct_decom_utils.plnu_logger')
+    module('acct_decom_utils.plnu_logger.plnu_logger', PLNULogger=PLNULogger)
+    module('acct_decom_utils.exceptions')
+    module('acct_decom_utils.exceptions.exceptions', AcctDeprovException=AcctDeprovException,
+           RetryException=type('RetryException', (AcctDeprovException,), {}),
+           TerminalException=type('TerminalException', (AcctDeprovException,), {}),
+           GoogleAcctDeprovException=type('GoogleAcctDeprovException', (AcctDeprovException,), {}),
+           GoogleRetryException=type('GoogleRetryException', (AcctDeprovException,), {}),
+           GoogleTerminalException=type('GoogleTerminalException', (AcctDeprovException,), {}),
+           InsertException=type('InsertException', (Exception,), {}))
+    module('acct_decom_utils.failed_lambda_processing')
+    module('acct_decom_utils.failed_lambda_processing.deprovisioning_action_wrapper',
+           deprovisioning_action=deprovisioning_action)
+    module('acct_decom_utils.failed_lambda_processing.handle_success',
+           handle_success=lambda record, lambda_name, sns_arn: None)
+    module('acct_decom_utils.google_credentials')
+    module('acct_decom_utils.google_credentials.google_credentials', GoogleApiCredentials=object)
+
+
+try:
+    import acct_decom_utils  # noqa: F401
+except ImportError:
+    _stub_acct_decom_utils()
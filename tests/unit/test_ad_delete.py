@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path[:0] = [os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python"),
+                os.path.join(BASE_PATH, "src", "actions", "ad_delete_entry", "src"),
+                os.path.join(BASE_PATH, "src", "actions", "ad_delete_sfn_handler", "src")]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+import ad_delete_entry  # noqa: E402
+import ad_delete_sfn_handler  # noqa: E402
+
+QUEUE_URL = 'https://sqs.us-west-2.amazonaws.com/123456789012/ad_delete_queue.fifo'
+
+
+def build_records(count):
+    return [{'username': f"user{index}", 'universal_id': str(index), 'account_type': 'employee',
+             'next_step': 'emp-1', 'next_step_date': '2024-01-01'} for index in range(count)]
+
+
+class FakeSfn:
+    def __init__(self):
+        self.inputs = []
+
+    def start_execution(self, stateMachineArn, input):
+        self.inputs.append(json.loads(input))
+        return {'executionArn': 'arn:execution'}
+
+
+def test_entry_starts_one_execution_for_several_records(monkeypatch):
+    sfn = FakeSfn()
+    succeeded = []
+    monkeypatch.setattr(ad_delete_entry, 'sfn', sfn)
+    monkeypatch.setattr(ad_delete_entry.outcome_publisher, 'handle_success',
+                        lambda record, lambda_name, sns_arn: succeeded.append(record.username))
+    records = build_records(3)
+
+    ad_delete_entry.lambda_handler({'Records': [{'Sns': {'Message': json.dumps(records)}}]}, None)
+
+    assert sfn.inputs == [{'records': records, 'action': 'suspend', 'waitSeconds': ad_delete_entry.wait}]
+    assert succeeded == ['user0', 'user1', 'user2']
+
+
+class FakeSqs:
+    def __init__(self):
+        self.batches = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append(Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+def test_suspend_sends_records_in_batches(monkeypatch):
+    sqs = FakeSqs()
+    monkeypatch.setattr(ad_delete_sfn_handler, 'sqs', sqs)
+
+    ad_delete_sfn_handler.process_suspend(build_records(12), 'suspend', QUEUE_URL)
+
+    assert [len(entries) for entries in sqs.batches] == [10, 2]
+    assert [json.loads(entry['MessageBody'])['username'] for entry in sqs.batches[0]] == \
+        [f"user{index}" for index in range(10)]
+    assert len({entry['MessageDeduplicationId'] for entry in sqs.batches[0]}) == 10
+
+
+def test_handler_keeps_records_through_the_workflow(monkeypatch):
+    sqs = FakeSqs()
+    monkeypatch.setattr(ad_delete_sfn_handler, 'sqs', sqs)
+    monkeypatch.setattr(ad_delete_sfn_handler, 'queue_url', QUEUE_URL)
+    records = build_records(2)
+
+    output = ad_delete_sfn_handler.lambda_handler({'records': records, 'action': 'suspend', 'waitSeconds': '180'}, None)
+
+    assert output == {'records': records, 'action': 'delete', 'waitSeconds': '180'}
+    assert [len(entries) for entries in sqs.batches] == [2]
@@ -0,0 +1,99 @@
+import os
+import sys
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path[:0] = [os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python"),
+                os.path.join(BASE_PATH, "src", "core", "advance_step", "src")]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+import advance_step  # noqa: E402
+from acct_decom_utils.event_table import event_table  # noqa: E402
+from deprov_common.event_index import event_index  # noqa: E402
+from deprov_common.step_registry import step_registry  # noqa: E402
+
+
+def cancelled(*codes):
+    return ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                        'CancellationReasons': [{'Code': code} for code in codes]}, 'TransactWriteItems')
+
+
+class FakeClient:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def transact_write_items(self, TransactItems):
+        self.calls.append([item['Update']['Key']['username'] for item in TransactItems])
+        error = self.errors.pop(0) if self.errors else None
+        if error:
+            raise error
+        return {}
+
+
+def use_client(monkeypatch, client):
+    monkeypatch.setattr(advance_step, 'dynamodb', SimpleNamespace(meta=SimpleNamespace(client=client)))
+    monkeypatch.setattr(advance_step.time, 'sleep', lambda seconds: None)
+
+
+def build_updates(*usernames):
+    step = step_registry.Step('employee', 'emp-1', '', 'emp-2', 7, 1)
+    return [(username, advance_step.build_step_update(
+        event_table.EventTableRecord(username=username, next_step='emp-1', next_step_date='2024-01-01'), step))
+        for username in usernames]
+
+
+def test_update_is_conditional_on_the_current_step():
+    (_, update), = build_updates('user0')
+
+    assert update['Update']['ConditionExpression'] == "next_step = :prev"
+    assert update['Update']['ExpressionAttributeValues'] == {
+        ':prev': 'emp-1',
+        ':nxt': 'emp-2',
+        ':shard': event_index.step_shard('user0', 'emp-2'),
+        ':nd': '2024-01-08'
+    }
+
+
+def test_skips_users_already_advanced_and_retries_the_rest(monkeypatch):
+    client = FakeClient(cancelled('ConditionalCheckFailed', 'None', 'TransactionConflict'))
+    use_client(monkeypatch, client)
+
+    outcomes = advance_step.advance_records(build_updates('user0', 'user1', 'user2'))
+
+    assert outcomes == {'user0': advance_step.SKIPPED, 'user1': advance_step.ADVANCED,
+                        'user2': advance_step.ADVANCED}
+    assert client.calls == [['user0', 'user1', 'user2'], ['user1', 'user2']]
+
+
+def test_fails_users_still_cancelled_after_every_attempt(monkeypatch):
+    client = FakeClient(*[cancelled('TransactionConflict')] * advance_step.MAX_ATTEMPTS)
+    use_client(monkeypatch, client)
+
+    outcomes = advance_step.advance_records(build_updates('user0'))
+
+    assert outcomes == {'user0': advance_step.FAILED}
+    assert len(client.calls) == advance_step.MAX_ATTEMPTS
+
+
+def test_user_listed_twice_is_advanced_once(monkeypatch):
+    client = FakeClient()
+    use_client(monkeypatch, client)
+
+    outcomes = advance_step.advance_records(build_updates('user0', 'user0', 'user1'))
+
+    assert outcomes == {'user0': advance_step.ADVANCED, 'user1': advance_step.ADVANCED}
+    assert client.calls == [['user0', 'user1']]
+
+
+def test_chunks_are_written_separately(monkeypatch):
+    client = FakeClient(None, cancelled('ConditionalCheckFailed'))
+    use_client(monkeypatch, client)
+    monkeypatch.setattr(advance_step, 'TRANSACT_CHUNK_SIZE', 2)
+
+    outcomes = advance_step.advance_records(build_updates('user0', 'user1', 'user2'))
+
+    assert client.calls == [['user0', 'user1'], ['user2']]
+    assert outcomes['user2'] == advance_step.SKIPPED
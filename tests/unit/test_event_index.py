@@ -0,0 +1,94 @@
+import os
+import sys
+from datetime import datetime
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path[:0] = [os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python")]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from deprov_common.event_index import event_index  # noqa: E402
+
+
+class FakeDynamoDB:
+    """
+    Answers queries with the items given per shard (`emp-1#0`) or, for `next_step-index`, per step (`emp-1`), one
+    item per page
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+
+    def query(self, **query_args):
+        self.queries.append(query_args)
+        key = next(value['S'] for name, value in query_args['ExpressionAttributeValues'].items() if name != ':due')
+        items = self.items.get(key, [])
+        position = int(query_args.get('ExclusiveStartKey', {}).get('position', 0))
+        page = {'Items': [{'username': {'S': username}, 'next_step_date': {'S': date}}
+                          for username, date in items[position:position + 1]]}
+        if position + 1 < len(items):
+            page['LastEvaluatedKey'] = {'position': position + 1}
+        return page
+
+
+def use_index(monkeypatch, client, mode, shards=4, reads=None):
+    monkeypatch.setattr(event_index, '_client', client)
+    monkeypatch.setattr(event_index, 'STEP_SHARD_INDEX', mode)
+    monkeypatch.setattr(event_index, 'STEP_SHARDS', shards)
+    monkeypatch.setattr(event_index, 'STEP_SHARD_READS', reads or shards)
+
+
+def test_users_stay_on_one_shard_of_their_step(monkeypatch):
+    monkeypatch.setattr(event_index, 'STEP_SHARDS', 4)
+
+    shards = {event_index.step_shard(f"user{index}", 'emp-1') for index in range(100)}
+
+    assert shards == {f"emp-1#{shard}" for shard in range(4)}
+    assert event_index.step_shard('user0', 'emp-1') == event_index.step_shard('user0', 'emp-1')
+    assert event_index.step_shard('user0', 'emp-1').split('#')[1] == \
+        event_index.step_shard('user0', 'emp-2').split('#')[1]
+
+
+def test_reads_every_configured_shard_merged_by_date(monkeypatch):
+    client = FakeDynamoDB({'emp-1#0': [('user0', '2024-01-01'), ('user4', '2024-01-04')],
+                           'emp-1#2': [('user2', '2024-01-02')],
+                           'emp-1#3': [('user3', '2024-01-03')]})
+    use_index(monkeypatch, client, event_index.SHARD_INDEX_ON)
+
+    records = list(event_index.iter_pending_events('emp-1', due_by=datetime(2024, 1, 10)))
+
+    assert [record.username for record in records] == ['user0', 'user2', 'user3', 'user4']
+    assert {query['ExpressionAttributeValues'][':shard']['S'] for query in client.queries} == \
+        {f"emp-1#{shard}" for shard in range(4)}
+    assert {query['ExpressionAttributeValues'][':due']['S'] for query in client.queries} == {'2024-01-10'}
+
+
+def test_reads_the_wider_shard_range_while_shards_are_lowered(monkeypatch):
+    client = FakeDynamoDB({'emp-1#5': [('user5', '2024-01-01')]})
+    use_index(monkeypatch, client, event_index.SHARD_INDEX_ON, shards=4, reads=8)
+
+    records = list(event_index.iter_pending_events('emp-1'))
+
+    assert [record.username for record in records] == ['user5']
+    assert len(client.queries) == 8
+
+
+def test_reads_unsharded_users_from_the_legacy_index_during_backfill(monkeypatch):
+    client = FakeDynamoDB({'emp-1#1': [('user1', '2024-01-02')], 'emp-1': [('user0', '2024-01-01')]})
+    use_index(monkeypatch, client, event_index.SHARD_INDEX_BACKFILL)
+
+    records = list(event_index.iter_pending_events('emp-1'))
+
+    assert [record.username for record in records] == ['user0', 'user1']
+    legacy, = [query for query in client.queries if query['IndexName'] == event_index.NEXT_STEP_INDEX]
+    assert legacy['FilterExpression'] == 'attribute_not_exists(next_step_shard)'
+
+
+def test_reads_only_the_legacy_index_until_the_shard_index_exists(monkeypatch):
+    client = FakeDynamoDB({'emp-1': [('user0', '2024-01-01')]})
+    use_index(monkeypatch, client, event_index.SHARD_INDEX_OFF)
+
+    records = list(event_index.iter_pending_events('emp-1'))
+
+    assert [record.username for record in records] == ['user0']
+    assert [query['IndexName'] for query in client.queries] == [event_index.NEXT_STEP_INDEX]
@@ -0,0 +1,158 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path[:0] = [os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python")]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from deprov_common.failure_state import failure_state  # noqa: E402
+
+
+def condition_failed(item=None):
+    response = {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}
+    if item is not None:
+        response['Item'] = item
+    return ClientError(response, 'UpdateItem')
+
+
+class FakeTable:
+    """
+    Returns or raises the given results for each `update_item` call, in order, and the given item for `get_item`
+    """
+
+    def __init__(self, *results, item=None):
+        self.results = list(results)
+        self.item = item
+        self.updates = []
+
+    def update_item(self, **update_args):
+        self.updates.append(update_args)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return {'Attributes': result}
+
+    def get_item(self, Key, ConsistentRead=False):
+        return {'Item': self.item} if self.item is not None else {}
+
+
+def outcome(lambda_name, token, username='user0'):
+    return failure_state.Outcome(token, username, lambda_name, token)
+
+
+def test_parse_outcomes_reports_unreadable_messages():
+    event = {'Records': [
+        {'messageId': 'm1', 'body': json.dumps({'username': 'user0', 'lambda_name': 'remove_asps'})},
+        {'messageId': 'm2', 'body': 'not json'},
+        {'messageId': 'm3', 'body': json.dumps({'username': 'user1'})}
+    ]}
+
+    outcomes, invalid = failure_state.parse_outcomes(event)
+
+    assert outcomes == [failure_state.Outcome('m1', 'user0', 'remove_asps', 'm1')]
+    assert invalid == ['m2', 'm3']
+
+
+def test_process_outcomes_returns_the_messages_of_users_that_failed():
+    outcomes = [outcome('remove_asps', 'm1'), outcome('remove_asps', 'm2', 'user1'), outcome('disable_in_gal', 'm3')]
+    applied = {}
+
+    def update(username, user_outcomes):
+        if username == 'user1':
+            raise RuntimeError('throttled')
+        applied[username] = [item.message_id for item in user_outcomes]
+
+    assert failure_state.process_outcomes(outcomes, update) == ['m2']
+    assert applied == {'user0': ['m1', 'm3']}
+
+
+def test_flag_failures_counts_each_message_once(monkeypatch):
+    table = FakeTable({'failed_lambdas': {'remove_asps': 1}, 'failure_tokens': ['m1']})
+    scheduled = []
+    monkeypatch.setattr(failure_state, 'table', table)
+    monkeypatch.setattr(failure_state, 'schedule_retries', lambda *args: scheduled.append(args))
+
+    failure_state.flag_failures('user0', [outcome('remove_asps', 'm1')])
+
+    update, = table.updates
+    assert 'NOT contains(#tokens, :t0)' in update['ConditionExpression']
+    assert update['ExpressionAttributeValues'][':t0'] == 'm1'
+    assert update['ExpressionAttributeValues'][':c0'] == 1
+    assert list(scheduled[0][3]) == ['remove_asps']
+
+
+def test_flag_failures_skips_messages_already_counted(monkeypatch):
+    counted = {'username': 'user0', 'failed_lambdas': {'remove_asps': 1, 'disable_in_gal': 1},
+               'failure_tokens': ['m1']}
+    table = FakeTable(condition_failed(),
+                      {'failed_lambdas': {'remove_asps': 1, 'disable_in_gal': 2}, 'failure_tokens': ['m1', 'm2']},
+                      item=counted)
+    scheduled = []
+    monkeypatch.setattr(failure_state, 'table', table)
+    monkeypatch.setattr(failure_state, 'schedule_retries', lambda *args: scheduled.append(args))
+
+    failure_state.flag_failures('user0', [outcome('remove_asps', 'm1'), outcome('disable_in_gal', 'm2')])
+
+    retry = table.updates[1]
+    assert retry['ExpressionAttributeNames']['#l0'] == 'disable_in_gal'
+    assert retry['ExpressionAttributeValues'][':tokens'] == ['m2']
+    # Both lambdas are scheduled, from the counts after the update
+    assert scheduled[0][1] == {'remove_asps': 1, 'disable_in_gal': 2}
+    assert sorted(scheduled[0][3]) == ['disable_in_gal', 'remove_asps']
+
+
+def test_flag_failures_reschedules_a_redelivered_message_without_counting_it(monkeypatch):
+    counted = {'username': 'user0', 'failed_lambdas': {'remove_asps': 1}, 'failure_tokens': ['m1']}
+    table = FakeTable(condition_failed(), item=counted)
+    scheduled = []
+    monkeypatch.setattr(failure_state, 'table', table)
+    monkeypatch.setattr(failure_state, 'schedule_retries', lambda *args: scheduled.append(args))
+
+    failure_state.flag_failures('user0', [outcome('remove_asps', 'm1')])
+
+    assert len(table.updates) == 1
+    assert scheduled[0][1] == {'remove_asps': 1}
+
+
+def test_flag_failures_ignores_users_that_no_longer_exist(monkeypatch):
+    table = FakeTable(condition_failed())
+    monkeypatch.setattr(failure_state, 'table', table)
+    scheduled = []
+    monkeypatch.setattr(failure_state, 'schedule_retries', lambda *args: scheduled.append(args))
+
+    failure_state.flag_failures('user0', [outcome('remove_asps', 'm1')])
+
+    assert scheduled == []
+
+
+def test_clear_failures_takes_one_call_for_users_without_failures(monkeypatch):
+    table = FakeTable(condition_failed({'username': {'S': 'user0'}}))
+    monkeypatch.setattr(failure_state, 'table', table)
+
+    failure_state.clear_failures('user0', [outcome('remove_asps', 'm1')])
+
+    update, = table.updates
+    assert update['ConditionExpression'] == 'attribute_exists(#failed) AND attribute_exists(#retry)'
+
+
+def test_clear_failures_of_users_flagged_before_retries_were_scheduled(monkeypatch):
+    legacy = {'username': {'S': 'user0'}, 'failed_lambdas': {'M': {'remove_asps': {'N': '1'}}}}
+    table = FakeTable(condition_failed(legacy), {'username': 'user0', 'has_failed_lambdas': 'true'}, {})
+    monkeypatch.setattr(failure_state, 'table', table)
+
+    failure_state.clear_failures('user0', [outcome('remove_asps', 'm1')])
+
+    assert table.updates[1]['UpdateExpression'] == 'REMOVE #failed.#l0'
+    assert table.updates[2]['UpdateExpression'] == 'REMOVE has_failed_lambdas, next_retry_at, #retry, #tokens'
+
+
+def test_due_lambdas_leaves_out_lambdas_out_of_retries_or_not_due():
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    failed = {'remove_asps': 1, 'disable_in_gal': failure_state.MAX_RETRIES, 'force_logout_google': 1}
+    retry_at = {'force_logout_google': failure_state.event_index.format_retry_at(now + timedelta(minutes=5))}
+
+    assert failure_state.due_lambdas(failed, retry_at, now) == ['remove_asps']
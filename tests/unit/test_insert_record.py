@@ -0,0 +1,77 @@
+import os
+import sys
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path[:0] = [os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python"),
+                os.path.join(BASE_PATH, "src", "core", "insert_record", "src")]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+import insert_record  # noqa: E402
+from acct_decom_utils.event_table import event_table  # noqa: E402
+from deprov_common.event_index import event_index  # noqa: E402
+
+
+def build_record(username, **fields):
+    return {'username': username, 'account_type': 'employee', 'insert_date': '2024-01-01', **fields}
+
+
+def test_validate_record():
+    assert insert_record.validate_record(build_record('user0')) is None
+    assert insert_record.validate_record('user0') == 'Record must be an object'
+    assert insert_record.validate_record({'username': 'user0'}) == 'Missing account_type, insert_date'
+    assert insert_record.validate_record(build_record('user0', account_type='alumni')) == \
+        'Unknown account type alumni'
+    assert insert_record.validate_record(build_record('user0', insert_date='01/01/2024')) == \
+        'Invalid insert_date 01/01/2024'
+    assert insert_record.validate_record(build_record('user0', next_step_date=20240101)) == \
+        'Invalid next_step_date 20240101'
+
+
+def test_build_item_waits_on_the_first_step_from_the_insert_date():
+    item = insert_record.build_item(build_record('user0'))
+
+    assert item['next_step'] == 'emp-1'
+    assert item['next_step_date'] == '2024-01-01'
+    assert item['next_step_shard'] == event_index.step_shard('user0', 'emp-1')
+
+
+def test_build_item_keeps_a_given_next_step_date():
+    item = insert_record.build_item(build_record('user0', account_type='student', next_step_date='2024-02-01'))
+
+    assert item['next_step'] == 'stu-1'
+    assert item['next_step_date'] == '2024-02-01'
+
+
+def test_insert_records_reports_each_record(monkeypatch):
+    written = []
+    queued = []
+
+    def write_item(item):
+        written.append(item['username'])
+        return insert_record.EXISTS if item['username'] == 'user3' else insert_record.INSERTED
+
+    monkeypatch.setattr(insert_record.event_index, 'get_records',
+                        lambda keys: [event_table.EventTableRecord(username='user1')])
+    monkeypatch.setattr(insert_record, 'write_item', write_item)
+    monkeypatch.setattr(insert_record.step_scheduler, 'enqueue_steps', lambda steps: queued.extend(steps))
+
+    response = insert_record.insert_records([build_record('user0'), build_record('user1'), {'username': 'user2'},
+                                             build_record('user0'), build_record('user3')])
+
+    assert response['status'] == 202
+    assert [(result['username'], result['status']) for result in response['results']] == [
+        ('user0', insert_record.INSERTED), ('user1', insert_record.EXISTS), ('user2', insert_record.INVALID),
+        ('user0', insert_record.INVALID), ('user3', insert_record.EXISTS)]
+    assert written == ['user0', 'user3']
+    assert queued == [('user0', 'emp-1', '2024-01-01')]
+
+
+def test_bulk_records_reads_ndjson():
+    body = '{"username": "user0"}\n\nnot json\n'
+    event = {'ndjson_base64': insert_record.base64.b64encode(body.encode('utf-8')).decode('utf-8')}
+
+    records = insert_record.bulk_records(event)
+
+    assert records[0] == {'username': 'user0'}
+    assert records[1]['_error'].startswith('Invalid JSON')
+    assert insert_record.bulk_records({'username': 'user0'}) is None
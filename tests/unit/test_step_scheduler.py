@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path[:0] = [os.path.join(BASE_PATH, "src", "layers", "deprov_common", "python")]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from deprov_common.step_scheduler import step_scheduler  # noqa: E402
+
+NOW = datetime(2024, 1, 10, 12, 30, tzinfo=timezone.utc)
+
+
+class FakeScheduler:
+    def __init__(self, error_code=None):
+        self.error_code = error_code
+        self.schedules = []
+
+    def create_schedule(self, **schedule):
+        self.schedules.append(schedule)
+        if self.error_code:
+            raise ClientError({'Error': {'Code': self.error_code, 'Message': self.error_code}}, 'CreateSchedule')
+        return {'ScheduleArn': 'arn:schedule'}
+
+
+def use_scheduler(monkeypatch, client):
+    monkeypatch.setattr(step_scheduler, 'SCHEDULE_GROUP', 'deprov_step_schedules')
+    monkeypatch.setattr(step_scheduler, 'TARGET_ARN', 'arn:aws:lambda:us-west-2:123456789012:function:target')
+    monkeypatch.setattr(step_scheduler, 'ROLE_ARN', 'arn:aws:iam::123456789012:role/scheduler')
+    monkeypatch.setattr(step_scheduler, '_client', client)
+
+
+def test_future_steps_fire_at_midnight_of_their_date(monkeypatch):
+    client = FakeScheduler()
+    use_scheduler(monkeypatch, client)
+
+    assert step_scheduler.schedule_step('user0', 'emp-2', '2024-01-17', now=NOW)
+
+    schedule, = client.schedules
+    assert schedule['ScheduleExpression'] == 'at(2024-01-17T00:00:00)'
+    assert schedule['ScheduleExpressionTimezone'] == 'UTC'
+    assert json.loads(schedule['Target']['Input']) == {'username': 'user0', 'step': 'emp-2'}
+
+
+def test_steps_already_due_fire_shortly_after_being_scheduled(monkeypatch):
+    client = FakeScheduler()
+    use_scheduler(monkeypatch, client)
+
+    assert step_scheduler.schedule_step('user0', 'emp-2', '2024-01-01', now=NOW)
+
+    assert client.schedules[0]['ScheduleExpression'] == 'at(2024-01-10T12:31:00)'
+
+
+def test_existing_schedule_counts_as_scheduled(monkeypatch):
+    use_scheduler(monkeypatch, FakeScheduler('ConflictException'))
+
+    assert step_scheduler.schedule_step('user0', 'emp-2', '2024-01-17', now=NOW)
+
+
+def test_other_errors_are_left_to_reconciliation(monkeypatch):
+    use_scheduler(monkeypatch, FakeScheduler('ServiceQuotaExceededException'))
+
+    assert not step_scheduler.schedule_step('user0', 'emp-2', '2024-01-17', now=NOW)
+    assert not step_scheduler.schedule_step('user0', 'emp-2', 'not a date', now=NOW)
+
+
+def test_nothing_is_scheduled_without_a_schedule_group(monkeypatch):
+    client = FakeScheduler()
+    use_scheduler(monkeypatch, client)
+    monkeypatch.setattr(step_scheduler, 'SCHEDULE_GROUP', None)
+
+    assert not step_scheduler.schedule_step('user0', 'emp-2', '2024-01-17', now=NOW)
+    assert client.schedules == []
+
+
+def test_schedule_names_are_unique_per_date_and_valid():
+    assert step_scheduler.schedule_name('user0', 'emp-2', '2024-01-17') == 'user0.emp-2.2024-01-17'
+    assert step_scheduler.schedule_name('user0', 'emp-2', '2024-01-17') != \
+        step_scheduler.schedule_name('user0', 'emp-2', '2024-02-17')
+
+    long_name = step_scheduler.schedule_name('first.last+deprovisioned' * 3, 'emp-2', '2024-01-17')
+    assert len(long_name) == step_scheduler.MAX_NAME_LENGTH
+    assert not step_scheduler._INVALID_NAME_CHARS.search(long_name)
+    assert long_name != step_scheduler.schedule_name('first.last+deprovisioned' * 3, 'emp-2', '2024-02-17')